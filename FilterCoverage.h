@@ -1,6 +1,11 @@
 #ifndef FilterCoverage_h
 #define FilterCoverage_h
 
+#include <algorithm>
+#include <cstdlib>
+#include <cstring>
+#include <map>
+#include <stdint.h>
 #include <string>
 #include <vector>
 
@@ -26,6 +31,39 @@ extern "C" uint64_t *__llvm_profile_end_counters(void);
 // A helper object, FilterCoverage::Scope, can be used to ensure recursive
 // functions record filtered coverage for the first and all nested calls. For
 // more information, see the comment above FilterCoverage::Scope, below.
+//
+// beginFilteringCoverage and endFilteringCoverage copy every counter twice and
+// write the whole profile each time filtering ends, which is too slow for code
+// that is filtered many times, such as a function called in a loop. Deferred
+// filtering has the same output but is much cheaper:
+//    FilterCoverage::beginDeferredFilteringCoverage();
+//    functionB();
+//    FilterCoverage::endDeferredFilteringCoverage();
+// Beginning copies the counters into a preallocated snapshot with a single
+// memcpy. Ending adds the change in each counter since the snapshot to the
+// filtered counters in one pass, without restoring the counters or writing a
+// file. The filtered coverage is written to LLVM_PROFILE_FILE at exit, or
+// earlier with flushFilteredCoverage, and the remaining coverage, without the
+// filtered changes, is written to LLVM_PROFILE_FILE + _unfiltered at exit.
+//
+// Coverage can also be filtered into several named regions in one run, such as
+// one region per phase of a program:
+//    FilterCoverage::beginFilteringRegion("layout");
+//    layout();
+//    FilterCoverage::endFilteringRegion("layout");
+//    FilterCoverage::beginFilteringRegion("paint");
+//    paint();
+//    FilterCoverage::endFilteringRegion("paint");
+// Named regions use deferred filtering and each region's coverage is written to
+// LLVM_PROFILE_FILE + .region- + name at exit, such as
+// default.profraw.region-layout. Regions
+// may nest or overlap; the remaining coverage in _unfiltered excludes the
+// coverage of every region. "unfiltered" cannot be used as a region name.
+// Coverage.fromFilteredRawLlvmProfiles in coverage.py loads all of the regions.
+//
+// Deferred and immediate filtering should not be mixed in one program. LLVM's
+// continuous mode (%c in LLVM_PROFILE_FILE) is not supported because it writes
+// counters to the profile as they change.
 namespace FilterCoverage {
 
 // Return the path where coverage will be written.
@@ -112,6 +150,232 @@ static void endFilteringCoverage() {
   std::copy(unfilteredCounters().begin(), unfilteredCounters().end(), begin);
 }
 
+// A filter region with its own accumulated filtered counters. Regions use
+// deferred filtering and each region is written to its own file at exit.
+struct Region {
+  Region() : active(false) {}
+  // The counters when filtering this region began.
+  CoverageCounters snapshot;
+  // The accumulated changes in the counters while filtering this region.
+  CoverageCounters filtered;
+  // True if filtering of this region has begun but not ended.
+  bool active;
+};
+
+typedef std::map<std::basic_string<char>, Region*> Regions;
+
+// Static storage for the regions by name. The unnamed region, "", is used by
+// beginDeferredFilteringCoverage.
+static Regions& regions() {
+  __DEFINE_STATIC_LOCAL(Regions, regions, ());
+  return regions;
+}
+
+// Return the region with the given name, creating it if needed. Looking up a
+// region once and keeping the reference avoids a lookup each time filtering
+// begins and ends.
+static Region& region(const char* name) {
+  Region*& region = regions()[name];
+  if (!region)
+    region = new Region();
+  return *region;
+}
+
+// Static storage for the coverage recorded while any region was filtering.
+// Where regions overlap, the coverage is only recorded here once, so it can be
+// removed from the unfiltered coverage at exit.
+static Region& anyRegion() {
+  __DEFINE_STATIC_LOCAL(Region, any, ());
+  return any;
+}
+
+// Static storage for the number of regions that are filtering.
+static int& activeRegionCount() {
+  static int count = 0;
+  return count;
+}
+
+// Static storage for the region whose snapshot is the start of anyRegion. The
+// region that begins when no other region is filtering shares its snapshot
+// with anyRegion instead of taking a second one. If it ends while other regions
+// are filtering, the snapshot moves to anyRegion.
+static Region*& anyRegionSnapshotOwner() {
+  static Region* owner = 0;
+  return owner;
+}
+
+// Return the path where the coverage of a region will be written. The unnamed
+// region is written to LLVM_PROFILE_FILE and other regions to LLVM_PROFILE_FILE
+// + .region- + name.
+static std::basic_string<char> regionOutputFilename(const std::basic_string<char>& name) {
+  std::basic_string<char> profileFile = coverageProfileOutputFilename();
+  if (!name.empty())
+    profileFile.append(".region-").append(name);
+  return profileFile;
+}
+
+static void finishDeferredFilteringCoverage();
+
+// Register finishDeferredFilteringCoverage to run at exit. Functions registered
+// with atexit run in reverse order, so this runs before the profile runtime,
+// which registers itself when the program starts, writes coverage at exit.
+static void finishDeferredFilteringCoverageAtExit() {
+  static bool registered = false;
+  if (registered)
+    return;
+  registered = true;
+  std::atexit(finishDeferredFilteringCoverage);
+}
+
+// Copy the current counters into snapshot with a single memcpy. The snapshot
+// only needs to be allocated the first time.
+static void snapshotCounters(CoverageCounters& snapshot) {
+  uint64_t* begin = __llvm_profile_begin_counters();
+  uint64_t* end = __llvm_profile_end_counters();
+  size_t counterCount = end - begin;
+  if (snapshot.size() != counterCount)
+    snapshot.resize(counterCount);
+  if (counterCount)
+    std::memcpy(&snapshot[0], begin, counterCount * sizeof(uint64_t));
+}
+
+// Add the change in each counter since snapshot to filtered, and to
+// alsoFiltered if it is given.
+static void accumulateCounters(const CoverageCounters& snapshot, CoverageCounters& filtered, CoverageCounters* alsoFiltered = 0) {
+  uint64_t* begin = __llvm_profile_begin_counters();
+  uint64_t* end = __llvm_profile_end_counters();
+  size_t counterCount = std::min<size_t>(end - begin, snapshot.size());
+
+  if (filtered.size() < counterCount)
+    filtered.resize(counterCount, 0);
+  if (alsoFiltered && alsoFiltered->size() < counterCount)
+    alsoFiltered->resize(counterCount, 0);
+  if (!counterCount)
+    return;
+  uint64_t* filteredData = &filtered[0];
+  const uint64_t* snapshotData = &snapshot[0];
+  if (!alsoFiltered) {
+    for (size_t i = 0; i < counterCount; ++i)
+      filteredData[i] += begin[i] - snapshotData[i];
+    return;
+  }
+  uint64_t* alsoFilteredData = &(*alsoFiltered)[0];
+  for (size_t i = 0; i < counterCount; ++i) {
+    uint64_t change = begin[i] - snapshotData[i];
+    filteredData[i] += change;
+    alsoFilteredData[i] += change;
+  }
+}
+
+// Start recording filtered coverage for a region. A region cannot be nested in
+// itself; beginning a region that is already filtering does nothing.
+static void beginFilteringRegion(Region& region) {
+  if (region.active)
+    return;
+  finishDeferredFilteringCoverageAtExit();
+  region.active = true;
+  snapshotCounters(region.snapshot);
+  if (activeRegionCount()++ == 0)
+    anyRegionSnapshotOwner() = &region;
+}
+
+// Stop recording filtered coverage for a region and add it to the region's
+// filtered counters.
+static void endFilteringRegion(Region& region) {
+  if (!region.active)
+    return;
+  region.active = false;
+  Region& any = anyRegion();
+  bool ownsAnyRegionSnapshot = anyRegionSnapshotOwner() == &region;
+  if (--activeRegionCount() == 0) {
+    if (ownsAnyRegionSnapshot) {
+      // The region spanned all filtering since no region was active, so its
+      // changes are also anyRegion's.
+      accumulateCounters(region.snapshot, region.filtered, &any.filtered);
+    } else {
+      accumulateCounters(region.snapshot, region.filtered);
+      accumulateCounters(any.snapshot, any.filtered);
+    }
+    anyRegionSnapshotOwner() = 0;
+    return;
+  }
+  accumulateCounters(region.snapshot, region.filtered);
+  if (ownsAnyRegionSnapshot) {
+    region.snapshot.swap(any.snapshot);
+    anyRegionSnapshotOwner() = &any;
+  }
+}
+
+static void beginFilteringRegion(const char* name) {
+  beginFilteringRegion(region(name));
+}
+
+static void endFilteringRegion(const char* name) {
+  endFilteringRegion(region(name));
+}
+
+// Start recording filtered coverage without writing it when filtering ends.
+static void beginDeferredFilteringCoverage() {
+  beginFilteringRegion(region(""));
+}
+
+// Stop recording filtered coverage and add it to the filtered counters.
+static void endDeferredFilteringCoverage() {
+  endFilteringRegion(region(""));
+}
+
+// Write the filtered coverage recorded by each region so far to its file.
+// Filtering can continue afterwards.
+static void flushFilteredCoverage() {
+  uint64_t* begin = __llvm_profile_begin_counters();
+  uint64_t* end = __llvm_profile_end_counters();
+
+  // Temporarily replace the counters with each region's filtered counters to
+  // write them.
+  unfilteredCounters().assign(begin, end);
+  for (Regions::iterator it = regions().begin(); it != regions().end(); ++it) {
+    CoverageCounters& filtered = it->second->filtered;
+    filtered.resize(end - begin, 0);
+    std::copy(filtered.begin(), filtered.end(), begin);
+
+    std::basic_string<char> profileFile = regionOutputFilename(it->first);
+    __llvm_profile_set_filename(profileFile.c_str());
+    __llvm_profile_write_file();
+  }
+
+  // Any remaining coverage is written to [*.profraw]_unfiltered at exit.
+  std::basic_string<char> profileFile = coverageProfileOutputFilename();
+  profileFile.append("_unfiltered");
+  __llvm_profile_set_filename(profileFile.c_str());
+
+  std::copy(unfilteredCounters().begin(), unfilteredCounters().end(), begin);
+}
+
+// Write the filtered coverage and remove it from the counters so only the
+// remaining, unfiltered, coverage is written when the program exits. This runs
+// at exit once deferred filtering has been used.
+static void finishDeferredFilteringCoverage() {
+  // The program may exit while filtering.
+  for (Regions::iterator it = regions().begin(); it != regions().end(); ++it)
+    endFilteringRegion(*it->second);
+  flushFilteredCoverage();
+
+  uint64_t* begin = __llvm_profile_begin_counters();
+  uint64_t* end = __llvm_profile_end_counters();
+  const CoverageCounters& filtered = anyRegion().filtered;
+  for (size_t i = 0; i < filtered.size() && begin + i < end; ++i)
+    begin[i] -= filtered[i];
+}
+
+// How a Scope filters coverage.
+enum Mode {
+  // Write the filtered coverage each time filtering ends. See
+  // beginFilteringCoverage.
+  WriteOnEnd,
+  // Accumulate the filtered coverage and write it at exit. See
+  // beginDeferredFilteringCoverage.
+  Deferred
+};
 
 // Helper object for recording coverage in recursive functions. Coverage will
 // only be started/ended for the first instantiation of this Scope. This ensures
@@ -122,9 +386,17 @@ static void endFilteringCoverage() {
 //      ...
 //      recursiveFunction();
 //    }
+// For code that is filtered many times, use deferred filtering:
+//      FilterCoverage::Scope scope(FilterCoverage::Deferred);
+// or a named region:
+//      FilterCoverage::Scope scope("layout");
 class Scope {
 public:
-  Scope() : filtering_(false) {
+  explicit Scope(Mode mode = WriteOnEnd) : region_(0), filtering_(false) {
+    if (mode == Deferred) {
+      beginRegion(region(""));
+      return;
+    }
     // Do not record coverage if there is already an active scope recording.
     if (activeFilteringScope())
       return;
@@ -132,9 +404,19 @@ public:
     filtering_ = true;
     beginFilteringCoverage();
   }
+  explicit Scope(const char* name) : region_(0), filtering_(false) {
+    beginRegion(region(name));
+  }
+  explicit Scope(Region& region) : region_(0), filtering_(false) {
+    beginRegion(region);
+  }
   ~Scope() {
     if (!filtering_)
       return;
+    if (region_) {
+      endFilteringRegion(*region_);
+      return;
+    }
     endFilteringCoverage();
     activeFilteringScope() = false;
   }
@@ -145,6 +427,16 @@ private:
     static bool active = false;
     return active;
   }
+  void beginRegion(Region& region) {
+    // Do not record coverage if the region is already recording.
+    if (region.active)
+      return;
+    region_ = &region;
+    filtering_ = true;
+    beginFilteringRegion(region);
+  }
+  // The region this object is recording, if it uses deferred filtering.
+  Region* region_;
   // True if this object is recording filtered coverage.
   bool filtering_;
 };
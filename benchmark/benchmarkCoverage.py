@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# benchmarkCoverage.py - Time and memory-profile each stage of processing a
+# large profile.
+# Usage: python -m benchmark.benchmarkCoverage [--functions N [N ...]]
+#            [--stages STAGE [STAGE ...]] [--demangler DEMANGLER] [-o results.json]
+#            [--baseline earlierResults.json]
+#
+# Runs each stage (parsing an llvm-profdata dump, demangling, encoding as JSON
+# and comparing two runs) on synthetic Chromium-like profiles of each size and
+# writes the results as JSON, so results can be saved and compared over time to
+# find regressions and measure optimizations.
+#
+# Each measurement runs in a new process so the peak memory use of one stage
+# does not hide the next. The input of a stage is built before it is measured;
+# maxRss is the peak memory use of the process including its input and
+# maxRssIncrease is how much the stage itself raised the peak.
+#
+# With --baseline, each measurement is also compared with the same stage and
+# size in earlier results.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from benchmark import synthetic
+import compare
+from coverage.coverage import Coverage
+from coverage.demangle import IN_PROCESS_DEMANGLER, inProcessDemanglingAvailable
+
+# Return the peak memory use of this process in bytes. ru_maxrss is in
+# kilobytes on Linux and bytes on MacOS.
+def _maxRss():
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss if sys.platform == "darwin" else maxRss * 1024
+
+def _cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+# Each stage takes (the number of functions, the demangler) and returns (a
+# function to measure, a function to clean up afterwards).
+
+def _parseStage(functionCount, demangler):
+    # The dump is read from a file, like the output of llvm-profdata, rather
+    # than held in memory.
+    dumpFile = tempfile.NamedTemporaryFile(suffix=".txt", delete=False)
+    with dumpFile:
+        dumpFile.writelines(synthetic.profDataShowAllFunctions(functionCount))
+    def parse():
+        with open(dumpFile.name, "r") as inFile:
+            return Coverage._fromProfDataShowAllFunctions(inFile)
+    return parse, lambda: os.remove(dumpFile.name)
+
+def _demangleStage(functionCount, demangler):
+    coverage = synthetic.coverage(functionCount)
+    return lambda: coverage.demangle(demangler), None
+
+def _asJsonStage(functionCount, demangler):
+    coverage = synthetic.coverage(functionCount)
+    return coverage.asJson, None
+
+def _compareStage(functionCount, demangler):
+    # The second run calls 1% of the functions a different number of times.
+    coverageA = synthetic.coverage(functionCount)
+    coverageB = synthetic.coverage(functionCount, changedFraction = 0.01)
+    return lambda: compare.compare(coverageA, coverageB), None
+
+STAGES = [
+    ("parse", _parseStage),
+    ("demangle", _demangleStage),
+    ("asJson", _asJsonStage),
+    ("compare", _compareStage),
+]
+
+# Measure one stage and return its result. This runs in a worker process.
+def _measure(stage, functionCount, demangler):
+    run, cleanUp = dict(STAGES)[stage](functionCount, demangler)
+    try:
+        setupMaxRss = _maxRss()
+        cpuStart = _cpuTime()
+        start = time.time()
+        run()
+        seconds = time.time() - start
+        cpuSeconds = _cpuTime() - cpuStart
+        maxRss = _maxRss()
+    finally:
+        if cleanUp:
+            cleanUp()
+    return {
+        "stage": stage,
+        "functions": functionCount,
+        "seconds": seconds,
+        "cpuSeconds": cpuSeconds,
+        "maxRss": maxRss,
+        "maxRssIncrease": maxRss - setupMaxRss,
+    }
+
+# Measure stage in a new process and return its result.
+def measure(stage, functionCount, demangler):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(_measure, (stage, functionCount, demangler))
+    finally:
+        pool.close()
+        pool.join()
+
+# Return a map from (stage, functions) to the results in a JSON report.
+def _loadResults(path):
+    with open(path, "r") as inFile:
+        report = json.load(inFile)
+    return dict(((result["stage"], result["functions"]), result) for result in report["results"])
+
+# Return a description of result relative to baseline, such as "1.50x time,
+# 0.90x peak".
+def _formatChange(result, baseline):
+    def ratio(key):
+        return "%.2fx" % (float(result[key]) / baseline[key]) if baseline[key] else "n/a"
+    return ratio("seconds") + " time, " + ratio("maxRss") + " peak"
+
+def _defaultDemangler():
+    return IN_PROCESS_DEMANGLER if inProcessDemanglingAvailable() else "c++filt -n"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of processing large profiles")
+    parser.add_argument("--functions", type=int, nargs="+", default=[10000, 100000, 1000000], help="Numbers of functions in the synthetic profiles")
+    parser.add_argument("--stages", nargs="+", choices=[name for name, stage in STAGES], default=[name for name, stage in STAGES], help="Stages to measure")
+    parser.add_argument("--demangler", default=None, help="Demangler command (default: in-process if available, otherwise c++filt -n)")
+    parser.add_argument("-o", "--output", help="Write the JSON results to a file instead of stdout")
+    parser.add_argument("--baseline", help="Earlier JSON results to compare with")
+    args = parser.parse_args()
+
+    demangler = args.demangler or _defaultDemangler()
+    baseline = _loadResults(args.baseline) if args.baseline else {}
+    results = []
+    for functionCount in args.functions:
+        for stage in args.stages:
+            result = measure(stage, functionCount, demangler)
+            line = "%-9s %8d functions %8.2fs %8.0fMB peak" % (stage, functionCount, result["seconds"], result["maxRss"] / float(1 << 20))
+            if (stage, functionCount) in baseline:
+                line += " (" + _formatChange(result, baseline[(stage, functionCount)]) + ")"
+            sys.stderr.write(line + "\n")
+            results.append(result)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "demangler": demangler,
+        "results": results,
+    }
+    encoded = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as outFile:
+            outFile.write(encoded + "\n")
+    else:
+        print encoded
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# benchmarkDemangle.py - Compare demangling throughput.
+# Usage: python -m benchmark.benchmarkDemangle [--names N] [--demangler DEMANGLER]
+#
+# Times demangling synthetic Chromium-like names with a single c++filt process
+# fed through one communicate() call (how Coverage.demangle used to work),
+# with DemanglerPool at several pool sizes, and in-process if available.
+
+import argparse
+import multiprocessing
+import subprocess
+import time
+
+from benchmark.synthetic import mangledNames
+from coverage.demangle import DemanglerPool, IN_PROCESS_DEMANGLER, inProcessDemanglingAvailable
+
+# Demangle names with one demangler process and a single communicate() call.
+def demangleSingleShot(demangler, names):
+    proc = subprocess.Popen(demangler, shell=True, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, err = proc.communicate("\n".join(names))
+    if err != "":
+        raise AssertionError(err)
+    return out.split("\n")
+
+def _report(label, names, seconds):
+    print "%-28s %8.2fs %12.0f names/s" % (label, seconds, len(names) / seconds)
+
+def _time(function):
+    start = time.time()
+    result = function()
+    return result, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark demangling throughput")
+    parser.add_argument("--names", type=int, default=200000, help="Number of names to demangle")
+    parser.add_argument("--demangler", default="c++filt -n", help="Demangler command")
+    args = parser.parse_args()
+
+    names = mangledNames(args.names)
+    expected, seconds = _time(lambda: demangleSingleShot(args.demangler, names))
+    _report("single-shot", names, seconds)
+
+    processCounts = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+    for processes in processCounts:
+        demangled, seconds = _time(lambda: DemanglerPool(args.demangler, processes).demangle(names))
+        if demangled != expected:
+            raise AssertionError("DemanglerPool output differs from the single-shot demangler.")
+        _report("pool, %d processes" % processes, names, seconds)
+
+    if inProcessDemanglingAvailable():
+        demangled, seconds = _time(lambda: DemanglerPool(IN_PROCESS_DEMANGLER).demangle(names))
+        _report("in-process", names, seconds)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+// filterCoverageBenchmark.cpp - Measure the cost of FilterCoverage::Scope.
+// Usage: filterCoverageBenchmark [iterations]
+//
+// Times entering and leaving a FilterCoverage::Scope for several counter array
+// sizes, with filtered coverage written every time filtering ends (WriteOnEnd)
+// and with deferred filtering (Deferred). The profile runtime is replaced by a
+// counter array of the given size and a write function that writes the
+// counters to LLVM_PROFILE_FILE, so this does not need to be built with
+// coverage.
+
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <stdint.h>
+#include <string>
+#include <unistd.h>
+#include <vector>
+
+static std::vector<uint64_t> counters;
+static std::string profileFilename;
+static char profileTemplate[] = "/tmp/filterCoverageBenchmarkXXXXXX";
+
+extern "C" void __llvm_profile_set_filename(const char* name) {
+  profileFilename = name;
+}
+
+extern "C" int __llvm_profile_write_file(void) {
+  FILE* file = std::fopen(profileFilename.c_str(), "wb");
+  if (!file)
+    return -1;
+  std::fwrite(counters.data(), sizeof(uint64_t), counters.size(), file);
+  std::fclose(file);
+  return 0;
+}
+
+extern "C" uint64_t* __llvm_profile_begin_counters(void) {
+  return counters.data();
+}
+
+extern "C" uint64_t* __llvm_profile_end_counters(void) {
+  return counters.data() + counters.size();
+}
+
+#include "../FilterCoverage.h"
+
+// Stand-in for an instrumented function: bump a few counters.
+static void filteredFunction(size_t call) {
+  counters[call % counters.size()]++;
+  counters[(call * 7) % counters.size()]++;
+}
+
+// Deferred filtering writes profiles at exit, so this is registered before it
+// to run after it.
+static void removeProfiles() {
+  std::remove(profileTemplate);
+  std::remove((std::string(profileTemplate) + "_unfiltered").c_str());
+}
+
+// Return the mean nanoseconds to enter a Scope, call filteredFunction and
+// leave the Scope.
+static double scopeNanoseconds(FilterCoverage::Mode mode, size_t iterations) {
+  std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+  for (size_t i = 0; i < iterations; ++i) {
+    FilterCoverage::Scope scope(mode);
+    filteredFunction(i);
+  }
+  std::chrono::steady_clock::time_point end = std::chrono::steady_clock::now();
+  return std::chrono::duration<double, std::nano>(end - start).count() / iterations;
+}
+
+int main(int argc, char* argv[]) {
+  size_t iterations = argc > 1 ? std::strtoul(argv[1], 0, 10) : 1000;
+
+  // Write profiles to a scratch file rather than the working directory.
+  int profileFile = mkstemp(profileTemplate);
+  if (profileFile < 0)
+    return 1;
+  close(profileFile);
+  setenv("LLVM_PROFILE_FILE", profileTemplate, 1);
+  std::atexit(removeProfiles);
+
+  std::printf("%12s %18s %18s\n", "counters", "WriteOnEnd ns", "Deferred ns");
+  size_t counterCounts[] = { 1000, 10000, 100000, 1000000 };
+  for (size_t i = 0; i < sizeof(counterCounts) / sizeof(counterCounts[0]); ++i) {
+    counters.assign(counterCounts[i], 1);
+    double writeOnEnd = scopeNanoseconds(FilterCoverage::WriteOnEnd, iterations);
+    double deferred = scopeNanoseconds(FilterCoverage::Deferred, iterations);
+    std::printf("%12zu %18.0f %18.0f\n", counterCounts[i], writeOnEnd, deferred);
+  }
+  return 0;
+}
@@ -0,0 +1,72 @@
+# synthetic.py - synthetic profiles for benchmarks
+#
+# Chromium-scale programs have hundreds of thousands of functions with long
+# mangled names, most of which are called rarely and a few of which are called
+# millions of times. These functions generate deterministic functions like that,
+# as llvm-profdata show -all-functions dumps or as Coverage objects, so every
+# run of a benchmark measures the same input.
+
+import random
+
+from coverage.coverage import Coverage
+
+_NAMESPACES = ["blink", "content", "cc", "gfx", "base", "net", "viz", "ui"]
+
+def _lengthPrefixed(name):
+    return str(len(name)) + name
+
+# Return the mangled name of function index, such as
+# _ZN5blink13LayoutObject714paintInternal5ERKN3gfx10PaintInfo3ERKN4base6VectorIiEE
+# (blink::LayoutObject7::paintInternal5(gfx::PaintInfo3 const&, base::Vector<int> const&)).
+def mangledName(index):
+    namespace = _NAMESPACES[index % len(_NAMESPACES)]
+    className = "LayoutObject%d" % (index % 997)
+    methodName = "paintInternal%d" % index
+    argumentNamespace = _NAMESPACES[index % 3]
+    argumentName = "PaintInfo%d" % (index % 31)
+    return ("_ZN" + _lengthPrefixed(namespace) + _lengthPrefixed(className) + _lengthPrefixed(methodName) +
+            "ERKN" + _lengthPrefixed(argumentNamespace) + _lengthPrefixed(argumentName) + "ERKN4base6VectorIiEE")
+
+# Return a list of count distinct mangled names.
+def mangledNames(count):
+    return [mangledName(index) for index in xrange(count)]
+
+# Return the file of function index. Like static functions, one in ten
+# functions has a file.
+def fileName(index):
+    if index % 10:
+        return ""
+    return "../../third_party/blink/renderer/core/layout/layout_object_%d.cc" % (index % 5000)
+
+# Yield (file, function, call count) for count functions. Call counts have a
+# long tail: most functions are called a few times and some very often. If
+# changedFraction is given, that fraction of the functions, chosen with
+# changeSeed, have a different call count, as in a second run of the program.
+def functions(count, seed = 0, changedFraction = 0.0, changeSeed = 1):
+    counts = random.Random(seed)
+    changes = random.Random(changeSeed)
+    for index in xrange(count):
+        callCount = int(counts.paretovariate(1.2))
+        if changedFraction and changes.random() < changedFraction:
+            callCount += changes.randint(1, 1000)
+        yield fileName(index), mangledName(index), callCount
+
+# Yield the lines of an llvm-profdata show -all-functions dump of functions.
+# See Coverage._fromProfDataShowAllFunctions.
+def profDataShowAllFunctions(count, seed = 0):
+    yield "Counters:\n"
+    for file, function, callCount in functions(count, seed):
+        yield "  " + (file + ":" if file else "") + function + ":\n"
+        yield "    Hash: 0x0123456789abcdef\n"
+        yield "    Counters: 12\n"
+        yield "    Function count: %d\n" % callCount
+    yield "Instrumentation level: Front-end\n"
+    yield "Functions shown: %d\n" % count
+    yield "Total functions: %d\n" % count
+
+# Return a Coverage object of count functions. See functions.
+def coverage(count, seed = 0, changedFraction = 0.0, changeSeed = 1):
+    result = Coverage()
+    for file, function, callCount in functions(count, seed, changedFraction, changeSeed):
+        result.addCallCount(file, function, callCount)
+    return result
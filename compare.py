@@ -2,61 +2,426 @@
 
 # compare.py - Compare two raw code coverage files.
 # Usage: compare.py coverageA.profraw coverageB.profraw
+#        compare.py --baseline good.profraw bad1.profraw bad2.profraw ...
+#        compare.py --passing good*.profraw --failing bad*.profraw
+#        compare.py --stream [--filter PATTERN] coverageA.profraw coverageB.profraw
 
 import argparse
+from collections import namedtuple
+import glob
+import heapq
+from itertools import islice, izip
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os.path
+import re
+import sys
+
+from coverage.cache import DemangleCache
 from coverage.coverage import Coverage
+from coverage.demangle import IN_PROCESS_DEMANGLER, demangleNames, inProcessDemanglingAvailable
+from coverage.spectrum import METRICS, Spectrum
+from coverage import stages
+
+# A call count difference for the function with the given id. See
+# callCountDifferences.
+Difference = namedtuple("Difference", ["id", "countA", "countB", "delta"])
 
 def _fileAndFunction(file, function):
     return (file + ": " if file else "") + function
 
-# Return a list of human-readable function call count differences, sorted by |call count difference|.
-def compare(coverageA, coverageB):
-    # Map from file+function, using _fileAndFunction, to (a count, b count).
-    differenceMap = {}
-    for (file, function) in coverageA.functions():
-        key = _fileAndFunction(file, function)
-        differenceMap[key] = (coverageA.callCount(file, function), 0)
-    for (file, function) in coverageB.functions():
-        key = _fileAndFunction(file, function)
-        aCount = differenceMap[key][0] if key in differenceMap else 0
-        differenceMap[key] = (aCount, coverageB.callCount(file, function))
-
-    # List of (|call count difference|, human readable difference).
+# Return (differences, functionForId) where differences is a list of Difference
+# for every function whose call count differs between coverageA and coverageB,
+# and functionForId maps a Difference's id to its (file, function) pair.
+def callCountDifferences(coverageA, coverageB):
+    countsA, countsB, rowsB = Coverage.alignCallCounts(coverageA, coverageB)
+    differences = [Difference(id, aCount, bCount, abs(aCount - bCount)) for id, (aCount, bCount) in enumerate(izip(countsA, countsB)) if aCount != bCount]
+
+    rowCountA = len(coverageA)
+    def functionForId(id):
+        if id < rowCountA:
+            return coverageA.functionAt(id)
+        return coverageB.functionAt(rowsB[id - rowCountA])
+    return differences, functionForId
+
+# A region whose execution count differs between two Coverage objects.
+RegionDifference = namedtuple("RegionDifference", ["file", "lineStart", "columnStart", "lineEnd", "columnEnd", "countA", "countB"])
+
+# Return a list of RegionDifference for the regions of (file, function) whose
+# execution counts differ between coverageA and coverageB, in source order. A
+# region that only one of them has, such as when the other never called the
+# function, has a count of 0 in the other.
+def regionDifferences(coverageA, coverageB, file, function):
+    countsA = dict((region[:5], region.count) for region in coverageA.regions(file, function))
+    countsB = dict((region[:5], region.count) for region in coverageB.regions(file, function))
     differences = []
-    for fileAndFunction, (aCount, bCount) in differenceMap.items():
-        callCountDifference = abs(aCount - bCount)
-        if callCountDifference > 0:
-            differenceString = fileAndFunction + " call count difference: " + str(aCount) + " != " + str(bCount)
-            differences.append((callCountDifference, differenceString))
+    for sourceRange in sorted(set(countsA) | set(countsB)):
+        countA = countsA.get(sourceRange, 0)
+        countB = countsB.get(sourceRange, 0)
+        if countA != countB:
+            differences.append(RegionDifference(*(sourceRange + (countA, countB))))
+    return differences
+
+def _formatRegionDifference(difference):
+    return ("    " + difference.file + ":" + str(difference.lineStart) + ":" + str(difference.columnStart) + "-" + str(difference.lineEnd) + ":" + str(difference.columnEnd)
+            + " region count difference: " + str(difference.countA) + " != " + str(difference.countB))
+
+# Return the top differences, largest |call count difference| first. Ties are
+# kept in id order. If top is None, all differences are returned.
+def largestDifferences(differences, top = None):
+    rank = lambda difference: (-difference.delta, difference.id)
+    if top is None:
+        return sorted(differences, key=rank)
+    return heapq.nsmallest(top, differences, key=rank)
+
+# Yield (file, function, call count) for the functions with the same call count
+# in coverageA and coverageB but different region execution counts, such as a
+# function where a different branch was taken. If functionFilter is given, it is
+# checked before the regions of a function are compared.
+def _iterRegionOnlyDifferences(coverageA, coverageB, functionFilter = None):
+    for file, function, count in coverageA.callCounts():
+        if functionFilter is not None and not functionFilter(file, function):
+            continue
+        if coverageB.callCount(file, function) == count and regionDifferences(coverageA, coverageB, file, function):
+            yield file, function, count
+
+# Return a list of at most limit _iterRegionOnlyDifferences.
+def _regionOnlyDifferences(coverageA, coverageB, limit = None):
+    return list(islice(_iterRegionOnlyDifferences(coverageA, coverageB), limit))
+
+# Return a list of human-readable function call count differences, sorted by |call count difference|.
+# If top is given, only the top largest differences are returned. Only the
+# returned differences are formatted. If the coverages have regions, each
+# function is followed by its differing regions, and functions with the same
+# call count but differing regions are listed before all call count
+# differences.
+def compare(coverageA, coverageB, top = None):
+    with stages.stage("compare") as stage:
+        differences, functionForId = callCountDifferences(coverageA, coverageB)
+        ranked = largestDifferences(differences, top)
+        differenceStrings = []
+        hasRegions = coverageA.hasRegions() or coverageB.hasRegions()
+        if hasRegions and (top is None or len(ranked) < top):
+            for file, function, count in _regionOnlyDifferences(coverageA, coverageB, None if top is None else top - len(ranked)):
+                differenceStrings.append(_fileAndFunction(file, function) + " region count difference with the same call count: " + str(count))
+                differenceStrings.extend(_formatRegionDifference(regionDifference) for regionDifference in regionDifferences(coverageA, coverageB, file, function))
+
+        # Print the largest differences last.
+        for difference in reversed(ranked):
+            file, function = functionForId(difference.id)
+            differenceStrings.append(_fileAndFunction(file, function) + " call count difference: " + str(difference.countA) + " != " + str(difference.countB))
+            if hasRegions:
+                differenceStrings.extend(_formatRegionDifference(regionDifference) for regionDifference in regionDifferences(coverageA, coverageB, file, function))
+        stage.items = len(differences)
+        return differenceStrings
+
+# Yield (file, function, countA, countB) for the functions whose call counts
+# differ, largest |call count difference| first, then for the functions with the
+# same call count but differing regions. Differences are ranked lazily with a
+# heap, so the largest ones are known without sorting all of them. If
+# functionFilter is given, only functions for which functionFilter(file,
+# function) is True are yielded.
+def iterDifferences(coverageA, coverageB, functionFilter = None):
+    differences, functionForId = callCountDifferences(coverageA, coverageB)
+    heap = [(-difference.delta, difference.id, difference.countA, difference.countB) for difference in differences]
+    del differences
+    heapq.heapify(heap)
+    while heap:
+        negativeDelta, id, countA, countB = heapq.heappop(heap)
+        file, function = functionForId(id)
+        if functionFilter is None or functionFilter(file, function):
+            yield file, function, countA, countB
+
+    if coverageA.hasRegions() or coverageB.hasRegions():
+        for file, function, count in _iterRegionOnlyDifferences(coverageA, coverageB, functionFilter):
+            yield file, function, count, count
+
+# Yield the differences of iterDifferences as human-readable lines, largest
+# first, formatted like compare. Only the top differences are yielded if top is
+# given. Function names are demangled as they are shown, with
+# demangle(functions) returning a map from mangled to demangled names. Unlike
+# demangleCoverages, functions that demangle to the same name, such as
+# constructor variants, are not merged: that would need every name demangled.
+# Functions are demangled in batches that start with one function and double up
+# to maxBatchSize, so the first lines are ready without waiting for the rest.
+def streamCompare(coverageA, coverageB, top = None, functionFilter = None, demangle = None, maxBatchSize = 1024):
+    hasRegions = coverageA.hasRegions() or coverageB.hasRegions()
+    differences = islice(iterDifferences(coverageA, coverageB, functionFilter), top)
+    batchSize = 1
+    while True:
+        batch = list(islice(differences, batchSize))
+        if not batch:
+            return
+        demangledFunctionMap = demangle(list(set(function for file, function, countA, countB in batch))) if demangle else {}
+        for file, function, countA, countB in batch:
+            name = _fileAndFunction(file, demangledFunctionMap.get(function, function))
+            if countA != countB:
+                yield name + " call count difference: " + str(countA) + " != " + str(countB)
+            else:
+                yield name + " region count difference with the same call count: " + str(countA)
+            if hasRegions:
+                for regionDifference in regionDifferences(coverageA, coverageB, file, function):
+                    yield _formatRegionDifference(regionDifference)
+        batchSize = min(batchSize * 2, maxBatchSize)
+
+# Return a functionFilter(file, function) for iterDifferences that is True if
+# the regular expression pattern is found in the file or function name. Names
+# are matched as they are in the profile, before demangling: identifiers such
+# as class and function names appear unchanged in mangled names, but qualified
+# names such as "blink::LayoutObject" do not.
+def functionFilter(pattern):
+    search = re.compile(pattern).search
+    return lambda file, function: bool(search(file) or search(function))
+
+# Load several raw coverage files concurrently and return their Coverage
+# objects in the same order. Most of the time loading a profile is spent
+# waiting on subprocesses and I/O, which threads can overlap. See
+# Coverage.fromRawLlvmProfile for useSnapshots and executable.
+def loadCoverages(paths, useSnapshots = True, executable = None):
+    pool = ThreadPool(len(paths))
+    try:
+        return pool.map(lambda path: Coverage.fromRawLlvmProfile(path, useSnapshots = useSnapshots, executable = executable), paths)
+    finally:
+        pool.close()
+
+# Call demangle(demangler) with the given demangler and return its result. If
+# no demangler is given, try c++filt and then in-process demangling, but fail
+# silently and return None.
+def _demangleWithFallback(demangle, demangler):
+    if demangler:
+        return demangle(demangler)
+
+    # MacOS's c++filt version is older and strips underscores by default,
+    # which is different from the latest GNU C++filt. Work around this
+    # difference by forcing underscores to not be stripped using -n.
+    try:
+        return demangle("c++filt -n")
+    except:
+        # Without c++filt, demangle in-process if possible.
+        if inProcessDemanglingAvailable():
+            return demangle(IN_PROCESS_DEMANGLER)
+    return None
+
+# Demangle Coverage objects together with the given demangler. See
+# _demangleWithFallback.
+def demangleCoverages(coverages, demangler = None, cache = None, processes = None):
+    _demangleWithFallback(lambda demangler: Coverage.demangleCoverages(coverages, demangler, cache, processes), demangler)
+
+# Return a map from mangled to demangled names for a list of distinct function
+# names. Names that could not be demangled map to themselves. See
+# _demangleWithFallback.
+def demangleFunctionNames(functions, demangler = None, cache = None, processes = None):
+    demangledFunctionMap = _demangleWithFallback(lambda demangler: demangleNames(functions, demangler, cache, processes), demangler)
+    return demangledFunctionMap or dict(zip(functions, functions))
 
-    sortedDifferences = sorted(differences, key=lambda tup: tup[0])
-    return [ difference[1] for difference in sortedDifferences ]
+# Statistics for a function whose call count differs from the baseline in at
+# least one run. meanDelta is the mean of (run count - baseline count) over all
+# runs. consistency is |runs with more calls - runs with fewer calls| / runs,
+# which is 1 when every run differs from the baseline in the same direction.
+FunctionStatistics = namedtuple("FunctionStatistics", ["file", "function", "baselineCount", "differingRuns", "meanDelta", "consistency"])
+
+# The baseline Coverage object in batch worker processes. See compareBatch.
+_batchBaseline = None
+_batchUseSnapshots = True
+
+def _initBatchWorker(baseline, useSnapshots):
+    global _batchBaseline, _batchUseSnapshots
+    _batchBaseline = baseline
+    _batchUseSnapshots = useSnapshots
+
+# Return (file, function, baseline count, run count) for each function whose
+# call count differs between the baseline and the raw coverage file at path.
+def _baselineDifferences(path):
+    run = Coverage.fromRawLlvmProfile(path, useSnapshots = _batchUseSnapshots)
+    differences, functionForId = callCountDifferences(_batchBaseline, run)
+    return [functionForId(difference.id) + (difference.countA, difference.countB) for difference in differences]
+
+# Aggregate the per-run lists of (file, function, baseline count, run count)
+# from _baselineDifferences into a list of FunctionStatistics. The list is
+# ranked with the most consistently differing functions first.
+def aggregateDifferences(runDifferences):
+    runCount = len(runDifferences)
+    # Map from (file, function) to [baseline count, differing runs, sum of
+    # deltas, sum of delta signs].
+    totals = {}
+    for differences in runDifferences:
+        for file, function, baselineCount, count in differences:
+            delta = count - baselineCount
+            total = totals.setdefault((file, function), [baselineCount, 0, 0, 0])
+            total[1] += 1
+            total[2] += delta
+            total[3] += 1 if delta > 0 else -1
+
+    statistics = [FunctionStatistics(file, function, baselineCount, differingRuns, float(deltaSum) / runCount, abs(signSum) / float(runCount))
+                  for (file, function), (baselineCount, differingRuns, deltaSum, signSum) in totals.iteritems()]
+    statistics.sort(key=lambda s: (-s.consistency, -s.differingRuns, -abs(s.meanDelta), s.file, s.function))
+    return statistics
+
+# Compare a baseline Coverage object against many raw coverage files using
+# worker processes. The baseline is sent to each worker once. Return the ranked
+# list of FunctionStatistics from aggregateDifferences.
+def compareBatch(baseline, runPaths, processes = None, useSnapshots = True):
+    with stages.stage("compare batch", len(runPaths)):
+        pool = multiprocessing.Pool(processes, _initBatchWorker, (baseline, useSnapshots))
+        try:
+            runDifferences = pool.map(_baselineDifferences, runPaths)
+        finally:
+            pool.close()
+            pool.join()
+        return aggregateDifferences(runDifferences)
+
+def _formatStatistics(statistics, runCount, demangledFunctionMap):
+    function = demangledFunctionMap.get(statistics.function, statistics.function)
+    return (_fileAndFunction(statistics.file, function) + " differs in " + str(statistics.differingRuns) + " of " + str(runCount) + " runs"
+            + " (consistency %.2f), mean call count difference %+.1f from %d" % (statistics.consistency, statistics.meanDelta, statistics.baselineCount))
+
+# Expand directories into the raw coverage files (*.profraw) and coverage
+# snapshots (*.snapshot, see record.py) they contain and glob patterns into the
+# files they match. If exclude is given, paths to the same file, such as a
+# baseline in a directory of runs, are left out.
+def _expandRunPaths(paths, exclude = None):
+    runPaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            runPaths.extend(sorted(glob.glob(os.path.join(path, "*.profraw")) + glob.glob(os.path.join(path, "*.snapshot"))))
+        elif glob.has_magic(path):
+            runPaths.extend(sorted(glob.glob(path)))
+        else:
+            runPaths.append(path)
+    if exclude:
+        excludedPath = os.path.realpath(exclude)
+        runPaths = [path for path in runPaths if os.path.realpath(path) != excludedPath]
+    return runPaths
+
+# Build a spectrum.Spectrum from passing and failing raw coverage files. Up to
+# threads files are loaded at a time, defaulting to one per CPU, and each run is
+# added to the spectrum as it is loaded so the runs are not all kept in memory.
+def spectrumFromRawProfiles(passingPaths, failingPaths, useSnapshots = True, threads = None):
+    spectrum = Spectrum()
+    paths = passingPaths + failingPaths
+    failed = [False] * len(passingPaths) + [True] * len(failingPaths)
+    with stages.stage("build spectrum", len(paths)):
+        pool = ThreadPool(threads or multiprocessing.cpu_count())
+        try:
+            loaded = pool.imap(lambda path: Coverage.fromRawLlvmProfile(path, useSnapshots = useSnapshots), paths)
+            for coverage, runFailed in izip(loaded, failed):
+                spectrum.addRun(coverage, runFailed)
+        finally:
+            pool.close()
+    return spectrum
+
+def _formatSuspiciousness(suspiciousness, metric, spectrum, demangledFunctionMap):
+    function = demangledFunctionMap.get(suspiciousness.function, suspiciousness.function)
+    return (_fileAndFunction(suspiciousness.file, function) + " suspiciousness %.3f (%s)" % (suspiciousness.score, metric)
+            + ", called in " + str(suspiciousness.failingRuns) + " of " + str(spectrum.failingRuns) + " failing and "
+            + str(suspiciousness.passingRuns) + " of " + str(spectrum.passingRuns) + " passing runs")
+
+# An argparse type for counts such as --top.
+def _nonNegativeInt(string):
+    try:
+        value = int(string)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise argparse.ArgumentTypeError("expected a number of at least 0: " + repr(string))
+    return value
 
 def main():
     parser = argparse.ArgumentParser(description="Compare code coverage")
-    parser.add_argument("coverageA", help="Raw coverage file for run A")
-    parser.add_argument("coverageB", help="Raw coverage file for run B")
-    parser.add_argument("-d", "--demangler", help="Demangler")
+    parser.add_argument("coverage", nargs="*", help="Raw coverage files for runs A and B, or with --baseline, the runs (files, directories or globs) to compare against the baseline")
+    parser.add_argument("--baseline", help="Raw coverage file for a known-good run to compare many runs against")
+    parser.add_argument("--passing", nargs="+", default=[], help="Raw coverage files (files, directories or globs) of passing runs, for ranking functions by suspiciousness", metavar="PATH")
+    parser.add_argument("--failing", nargs="+", default=[], help="Raw coverage files (files, directories or globs) of failing runs, for ranking functions by suspiciousness", metavar="PATH")
+    parser.add_argument("--metric", choices=sorted(METRICS), default="ochiai", help="Suspiciousness metric for --passing and --failing (default: ochiai)")
+    parser.add_argument("-j", "--processes", type=int, help="Number of runs to load in parallel for --baseline, --passing and --failing (default: one per CPU)", metavar="N")
+    parser.add_argument("-d", "--demangler", help="Demangler command, or " + IN_PROCESS_DEMANGLER + " to demangle in-process")
+    parser.add_argument("--demangle-processes", type=int, help="Number of demangler processes to run in parallel (default: one per CPU)", metavar="N")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the on-disk demangling and profile snapshot caches")
+    parser.add_argument("--top", type=_nonNegativeInt, help="Only print the N largest differences", metavar="N")
+    parser.add_argument("--executable", help="Executable the two raw coverage files (not snapshots) were recorded from, for showing the differing regions of each function")
+    parser.add_argument("--stream", action="store_true", help="Print the largest differences first, as soon as they are known, only demangling the functions that are printed. Functions that demangle to the same name, such as constructor variants, are not merged")
+    parser.add_argument("--filter", help="Only show functions whose file or function name, before demangling, contains a match for the regular expression PATTERN", metavar="PATTERN")
+    stages.addArguments(parser)
     args = parser.parse_args()
 
-    coverageA = Coverage.fromRawLlvmProfile(args.coverageA)
-    coverageB = Coverage.fromRawLlvmProfile(args.coverageB)
-
-    if args.demangler:
-        coverageA.demangle(args.demangler)
-        coverageB.demangle(args.demangler)
-    else:
-        # Try demangling using c++filt but fail silently.
-        # MacOS's c++filt version is older and strips underscores by default,
-        # which is different from the latest GNU C++filt. Work around this
-        # difference by forcing underscores to not be stripped using -n.
-        try:
-            coverageA.demangle("c++filt -n")
-            coverageB.demangle("c++filt -n")
-        except:
-            pass
+    if args.profile_stages:
+        stages.enable()
+    try:
+        _run(parser, args)
+    finally:
+        if args.profile_stages:
+            stages.writeReport(args.profile_stages_format, args.profile_stages_output)
+
+def _run(parser, args):
+    cache = None if args.no_cache else DemangleCache()
+    try:
+        matches = functionFilter(args.filter) if args.filter else None
+    except re.error as error:
+        parser.error("invalid --filter pattern: " + str(error))
+
+    # Regions are only read when comparing two raw coverage files.
+    if args.executable and (args.baseline or args.passing or args.failing):
+        parser.error("--executable cannot be combined with --baseline, --passing or --failing")
+
+    if args.passing or args.failing:
+        if args.coverage or args.baseline:
+            parser.error("--passing and --failing cannot be combined with other coverage files")
+        failingPaths = _expandRunPaths(args.failing)
+        if not failingPaths:
+            parser.error("no failing raw coverage files to rank functions with")
+        spectrum = spectrumFromRawProfiles(_expandRunPaths(args.passing), failingPaths, not args.no_cache, args.processes)
+        ranked = spectrum.rank(args.metric, None if matches else args.top)
+        if matches:
+            ranked = [s for s in ranked if matches(s.file, s.function)][:args.top]
+        # Only the printed functions need to be demangled.
+        demangledFunctionMap = demangleFunctionNames(list(set(s.function for s in ranked)), args.demangler, cache, args.demangle_processes)
+        # Print the most suspicious functions last.
+        for suspiciousness in reversed(ranked):
+            print _formatSuspiciousness(suspiciousness, args.metric, spectrum, demangledFunctionMap)
+        return
+
+    if args.baseline:
+        runPaths = _expandRunPaths(args.coverage, args.baseline)
+        if not runPaths:
+            parser.error("no raw coverage files to compare against the baseline")
+        baseline = Coverage.fromRawLlvmProfile(args.baseline, useSnapshots = not args.no_cache)
+        statistics = compareBatch(baseline, runPaths, args.processes, not args.no_cache)
+        if matches:
+            statistics = [s for s in statistics if matches(s.file, s.function)]
+        if args.top is not None:
+            statistics = statistics[:args.top]
+        # Only the printed functions need to be demangled.
+        demangledFunctionMap = demangleFunctionNames(list(set(s.function for s in statistics)), args.demangler, cache, args.demangle_processes)
+        # Print the most consistent differences last.
+        for functionStatistics in reversed(statistics):
+            print _formatStatistics(functionStatistics, len(runPaths), demangledFunctionMap)
+        return
+
+    if len(args.coverage) != 2:
+        parser.error("expected two raw coverage files (coverageA coverageB) or --baseline")
+    if args.executable:
+        for path in args.coverage:
+            if Coverage.isSnapshot(path):
+                parser.error("--executable cannot be used with the snapshot \"" + path + "\"; use raw coverage files")
+    coverageA, coverageB = loadCoverages(args.coverage, not args.no_cache, args.executable)
+
+    if args.stream:
+        demangle = lambda functions: demangleFunctionNames(functions, args.demangler, cache, args.demangle_processes)
+        for difference in streamCompare(coverageA, coverageB, args.top, matches, demangle):
+            print difference
+            sys.stdout.flush()
+        return
+
+    # Filter before demangling so only the remaining functions are demangled.
+    if matches:
+        coverageA = coverageA.filtered(matches)
+        coverageB = coverageB.filtered(matches)
+
+    # Both coverages mostly contain the same functions, so they are demangled
+    # together and share one cache.
+    demangleCoverages([coverageA, coverageB], args.demangler, cache, args.demangle_processes)
 
-    differences = compare(coverageA, coverageB)
+    differences = compare(coverageA, coverageB, args.top)
     for difference in differences:
         print difference
 
@@ -0,0 +1,208 @@
+# binary.py - checking executables for coverage instrumentation
+#
+# Executables built with -fprofile-instr-generate have sections for the
+# profile counters and data (__llvm_prf_cnts and __llvm_prf_data). Rather than
+# reading a whole executable, which can be gigabytes for a debug build, only
+# the ELF or Mach-O headers and section headers are read from a memory-mapped
+# file. Other formats fall back to scanning the file for the profile runtime.
+#
+# Results are cached by path, size and modification time, in memory and in the
+# cache directory, so repeated recordings of the same executable skip the check.
+# Like the other caches, the cache is bounded: executables that no longer exist
+# and the least recently checked ones are forgotten.
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from cache import cacheDirectory
+
+PROFILE_SECTIONS = frozenset(["__llvm_prf_cnts", "__llvm_prf_data"])
+
+_ELF_MAGIC = "\x7fELF"
+_ELF_CLASS_64 = 2
+_ELF_DATA_BIG_ENDIAN = 2
+_ELF_SHN_XINDEX = 0xffff
+
+_MACHO_MAGIC_32 = 0xfeedface
+_MACHO_MAGIC_64 = 0xfeedfacf
+_MACHO_FAT_MAGIC = 0xcafebabe
+_MACHO_LC_SEGMENT = 0x1
+_MACHO_LC_SEGMENT_64 = 0x19
+
+# Map from absolute path to ((size, modification time), instrumented, time last
+# checked), loaded from _instrumentedCachePathLoaded.
+_instrumentedCache = None
+_instrumentedCachePathLoaded = None
+_INSTRUMENTED_CACHE_MAX_ENTRIES = 1000
+_instrumentedCacheLock = threading.Lock()
+
+def _unpackFrom(format, data, offset):
+    size = struct.calcsize(format)
+    if offset + size > len(data):
+        raise ValueError("Truncated header.")
+    return struct.unpack(format, data[offset:offset + size])
+
+def _cString(data):
+    end = data.find("\0")
+    return data if end < 0 else data[:end]
+
+# Return the section names of an ELF file.
+def _elfSectionNames(data):
+    is64 = ord(data[4]) == _ELF_CLASS_64
+    endian = ">" if ord(data[5]) == _ELF_DATA_BIG_ENDIAN else "<"
+    if is64:
+        (sectionHeaderOffset,) = _unpackFrom(endian + "Q", data, 0x28)
+        sectionHeaderSize, sectionCount, namesIndex = _unpackFrom(endian + "HHH", data, 0x3a)
+        # Name, type, flags, address, offset, size and link.
+        sectionHeader = endian + "IIQQQQI"
+    else:
+        (sectionHeaderOffset,) = _unpackFrom(endian + "I", data, 0x20)
+        sectionHeaderSize, sectionCount, namesIndex = _unpackFrom(endian + "HHH", data, 0x2e)
+        sectionHeader = endian + "IIIIIII"
+    if sectionHeaderOffset == 0:
+        return set()
+
+    # With many sections, the real count and names index are in the first
+    # section header's size and link fields.
+    first = _unpackFrom(sectionHeader, data, sectionHeaderOffset)
+    if sectionCount == 0:
+        sectionCount = first[5]
+    if namesIndex == _ELF_SHN_XINDEX:
+        namesIndex = first[6]
+
+    sections = [_unpackFrom(sectionHeader, data, sectionHeaderOffset + index * sectionHeaderSize) for index in xrange(sectionCount)]
+    names = sections[namesIndex]
+    namesOffset, namesSize = names[4], names[5]
+    # Only the start of each name is needed to compare with PROFILE_SECTIONS.
+    return set(_cString(data[namesOffset + section[0]:min(namesOffset + namesSize, namesOffset + section[0] + 64)]) for section in sections)
+
+# Return the section names of a Mach-O file, or of every architecture of a
+# universal (fat) file.
+def _machOSectionNames(data, offset = 0):
+    (magic,) = _unpackFrom(">I", data, offset)
+    if magic == _MACHO_FAT_MAGIC:
+        (architectureCount,) = _unpackFrom(">I", data, offset + 4)
+        names = set()
+        for index in xrange(architectureCount):
+            # CPU type, CPU subtype, offset, size and alignment.
+            architectureOffset = _unpackFrom(">IIIII", data, offset + 8 + index * 20)[2]
+            names |= _machOSectionNames(data, architectureOffset)
+        return names
+
+    (magic,) = _unpackFrom("<I", data, offset)
+    is64 = magic == _MACHO_MAGIC_64
+    commandCount, commandsSize = _unpackFrom("<II", data, offset + 16)
+    position = offset + (32 if is64 else 28)
+    names = set()
+    for index in xrange(commandCount):
+        command, commandSize = _unpackFrom("<II", data, position)
+        if command == _MACHO_LC_SEGMENT_64 or command == _MACHO_LC_SEGMENT:
+            sectionCountOffset, firstSection, sectionSize = (64, 72, 80) if command == _MACHO_LC_SEGMENT_64 else (48, 56, 68)
+            (sectionCount,) = _unpackFrom("<I", data, position + sectionCountOffset)
+            for section in xrange(sectionCount):
+                sectionOffset = position + firstSection + section * sectionSize
+                names.add(_cString(data[sectionOffset:sectionOffset + 16]))
+        if commandSize == 0:
+            break
+        position += commandSize
+    return names
+
+# Return the set of section names of an ELF or Mach-O file in data, or None if
+# data is in another format.
+def sectionNames(data):
+    if data[:4] == _ELF_MAGIC:
+        return _elfSectionNames(data)
+    if len(data) >= 4 and (struct.unpack("<I", data[:4])[0] in (_MACHO_MAGIC_32, _MACHO_MAGIC_64) or struct.unpack(">I", data[:4])[0] == _MACHO_FAT_MAGIC):
+        return _machOSectionNames(data)
+    return None
+
+# Return True if data contains at least minimum instances of the profile
+# runtime's symbols. A simple hello world has 34.
+def _hasProfileRuntime(data, minimum = 10):
+    count = 0
+    position = data.find("__llvm_profile")
+    while position >= 0 and count < minimum:
+        count += 1
+        position = data.find("__llvm_profile", position + 1)
+    return count >= minimum
+
+def _readInstrumented(path):
+    with open(path, "rb") as inFile:
+        if os.fstat(inFile.fileno()).st_size == 0:
+            return False
+        data = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        try:
+            names = sectionNames(data)
+        except (ValueError, IndexError):
+            # Malformed headers; scan the file instead.
+            names = None
+        if names is not None:
+            return PROFILE_SECTIONS <= names
+        return _hasProfileRuntime(data)
+    finally:
+        data.close()
+
+def _instrumentedCachePath():
+    return os.path.join(cacheDirectory(), "instrumented.json")
+
+# Load the cache once, and again if the cache directory changes, such as when
+# CCDB_CACHE_DIR is set.
+def _loadInstrumentedCache():
+    global _instrumentedCache, _instrumentedCachePathLoaded
+    path = _instrumentedCachePath()
+    if _instrumentedCache is None or path != _instrumentedCachePathLoaded:
+        try:
+            with open(path, "r") as inFile:
+                _instrumentedCache = json.load(inFile)
+        except (IOError, ValueError):
+            _instrumentedCache = {}
+        _instrumentedCachePathLoaded = path
+    return _instrumentedCache
+
+def _saveInstrumentedCache():
+    for key in [key for key in _instrumentedCache if not os.path.exists(key)]:
+        del _instrumentedCache[key]
+    excess = len(_instrumentedCache) - _INSTRUMENTED_CACHE_MAX_ENTRIES
+    if excess > 0:
+        # Entries from before the time last checked was kept are the oldest.
+        lastChecked = lambda key: _instrumentedCache[key][2] if len(_instrumentedCache[key]) > 2 else 0
+        for key in sorted(_instrumentedCache, key=lastChecked)[:excess]:
+            del _instrumentedCache[key]
+
+    # Write under a temporary name first so concurrent recordings never see a
+    # partial file.
+    path = _instrumentedCachePathLoaded
+    temporaryPath = path + "." + str(os.getpid()) + "." + str(threading.current_thread().ident)
+    try:
+        with open(temporaryPath, "w") as outFile:
+            json.dump(_instrumentedCache, outFile)
+        os.rename(temporaryPath, path)
+    except (IOError, OSError):
+        # The cache is only an optimization.
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+
+# Return True if the executable at path was built with coverage
+# instrumentation. See the comment at the top of this file.
+def isInstrumented(path):
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    version = [stat.st_size, stat.st_mtime]
+    with _instrumentedCacheLock:
+        cached = _loadInstrumentedCache().get(key)
+        if cached and cached[0] == version:
+            # Only kept in memory until the cache is next saved, so hits do
+            # not rewrite the file.
+            cached[2:] = [time.time()]
+            return cached[1]
+
+    instrumented = _readInstrumented(path)
+    with _instrumentedCacheLock:
+        _instrumentedCache[key] = [version, instrumented, time.time()]
+        _saveInstrumentedCache()
+    return instrumented
@@ -0,0 +1,153 @@
+# cache.py - on-disk caches shared across runs
+#
+# Results that are expensive to compute and are the same from run to run, such
+# as demangled function names and parsed profiles, are kept under a per-user
+# cache directory. The directory can be changed with the CCDB_CACHE_DIR
+# environment variable. Each cache is bounded and evicts its least recently used
+# entries.
+
+import hashlib
+import os
+import sqlite3
+
+# Create directory if it does not exist. Several threads or processes may
+# create it at once.
+def _makeDirectory(directory):
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+# Return the directory for on-disk caches, creating it if needed.
+def cacheDirectory():
+    directory = os.environ.get("CCDB_CACHE_DIR")
+    if not directory:
+        xdgCacheHome = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        directory = os.path.join(xdgCacheHome, "ccdb")
+    if not os.path.isdir(directory):
+        _makeDirectory(directory)
+    return directory
+
+def _snapshotDirectory():
+    directory = os.path.join(cacheDirectory(), "snapshots")
+    if not os.path.isdir(directory):
+        _makeDirectory(directory)
+    return directory
+
+# Return the path of the cached snapshot for a raw profile. Snapshots are
+# keyed by the absolute path of the profile, and of the executable whose
+# coverage mapping was used to read regions, if any; see
+# Coverage.fromRawLlvmProfile.
+def snapshotPath(rawProfilePath, executable = None):
+    key = os.path.abspath(rawProfilePath)
+    if executable:
+        key += "\0" + os.path.abspath(executable)
+    key = hashlib.sha1(key).hexdigest()
+    return os.path.join(_snapshotDirectory(), key + ".snapshot")
+
+# Mark a cached snapshot as used, for pruneSnapshots. Access times are often
+# not kept up to date, so the modification time is used instead.
+def touchSnapshot(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+# Bound the snapshot cache like DemangleCache: remove the least recently used
+# snapshots while there are more than maxEntries or they take more than
+# maxBytes. Other runs may be pruning at the same time, so snapshots that are
+# already gone are skipped.
+def pruneSnapshots(maxEntries = 256, maxBytes = 4 << 30):
+    directory = _snapshotDirectory()
+    snapshots = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(".snapshot"):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        snapshots.append((stat.st_mtime, stat.st_size, path))
+    snapshots.sort(reverse=True)
+    entries = 0
+    size = 0
+    for mtime, snapshotSize, path in snapshots:
+        entries += 1
+        size += snapshotSize
+        if entries > maxEntries or size > maxBytes:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+# Return the SHA-1 digest of a file's contents.
+def fileDigest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as inFile:
+        for block in iter(lambda: inFile.read(1 << 20), ""):
+            digest.update(block)
+    return digest.digest()
+
+# A size-bounded map from mangled to demangled function names stored in SQLite.
+# Names are keyed by the demangler command too, because different demanglers
+# (or flags, such as c++filt -n) can produce different output. When the cache
+# grows beyond maxEntries, the least recently used names are evicted.
+class DemangleCache(object):
+
+    # SQLite limits the number of parameters in a single statement.
+    _LOOKUP_BATCH_SIZE = 500
+
+    def __init__(self, path = None, maxEntries = 1000000):
+        if path is None:
+            path = os.path.join(cacheDirectory(), "demangle.sqlite")
+        self._maxEntries = maxEntries
+        self._connection = sqlite3.connect(path)
+        self._connection.text_factory = str
+        # Marking hundreds of thousands of names as used rewrites the lastUsed
+        # index, which thrashes SQLite's default 2MB page cache.
+        self._connection.execute("PRAGMA cache_size = -65536")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS demangled (demangler TEXT, mangled TEXT, demangled TEXT, lastUsed INTEGER, PRIMARY KEY (demangler, mangled))")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS demangledLastUsed ON demangled (lastUsed)")
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    # Return a map from mangled to demangled names for the names in
+    # mangledNames that are in the cache.
+    def lookup(self, demangler, mangledNames):
+        demangledNames = {}
+        use = None
+        for start in xrange(0, len(mangledNames), DemangleCache._LOOKUP_BATCH_SIZE):
+            batch = mangledNames[start:start + DemangleCache._LOOKUP_BATCH_SIZE]
+            names = "(" + ",".join("?" * len(batch)) + ")"
+            found = self._connection.execute("SELECT mangled, demangled FROM demangled WHERE demangler = ? AND mangled IN " + names, [demangler] + batch).fetchall()
+            if found:
+                # Mark the names as used with one statement per batch.
+                if use is None:
+                    use = self._nextUse()
+                self._connection.execute("UPDATE demangled SET lastUsed = ? WHERE demangler = ? AND mangled IN " + names, [use, demangler] + batch)
+                demangledNames.update(found)
+        if use is not None:
+            self._connection.commit()
+        return demangledNames
+
+    # Add a map from mangled to demangled names to the cache.
+    def store(self, demangler, demangledNames):
+        use = self._nextUse()
+        self._connection.executemany("INSERT OR REPLACE INTO demangled VALUES (?, ?, ?, ?)", ((demangler, mangled, demangled, use) for mangled, demangled in demangledNames.iteritems()))
+        self._evict()
+        self._connection.commit()
+
+    # Return a number larger than any lastUsed in the cache.
+    def _nextUse(self):
+        (lastUse,) = self._connection.execute("SELECT MAX(lastUsed) FROM demangled").fetchone()
+        return (lastUse or 0) + 1
+
+    # Remove the least recently used names if there are more than maxEntries.
+    def _evict(self):
+        (entries,) = self._connection.execute("SELECT COUNT(*) FROM demangled").fetchone()
+        if entries > self._maxEntries:
+            self._connection.execute("DELETE FROM demangled WHERE rowid IN (SELECT rowid FROM demangled ORDER BY lastUsed, rowid LIMIT ?)", (entries - self._maxEntries,))
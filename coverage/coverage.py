@@ -2,111 +2,858 @@
 #
 # A Coverage object has a map of functions and their call counts. This class
 # also has supporting functions for parsing raw LLVM code coverage profiles.
+#
+# Large programs have hundreds of thousands of functions with long names, so
+# call counts are stored in columns: file and function names are interned into
+# string tables and each (file, function) row is a pair of integer ids plus a
+# count in a compact array.
+#
+# Coverage objects can also have regions: source ranges of a function and their
+# execution counts, from the coverage mapping of an executable (see
+# fromLlvmCovExport). Programs can have tens of millions of regions, so regions
+# are stored in columns too. The regions of each row are contiguous and each
+# row has the index of its first region and its number of regions.
+#
+# Coverage objects can be saved to and loaded from snapshots, a binary format
+# that stores the string tables and columns directly:
+#   header (see _SNAPSHOT_HEADER)
+#   file names, separated by \0
+#   function names, separated by \0
+#   file id column (uint32)
+#   function id column (uint32)
+#   call count column (uint64)
+#   first region column (uint32)
+#   region length column (uint32)
+#   region file id column (uint32)
+#   region range column (uint32 line start, column start, line end, column end)
+#   region execution count column (uint64)
+# Every section starts at a multiple of 8 bytes and all values are little
+# endian, so the columns can be used directly from a memory-mapped snapshot.
 
-from collections import defaultdict
+from array import array
+from collections import namedtuple
+import copy
+from cStringIO import StringIO
+from itertools import izip
 import json
+import mmap
+import os
 import re
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+
+from cache import fileDigest, pruneSnapshots, snapshotPath, touchSnapshot
+from demangle import demangleNames
+import profraw
+import stages
+
+_SNAPSHOT_MAGIC = "CCDBSNAP"
+_SNAPSHOT_VERSION = 2
+
+# Magic, version, the size, modification time and SHA-1 digest of the raw
+# profile the snapshot was made from (if any), the number of files, functions,
+# rows and regions, and the byte sizes of the file and function name sections.
+_SNAPSHOT_HEADER = struct.Struct("<8sQQd20s4xQQQQQQ")
+
+# llvm-cov export region kinds. Only code regions have execution counts of
+# their own; see llvm::coverage::CounterMappingRegion::RegionKind.
+_CODE_REGION_KIND = 0
+
+# A source range of a function and the number of times it was executed.
+Region = namedtuple("Region", ["file", "lineStart", "columnStart", "lineEnd", "columnEnd", "count"])
+
+def _paddingBytes(size):
+    return (8 - size % 8) % 8
+
+def _writePadded(outFile, data):
+    outFile.write(data)
+    outFile.write("\0" * _paddingBytes(len(data)))
+
+# Return the little endian bytes of an array.
+def _littleEndianBytes(column):
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tostring()
+
+# Return an array of typecode from little endian bytes.
+def _arrayFromLittleEndianBytes(typecode, data):
+    column = array(typecode)
+    column.fromstring(data)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+# The llvm-profdata commands that are known to work. Each command is only
+# checked once per process, even when profiles are loaded concurrently.
+_checkedLlvmProfdatas = set()
+_checkedLlvmProfdatasLock = threading.Lock()
+
+# Ensure llvm-profdata is available.
+def _checkLlvmProfdata(llvmProfdata):
+    with _checkedLlvmProfdatasLock:
+        if llvmProfdata in _checkedLlvmProfdatas:
+            return
+        command = [ llvmProfdata, "show", "--help" ]
+        proc = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, err = proc.communicate()
+        if err != "":
+            raise AssertionError(err)
+        _checkedLlvmProfdatas.add(llvmProfdata)
+
+# Read a JSON document from a file object one value at a time, so large arrays,
+# such as the functions of an llvm-cov export, can be walked without holding
+# the whole document in memory. Arrays and objects are walked with elements()
+# and keys(), which leave the reader at each element or value for the caller to
+# read with value(), skip() or another elements() or keys().
+class _JsonReader(object):
+    _CHUNK_SIZE = 1 << 16
+    _WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, inFile):
+        self._file = inFile
+        self._buffer = ""
+        self._position = 0
+        self._end = False
+        self._decoder = json.JSONDecoder()
+
+    # Drop the consumed part of the buffer and read at least size more bytes.
+    # Return False at the end of the file.
+    def _read(self, size = 0):
+        if self._end:
+            return False
+        data = self._file.read(max(size, _JsonReader._CHUNK_SIZE))
+        if not data:
+            self._end = True
+            return False
+        self._buffer = self._buffer[self._position:] + data
+        self._position = 0
+        return True
+
+    def _error(self, expected):
+        return ValueError("Expected " + expected + " in JSON: " + repr(self._buffer[self._position:self._position + 20]))
+
+    # Skip whitespace and return the next character without consuming it, or ""
+    # at the end of the file.
+    def _peek(self):
+        while True:
+            self._position = _JsonReader._WHITESPACE.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._read():
+                return ""
+
+    def _expect(self, character):
+        if self._peek() != character:
+            raise self._error("'" + character + "'")
+        self._position += 1
+
+    # Read and return the next value.
+    def value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                # A number at the end of the buffer may continue after it.
+                if end < len(self._buffer) or self._end:
+                    self._position = end
+                    return value
+            except ValueError:
+                if self._end:
+                    raise
+            # Read as much again as the unread part of the buffer, so a long
+            # value is decoded a bounded number of times.
+            self._read(len(self._buffer) - self._position)
+
+    # Read and discard the next value. The elements of an array are read one
+    # at a time.
+    def skip(self):
+        if self._peek() == "[":
+            for _ in self.elements():
+                self.value()
+        else:
+            self.value()
+
+    # Read the next array, stopping before each element for the caller to read.
+    def elements(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self._position += 1
+            return
+        while True:
+            yield
+            if self._peek() != ",":
+                self._expect("]")
+                return
+            self._position += 1
+
+    # Read the next object, yielding each key and stopping before its value
+    # for the caller to read.
+    def keys(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self._position += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, basestring):
+                raise self._error("a key")
+            self._expect(":")
+            yield key
+            if self._peek() != ",":
+                self._expect("}")
+                return
+            self._position += 1
+
+# An interned table of strings. Each distinct string is stored once and is
+# referred to by its integer id, in order of insertion.
+class _StringTable(object):
+
+    def __init__(self, strings = None):
+        self._strings = list(strings or [])
+        self._ids = dict(izip(self._strings, xrange(len(self._strings))))
+
+    # Return the id of string, adding it to the table if needed.
+    def intern(self, string):
+        id = self._ids.get(string)
+        if id is None:
+            id = len(self._strings)
+            self._ids[string] = id
+            self._strings.append(string)
+        return id
+
+    # Return the id of string, or None if it is not in the table.
+    def find(self, string):
+        return self._ids.get(string)
+
+    def __getitem__(self, id):
+        return self._strings[id]
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __iter__(self):
+        return iter(self._strings)
 
 class Coverage(object):
 
     def __init__(self):
-        # Map from (file, function) to call count.
-        self._callcounts = defaultdict(int)
+        self._files = _StringTable()
+        self._functionNames = _StringTable()
+        # Columns of file id, function id and call count, one row per
+        # (file, function) pair.
+        self._fileIds = array("I")
+        self._functionIds = array("I")
+        self._callCounts = array(profraw.COUNTER_TYPECODE)
+        # Map from _rowKey(file id, function id) to row.
+        self._rows = {}
+        # The first region and number of regions of each row.
+        self._regionFirsts = array("I")
+        self._regionLengths = array("I")
+        # Columns of region file id, range (four values per region) and
+        # execution count.
+        self._regionFileIds = array("I")
+        self._regionRanges = array("I")
+        self._regionCounts = array(profraw.COUNTER_TYPECODE)
+
+    @staticmethod
+    def _rowKey(fileId, functionId):
+        return (fileId << 32) | functionId
+
+    # Return the row of (file, function), or None if it has no call count.
+    def _findRow(self, file, function):
+        fileId = self._files.find(file)
+        functionId = self._functionNames.find(function)
+        if fileId is None or functionId is None:
+            return None
+        return self._rows.get(Coverage._rowKey(fileId, functionId))
 
     def addCallCount(self, file, function, count):
-        self._callcounts[(file, function)] += count
+        self._addCallCount(file, function, count)
+
+    # Add a call count and return the row of (file, function).
+    def _addCallCount(self, file, function, count):
+        return self._addRowCallCount(self._files.intern(file), self._functionNames.intern(function), count)
+
+    def _addRowCallCount(self, fileId, functionId, count):
+        key = Coverage._rowKey(fileId, functionId)
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._callCounts)
+            self._rows[key] = row
+            self._fileIds.append(fileId)
+            self._functionIds.append(functionId)
+            self._callCounts.append(count)
+            self._regionFirsts.append(0)
+            self._regionLengths.append(0)
+        else:
+            self._callCounts[row] += count
+        return row
+
+    # Add the call counts and regions of another Coverage object to this one.
+    # Regions of a function that differ from its existing regions are ignored.
+    def addCoverage(self, other):
+        # Translate other's string ids once per distinct string rather than
+        # once per row.
+        fileMap = [self._files.intern(file) for file in other._files]
+        functionMap = [self._functionNames.intern(function) for function in other._functionNames]
+        for otherRow, (fileId, functionId, count) in enumerate(izip(other._fileIds, other._functionIds, other._callCounts)):
+            row = self._addRowCallCount(fileMap[fileId], functionMap[functionId], count)
+            if other._regionLengths[otherRow]:
+                self._addRowRegions(row, [(fileMap[regionTuple[0]],) + regionTuple[1:] for regionTuple in other._rowRegions(otherRow)])
+
+    # Add the execution counts of a function's regions, a list of Region. If
+    # the function already has regions, the counts of the same ranges are
+    # added together, and the regions must have the same ranges.
+    def addRegions(self, file, function, regions):
+        row = self._addCallCount(file, function, 0)
+        files = self._files
+        regionTuples = [(files.intern(region.file), region.lineStart, region.columnStart, region.lineEnd, region.columnEnd, region.count) for region in regions]
+        if not self._addRowRegions(row, regionTuples):
+            raise AssertionError("The regions of \"" + function + "\" do not match its existing regions.")
+
+    # Add regions as (file id, line start, column start, line end, column end,
+    # count) tuples to a row. Return False without changing anything if the row
+    # already has different regions.
+    def _addRowRegions(self, row, regionTuples):
+        length = self._regionLengths[row]
+        if length == 0:
+            self._regionFirsts[row] = len(self._regionCounts)
+            self._regionLengths[row] = len(regionTuples)
+            for fileId, lineStart, columnStart, lineEnd, columnEnd, count in regionTuples:
+                self._regionFileIds.append(fileId)
+                self._regionRanges.extend((lineStart, columnStart, lineEnd, columnEnd))
+                self._regionCounts.append(count)
+            return True
+
+        first = self._regionFirsts[row]
+        if length != len(regionTuples):
+            return False
+        for index, regionTuple in enumerate(regionTuples, first):
+            if regionTuple[0] != self._regionFileIds[index] or list(regionTuple[1:5]) != self._regionRanges[4 * index:4 * index + 4].tolist():
+                return False
+        for index, regionTuple in enumerate(regionTuples, first):
+            self._regionCounts[index] += regionTuple[5]
+        return True
+
+    # Return the regions of a row as (file id, line start, column start, line
+    # end, column end, count) tuples.
+    def _rowRegions(self, row):
+        first = self._regionFirsts[row]
+        ranges = self._regionRanges
+        return [(self._regionFileIds[index],) + tuple(ranges[4 * index:4 * index + 4]) + (self._regionCounts[index],)
+                for index in xrange(first, first + self._regionLengths[row])]
+
+    # Return a list of the Regions of (file, function), in source order.
+    def regions(self, file, function):
+        row = self._findRow(file, function)
+        if row is None:
+            return []
+        files = self._files
+        return [Region(files[regionTuple[0]], *regionTuple[1:]) for regionTuple in self._rowRegions(row)]
+
+    # Return a new Coverage object with the call counts and regions of only the
+    # functions for which predicate(file, function) is True. Names of other
+    # functions are not kept, so they are not demangled either.
+    def filtered(self, predicate):
+        result = Coverage()
+        files = self._files
+        for row, (file, function) in enumerate(self.functions()):
+            if not predicate(file, function):
+                continue
+            resultRow = result._addCallCount(file, function, self._callCounts[row])
+            regionTuples = self._rowRegions(row)
+            if regionTuples:
+                result._addRowRegions(resultRow, [(result._files.intern(files[regionTuple[0]]),) + regionTuple[1:] for regionTuple in regionTuples])
+        return result
+
+    # Return True if any function has regions.
+    def hasRegions(self):
+        return len(self._regionCounts) > 0
 
     def callCount(self, file, function):
-        return self._callcounts[(file, function)]
+        row = self._findRow(file, function)
+        return 0 if row is None else self._callCounts[row]
 
     # Return a list of all (file, function) pairs.
     def functions(self):
-        return self._callcounts.keys()
+        files = self._files
+        functionNames = self._functionNames
+        return [(files[fileId], functionNames[functionId]) for fileId, functionId in zip(self._fileIds, self._functionIds)]
+
+    # Return an iterator of (file, function, call count) for all functions.
+    def callCounts(self):
+        files = self._files
+        functionNames = self._functionNames
+        for row in xrange(len(self._callCounts)):
+            yield (files[self._fileIds[row]], functionNames[self._functionIds[row]], self._callCounts[row])
+
+    def __len__(self):
+        return len(self._callCounts)
+
+    # Return the (file, function) pair of a row. Rows are numbered from 0 in
+    # the order functions were first added.
+    def functionAt(self, row):
+        return (self._files[self._fileIds[row]], self._functionNames[self._functionIds[row]])
+
+    # Align the call counts of two Coverage objects by (file, function). Return
+    # (countsA, countsB, rowsB) where countsA and countsB are arrays indexed by
+    # a shared id: ids below len(coverageA) are the rows of coverageA, and the
+    # remaining ids are functions only in coverageB, whose rows are in rowsB.
+    @staticmethod
+    def alignCallCounts(coverageA, coverageB):
+        # Translate coverageB's string ids to coverageA's once per distinct
+        # string rather than once per row.
+        fileMap = [coverageA._files.find(file) for file in coverageB._files]
+        functionMap = [coverageA._functionNames.find(function) for function in coverageB._functionNames]
+
+        countsA = array(profraw.COUNTER_TYPECODE, coverageA._callCounts)
+        countsB = array(profraw.COUNTER_TYPECODE, [0]) * len(countsA)
+        rowsB = array("I")
+        rowsA = coverageA._rows
+        for rowB, (fileIdB, functionIdB, count) in enumerate(izip(coverageB._fileIds, coverageB._functionIds, coverageB._callCounts)):
+            fileId = fileMap[fileIdB]
+            functionId = functionMap[functionIdB]
+            rowA = None
+            if fileId is not None and functionId is not None:
+                rowA = rowsA.get(Coverage._rowKey(fileId, functionId))
+            if rowA is None:
+                rowsB.append(rowB)
+                countsA.append(0)
+                countsB.append(count)
+            else:
+                countsB[rowA] = count
+        return countsA, countsB, rowsB
+
+    # Rename functions using a map from old to new function names. Functions
+    # that are renamed to the same name in the same file are merged.
+    # Merged functions with different regions, which should not happen for
+    # functions with the same source, keep the regions of the first function.
+    def _renameFunctions(self, functionMap):
+        old = copy.copy(self)
+        newFunctionNames = [functionMap[function] for function in old._functionNames]
+
+        # File names are unchanged, so file ids, including region file ids,
+        # stay the same.
+        Coverage.__init__(self)
+        self._files = old._files
+        for row in xrange(len(old)):
+            newRow = self._addCallCount(old._files[old._fileIds[row]], newFunctionNames[old._functionIds[row]], old._callCounts[row])
+            if old._regionLengths[row]:
+                self._addRowRegions(newRow, old._rowRegions(row))
 
     # Use a demangler to convert mangled function names to demangled function names.
     # See c++filt: https://linux.die.net/man/1/c++filt
     # For example: _Z1Av => A().
-    def demangle(self, demangler):
-        mangledCallCounts = self._callcounts
-        mangledFunctions = []
-        for (file, function) in mangledCallCounts:
-            mangledFunctions.append(function)
-
-        proc = subprocess.Popen(demangler, shell=True, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        out, err = proc.communicate("\n".join(mangledFunctions))
-        if err != "":
-            raise AssertionError(err)
-        demangledFunctions = filter(None, out.split("\n"))
+    # If a cache.DemangleCache is given, names it already has are not sent to
+    # the demangler and newly demangled names are added to it. Names are
+    # demangled by a DemanglerPool of up to processes demanglers.
+    def demangle(self, demangler, cache = None, processes = None):
+        Coverage.demangleCoverages([self], demangler, cache, processes)
 
-        mangledFunctionCount = len(mangledFunctions)
-        demangledFunctionCount = len(demangledFunctions)
-        if mangledFunctionCount != demangledFunctionCount:
-            raise AssertionError("Demangling failed: tried to demangle " + str(mangledFunctionCount) + " functions but " + str(demangledFunctionCount) + " were demangled.")
-
-        demangledFunctionMap = {}
-        for index, mangledFunction in enumerate(mangledFunctions):
-            demangledFunctionMap[mangledFunction] = demangledFunctions[index]
-
-        # Reset _callcounts then rebuild it from the demangled mapping.
-        self._callcounts = defaultdict(int)
-        for (file, mangledFunction), count in mangledCallCounts.items():
-            demangledFunction = demangledFunctionMap[mangledFunction]
-            self.addCallCount(file, demangledFunction, count)
+    # Demangle several Coverage objects together. Function names are collected
+    # from all of them so names they share, which is most names when comparing
+    # two runs of one program, are only demangled once.
+    @staticmethod
+    def demangleCoverages(coverages, demangler, cache = None, processes = None):
+        with stages.stage("demangle") as stage:
+            # Each distinct function name only needs to be demangled once.
+            mangledFunctions = _StringTable()
+            for coverage in coverages:
+                for function in coverage._functionNames:
+                    mangledFunctions.intern(function)
+            stage.items = len(mangledFunctions)
+            demangledFunctionMap = demangleNames(list(mangledFunctions), demangler, cache, processes)
+            with stages.stage("rename functions", sum(len(coverage) for coverage in coverages)):
+                for coverage in coverages:
+                    coverage._renameFunctions(demangledFunctionMap)
 
     def asJson(self, indent = None):
         encoded = {}
         encoded["files"] = {}
-        for (file, function) in self._callcounts:
+        for file, function, count in self.callCounts():
             if not file in encoded["files"]:
                 encoded["files"][file] = {}
-            encoded["files"][file][function] = self._callcounts[(file, function)]
+            encoded["files"][file][function] = count
         return json.dumps(encoded, sort_keys=False, indent=indent)
 
+    # Save a compact binary snapshot of this Coverage object to path. The
+    # snapshot can be loaded with fromSnapshot. source is the (size,
+    # modification time, SHA-1 digest) of the raw profile the coverage was read
+    # from, if any.
+    def saveSnapshot(self, path, source = None):
+        with stages.stage("save snapshot", len(self)):
+            self._saveSnapshot(path, source)
+
+    def _saveSnapshot(self, path, source):
+        size, mtime, digest = source or (0, 0.0, "")
+        files = "\0".join(self._files)
+        functions = "\0".join(self._functionNames)
+        with open(path, "wb") as outFile:
+            outFile.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, size, mtime, digest, len(self._files), len(self._functionNames), len(self), len(self._regionCounts), len(files), len(functions)))
+            _writePadded(outFile, files)
+            _writePadded(outFile, functions)
+            _writePadded(outFile, _littleEndianBytes(self._fileIds))
+            _writePadded(outFile, _littleEndianBytes(self._functionIds))
+            _writePadded(outFile, _littleEndianBytes(self._callCounts))
+            _writePadded(outFile, _littleEndianBytes(self._regionFirsts))
+            _writePadded(outFile, _littleEndianBytes(self._regionLengths))
+            _writePadded(outFile, _littleEndianBytes(self._regionFileIds))
+            _writePadded(outFile, _littleEndianBytes(self._regionRanges))
+            _writePadded(outFile, _littleEndianBytes(self._regionCounts))
+
+    # Return True if path is a snapshot this version can read.
+    @staticmethod
+    def isSnapshot(path):
+        return Coverage.snapshotSource(path) is not None
+
+    # Return the snapshot header fields of a file, or None if it is not a
+    # snapshot this version can read.
+    @staticmethod
+    def _readSnapshotHeader(inFile):
+        data = inFile.read(_SNAPSHOT_HEADER.size)
+        if len(data) != _SNAPSHOT_HEADER.size:
+            return None
+        header = _SNAPSHOT_HEADER.unpack(data)
+        if header[0] != _SNAPSHOT_MAGIC or header[1] != _SNAPSHOT_VERSION:
+            return None
+        return header
+
+    # Return the (size, modification time, SHA-1 digest) of the raw profile a
+    # snapshot was made from, or None if path is not a readable snapshot.
+    @staticmethod
+    def snapshotSource(path):
+        try:
+            with open(path, "rb") as inFile:
+                header = Coverage._readSnapshotHeader(inFile)
+        except IOError:
+            return None
+        return header[2:5] if header else None
+
+    # Load a Coverage object from a snapshot written by saveSnapshot.
+    @staticmethod
+    def fromSnapshot(path):
+        with stages.stage("load snapshot") as stage:
+            coverage = Coverage._fromSnapshot(path)
+            stage.items = len(coverage)
+        return coverage
+
+    @staticmethod
+    def _fromSnapshot(path):
+        with open(path, "rb") as inFile:
+            header = Coverage._readSnapshotHeader(inFile)
+            if not header:
+                raise AssertionError("\"" + path + "\" is not a coverage snapshot.")
+            data = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fileCount, functionCount, rowCount, regionCount, filesSize, functionsSize = header[5:]
+            offset = _SNAPSHOT_HEADER.size
+            def section(size):
+                start = offset
+                return data[start:start + size], start + size + _paddingBytes(size)
+
+            files, offset = section(filesSize)
+            functions, offset = section(functionsSize)
+            fileIds, offset = section(4 * rowCount)
+            functionIds, offset = section(4 * rowCount)
+            callCounts, offset = section(8 * rowCount)
+            regionFirsts, offset = section(4 * rowCount)
+            regionLengths, offset = section(4 * rowCount)
+            regionFileIds, offset = section(4 * regionCount)
+            regionRanges, offset = section(16 * regionCount)
+            regionCounts, offset = section(8 * regionCount)
+        finally:
+            data.close()
+
+        coverage = Coverage()
+        coverage._files = _StringTable(files.split("\0") if fileCount else [])
+        coverage._functionNames = _StringTable(functions.split("\0") if functionCount else [])
+        coverage._fileIds = _arrayFromLittleEndianBytes("I", fileIds)
+        coverage._functionIds = _arrayFromLittleEndianBytes("I", functionIds)
+        coverage._callCounts = _arrayFromLittleEndianBytes(profraw.COUNTER_TYPECODE, callCounts)
+        coverage._regionFirsts = _arrayFromLittleEndianBytes("I", regionFirsts)
+        coverage._regionLengths = _arrayFromLittleEndianBytes("I", regionLengths)
+        coverage._regionFileIds = _arrayFromLittleEndianBytes("I", regionFileIds)
+        coverage._regionRanges = _arrayFromLittleEndianBytes("I", regionRanges)
+        coverage._regionCounts = _arrayFromLittleEndianBytes(profraw.COUNTER_TYPECODE, regionCounts)
+        if (len(coverage._files) != fileCount or len(coverage._functionNames) != functionCount or len(coverage._callCounts) != rowCount
+                or len(coverage._regionLengths) != rowCount or len(coverage._regionCounts) != regionCount):
+            raise AssertionError("\"" + path + "\" is a corrupt coverage snapshot.")
+        coverage._rows = dict(izip((Coverage._rowKey(fileId, functionId) for fileId, functionId in izip(coverage._fileIds, coverage._functionIds)), xrange(rowCount)))
+        return coverage
+
     # Parse the function counter output of llvm-profdata show and return a
-    # Coverage object.
+    # Coverage object. The output can be a string or an iterable of lines, such
+    # as the stdout of a running llvm-profdata process, and is parsed one line
+    # at a time so the whole output never needs to be held in memory.
     @staticmethod
     def _fromProfDataShowAllFunctions(profdata):
+        if isinstance(profdata, basestring):
+            profdata = profdata.splitlines()
         coverage = Coverage()
         # The default format (without -text) is roughly:
         #   optional_filename.cpp:function_name:
         #     Hash: 0x456
         #     Counters: 6
         #     Function count: 3
-        # TODO(phil): Support block or region counters instead of just function-level counters.
-        functionsRx = re.compile(r"^\s+(?P<fileAndFunction>.+):\n\s+Hash:\s.*\n\s+Counters:\s.*\n\s+Function\scount:\s(?P<count>.+)\n", re.MULTILINE)
-        for match in functionsRx.finditer(profdata):
-            count = int(match.group("count"))
+        # A function is an indented line ending in ":" followed by exactly these
+        # three lines. Anything else resets the state. Region counters are not
+        # shown; see fromLlvmCovExport.
+        fileAndFunction = None
+        expected = None
+        for line in profdata:
+            stripped = line.strip()
+            if expected and stripped.startswith(expected):
+                if expected == "Hash:":
+                    expected = "Counters:"
+                elif expected == "Counters:":
+                    expected = "Function count:"
+                else:
+                    count = int(stripped[len(expected):])
+                    if count != 0:
+                        coverage._addPgoFunctionCount(fileAndFunction, count)
+                    expected = None
+            elif line[:1].isspace() and len(stripped) > 1 and stripped.endswith(":"):
+                fileAndFunction = stripped[:-1]
+                expected = "Hash:"
+            else:
+                expected = None
+        return coverage
+
+    # Add a call count for a PGO function name and return its row. Functions
+    # with local linkage are prefixed by their file (file.cpp:function).
+    def _addPgoFunctionCount(self, fileAndFunction, count):
+        fileAndFunctionMatch = re.match(r"(?P<file>.+):(?P<function>.+)", fileAndFunction)
+        if fileAndFunctionMatch:
+            file = fileAndFunctionMatch.group("file")
+            function = fileAndFunctionMatch.group("function")
+            return self._addCallCount(file, function, count)
+        return self._addCallCount("", fileAndFunction, count)
+
+    # Parse the JSON output of llvm-cov export and return a Coverage object with
+    # the call counts and code regions of every called function. export can be
+    # a string or a file object, such as the stdout of a running llvm-cov
+    # process. Functions are parsed one at a time, so the whole export, which
+    # can be gigabytes for large programs, never needs to be held in memory.
+    # See: https://llvm.org/docs/CommandGuide/llvm-cov.html#llvm-cov-export
+    @staticmethod
+    def fromLlvmCovExport(export):
+        reader = _JsonReader(StringIO(export) if isinstance(export, basestring) else export)
+        coverage = Coverage()
+        # The export is {"data": [{"files": [...], "functions": [...], ...}],
+        # ...}. Everything but the functions is skipped.
+        for key in reader.keys():
+            if key != "data":
+                reader.skip()
+                continue
+            for _ in reader.elements():
+                for dataKey in reader.keys():
+                    if dataKey != "functions":
+                        reader.skip()
+                        continue
+                    for _ in reader.elements():
+                        coverage._addExportedFunction(reader.value())
+        return coverage
+
+    # Add a function object of an llvm-cov export.
+    def _addExportedFunction(self, function):
+        count = function["count"]
+        if count == 0:
+            return
+        row = self._addPgoFunctionCount(function["name"].encode("utf-8"), count)
+        # Regions are [line start, column start, line end, column end,
+        # execution count, file index, expanded file index, kind].
+        fileIds = [self._files.intern(filename.encode("utf-8")) for filename in function["filenames"]]
+        regionTuples = [(fileIds[region[5]], region[0], region[1], region[2], region[3], region[4])
+                        for region in function["regions"] if region[7] == _CODE_REGION_KIND]
+        # Functions with the same name, such as template instantiations in
+        # different object files, keep the first function's regions if their
+        # regions differ.
+        self._addRowRegions(row, regionTuples)
+
+    # Build a Coverage object from the functions of a raw profile read with
+    # profraw.readRawProfile.
+    @staticmethod
+    def _fromRawProfileFunctions(functions):
+        coverage = Coverage()
+        for function in functions:
+            # The first counter is the function entry count. The other
+            # counters can only be mapped to source regions with the coverage
+            # mapping of the executable; see fromLlvmCovExport.
+            count = function.counters[0] if function.counters else 0
             if count == 0:
                 continue
-            fileAndFunction = match.group("fileAndFunction")
-            fileAndFunctionMatch = re.match(r"(?P<file>.+):(?P<function>.+)", fileAndFunction)
-            if fileAndFunctionMatch:
-                file = fileAndFunctionMatch.group("file")
-                function = fileAndFunctionMatch.group("function")
-                coverage.addCallCount(file, function, count)
-            else:
-                coverage.addCallCount("", fileAndFunction, count)
+            coverage._addPgoFunctionCount(function.name, count)
+        return coverage
+
+    # Convert a raw LLVM profile coverage file into a Coverage object. Snapshots,
+    # such as the merged shards written by record.py, are loaded directly.
+    # If executable is given, the regions of each function are read too, using
+    # the coverage mapping of the executable the profile was recorded from.
+    # If useSnapshots is True, the parsed coverage is saved as a snapshot in the
+    # cache directory, and reused while the raw profile's size, modification
+    # time and contents are unchanged.
+    @staticmethod
+    def fromRawLlvmProfile(rawProfDataPath, llvmToolchainPath = None, useSnapshots = True, executable = None):
+        with stages.stage("load profile") as stage:
+            coverage = Coverage._fromRawLlvmProfileOrSnapshot(rawProfDataPath, llvmToolchainPath, useSnapshots, executable)
+            stage.items = len(coverage)
         return coverage
 
-    # Convert a raw LLVM profile coverage file into a Coverage object.
     @staticmethod
-    def fromRawLlvmProfile(rawProfDataPath, llvmToolchainPath = None):
-        # Ensure llvm-profdata is available.
+    def _fromRawLlvmProfileOrSnapshot(rawProfDataPath, llvmToolchainPath, useSnapshots, executable):
+        if Coverage.isSnapshot(rawProfDataPath):
+            return Coverage.fromSnapshot(rawProfDataPath)
+        if not useSnapshots:
+            return Coverage._fromRawLlvmProfile(rawProfDataPath, llvmToolchainPath, executable)
+
+        snapshotFile = snapshotPath(rawProfDataPath, executable)
+        snapshotSource = Coverage.snapshotSource(snapshotFile)
+        stat = os.stat(rawProfDataPath)
+        digest = None
+        if snapshotSource and snapshotSource[:2] == (stat.st_size, stat.st_mtime):
+            digest = fileDigest(rawProfDataPath)
+            if snapshotSource[2] == digest:
+                touchSnapshot(snapshotFile)
+                return Coverage.fromSnapshot(snapshotFile)
+        digest = digest or fileDigest(rawProfDataPath)
+
+        coverage = Coverage._fromRawLlvmProfile(rawProfDataPath, llvmToolchainPath, executable)
+        # Write the snapshot under a temporary name first so concurrent runs
+        # never see a partial snapshot.
+        temporarySnapshotFile = snapshotFile + "." + str(os.getpid()) + "." + str(threading.current_thread().ident)
+        try:
+            coverage.saveSnapshot(temporarySnapshotFile, (stat.st_size, stat.st_mtime, digest))
+            os.rename(temporarySnapshotFile, snapshotFile)
+            pruneSnapshots()
+        except (IOError, OSError):
+            # The snapshot is only an optimization.
+            if os.path.exists(temporarySnapshotFile):
+                os.remove(temporarySnapshotFile)
+        return coverage
+
+    # Return a map from region name to the path of each filtered profile
+    # FilterCoverage.h wrote for rawProfDataPath (LLVM_PROFILE_FILE). The
+    # unnamed region, "", is rawProfDataPath itself, a named region is
+    # rawProfDataPath + ".region-" + name and "unfiltered", the remaining
+    # coverage, is rawProfDataPath + "_unfiltered". Other files are not
+    # included, even if their names start with rawProfDataPath.
+    @staticmethod
+    def filteredProfilePaths(rawProfDataPath):
+        directory, filename = os.path.split(rawProfDataPath)
+        paths = {}
+        if not os.path.isdir(directory or "."):
+            return paths
+        if os.path.isfile(rawProfDataPath):
+            paths[""] = rawProfDataPath
+        if os.path.isfile(rawProfDataPath + "_unfiltered"):
+            paths["unfiltered"] = rawProfDataPath + "_unfiltered"
+        prefix = filename + ".region-"
+        for regionFilename in os.listdir(directory or "."):
+            if regionFilename.startswith(prefix) and len(regionFilename) > len(prefix):
+                path = os.path.join(directory, regionFilename)
+                if os.path.isfile(path):
+                    paths[regionFilename[len(prefix):]] = path
+        return paths
+
+    # Load every filtered region of one run, recorded with FilterCoverage.h,
+    # and return a map from region name to Coverage object. See
+    # filteredProfilePaths for the region names. The other arguments are the
+    # same as fromRawLlvmProfile.
+    @staticmethod
+    def fromFilteredRawLlvmProfiles(rawProfDataPath, llvmToolchainPath = None, useSnapshots = True, executable = None):
+        paths = Coverage.filteredProfilePaths(rawProfDataPath)
+        if not paths:
+            raise AssertionError("No filtered coverage was found for '" + rawProfDataPath + "'.")
+        regions = {}
+        for name, path in paths.iteritems():
+            regions[name] = Coverage.fromRawLlvmProfile(path, llvmToolchainPath, useSnapshots, executable)
+        return regions
+
+    @staticmethod
+    def _fromRawLlvmProfile(rawProfDataPath, llvmToolchainPath = None, executable = None):
+        if executable:
+            return Coverage._fromRawLlvmProfileWithMapping(rawProfDataPath, executable)
+
+        # Read the raw profile directly if its format is understood, otherwise
+        # fall back to converting it with llvm-profdata.
+        with stages.stage("read raw profile") as stage:
+            functions = profraw.readRawProfile(rawProfDataPath)
+            if functions is not None:
+                stage.items = len(functions)
+                return Coverage._fromRawProfileFunctions(functions)
+
         llvmProfdata = "llvm-profdata"
-        command = [ llvmProfdata, "show", "--help" ]
-        proc = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        out, err = proc.communicate()
-        if err != "":
-            raise AssertionError(err)
+        _checkLlvmProfdata(llvmProfdata)
 
         # Use llvm-profdata to dump the raw counter values for each function.
         # See: https://llvm.org/docs/CommandGuide/llvm-profdata.html#profdata-show
-        # TODO(phil): Support block or region counters instead of just function-level counters.
+        # The output is parsed while llvm-profdata is still writing it. Errors
+        # go to a temporary file so a full stderr pipe cannot stall the process.
         command = [ llvmProfdata, "show", "-all-functions", rawProfDataPath ]
-        proc = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        out, err = proc.communicate()
+        with stages.stage("llvm-profdata show") as stage, tempfile.TemporaryFile() as errFile:
+            proc = subprocess.Popen(command, stderr=errFile, stdout=subprocess.PIPE)
+            try:
+                coverage = Coverage._fromProfDataShowAllFunctions(iter(proc.stdout.readline, ""))
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            errFile.seek(0)
+            err = errFile.read()
+            stage.items = len(coverage)
         if err != "":
             raise AssertionError(err)
 
-        return Coverage._fromProfDataShowAllFunctions(out)
+        return coverage
+
+    # Read the call counts and regions of a raw profile using the coverage
+    # mapping of executable: llvm-profdata merge indexes the raw profile and
+    # llvm-cov export maps its counters to source regions.
+    @staticmethod
+    def _fromRawLlvmProfileWithMapping(rawProfDataPath, executable):
+        llvmProfdata = "llvm-profdata"
+        _checkLlvmProfdata(llvmProfdata)
+
+        profdataFile, profdataPath = tempfile.mkstemp(suffix=".profdata")
+        os.close(profdataFile)
+        try:
+            command = [ llvmProfdata, "merge", "-sparse", "-o", profdataPath, rawProfDataPath ]
+            with stages.stage("llvm-profdata merge"):
+                proc = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+                out, err = proc.communicate()
+            if proc.returncode != 0:
+                raise AssertionError(err)
+
+            # llvm-cov warns about functions with mismatched data without
+            # failing, so only its exit status is checked. The export is
+            # parsed while llvm-cov is still writing it, and errors go to a
+            # temporary file so a full stderr pipe cannot stall the process.
+            command = [ "llvm-cov", "export", "-format=text", "-skip-expansions", "-instr-profile", profdataPath, executable ]
+            with stages.stage("llvm-cov export") as stage, tempfile.TemporaryFile() as errFile:
+                proc = subprocess.Popen(command, stderr=errFile, stdout=subprocess.PIPE)
+                try:
+                    coverage = Coverage.fromLlvmCovExport(proc.stdout)
+                except ValueError:
+                    # A failing llvm-cov can stop in the middle of the export;
+                    # report its error rather than the incomplete JSON.
+                    proc.stdout.close()
+                    proc.wait()
+                    errFile.seek(0)
+                    err = errFile.read()
+                    if proc.returncode > 0:
+                        raise AssertionError(err)
+                    raise
+                finally:
+                    proc.stdout.close()
+                    proc.wait()
+                errFile.seek(0)
+                err = errFile.read()
+                if proc.returncode != 0:
+                    raise AssertionError(err)
+                stage.items = len(coverage)
+        finally:
+            os.remove(profdataPath)
+        return coverage
@@ -0,0 +1,193 @@
+# demangle.py - parallel demangling of function names
+#
+# Demangling hundreds of thousands of names through a single demangler process
+# is slow, so names are split into chunks and streamed through a pool of
+# demangler processes running in parallel. Each process is fed its chunks by a
+# writer thread while a reader thread collects its output, so demangling
+# overlaps with writing and results are stored in order as they arrive.
+#
+# Demanglers such as c++filt buffer their output when writing to a pipe, so a
+# process cannot answer one chunk before it has seen the end of its input. The
+# processes therefore live for one call to DemanglerPool.demangle and handle
+# all of their chunks in that call.
+#
+# The special demangler IN_PROCESS_DEMANGLER demangles without a subprocess by
+# calling the C++ runtime's __cxa_demangle through ctypes, if it is available.
+
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+
+import stages
+
+IN_PROCESS_DEMANGLER = "__cxa_demangle"
+
+_cxaDemangle = None
+_free = None
+
+# Load __cxa_demangle from the C++ runtime. Return False if it is unavailable.
+def _loadCxaDemangle():
+    global _cxaDemangle, _free
+    if _cxaDemangle:
+        return True
+    for library in ["stdc++", "c++"]:
+        path = ctypes.util.find_library(library)
+        if not path:
+            continue
+        try:
+            runtime = ctypes.CDLL(path)
+            cxaDemangle = runtime.__cxa_demangle
+        except (OSError, AttributeError):
+            continue
+        cxaDemangle.restype = ctypes.c_void_p
+        cxaDemangle.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t), ctypes.POINTER(ctypes.c_int)]
+        free = ctypes.CDLL(ctypes.util.find_library("c")).free
+        free.argtypes = [ctypes.c_void_p]
+        _cxaDemangle, _free = cxaDemangle, free
+        return True
+    return False
+
+# Return True if IN_PROCESS_DEMANGLER can be used.
+def inProcessDemanglingAvailable():
+    return _loadCxaDemangle()
+
+# Demangle a single name in-process. Names that are not mangled are returned
+# unchanged, like c++filt -n.
+def demangleInProcess(mangledName):
+    if not mangledName.startswith("_Z"):
+        return mangledName
+    status = ctypes.c_int()
+    demangled = _cxaDemangle(mangledName, None, None, ctypes.byref(status))
+    if status.value != 0 or not demangled:
+        return mangledName
+    try:
+        return ctypes.string_at(demangled)
+    finally:
+        _free(demangled)
+
+# One demangler process and the chunks it demangles. Chunks are written and
+# read on separate threads so a full pipe in either direction cannot block.
+class _DemanglerProcess(object):
+
+    def __init__(self, demangler, chunks, chunkIndices, results):
+        self._chunks = chunks
+        self._chunkIndices = chunkIndices
+        self._results = results
+        self.extraLines = 0
+        self._errFile = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(demangler, shell=True, stdin=subprocess.PIPE, stderr=self._errFile, stdout=subprocess.PIPE)
+        self._writer = threading.Thread(target=self._write)
+        self._reader = threading.Thread(target=self._read)
+        self._writer.start()
+        self._reader.start()
+
+    def _write(self):
+        try:
+            for index in self._chunkIndices:
+                self._proc.stdin.write("".join(name + "\n" for name in self._chunks[index]))
+        except IOError:
+            # The demangler exited early. This is reported by join().
+            pass
+        finally:
+            try:
+                self._proc.stdin.close()
+            except IOError:
+                pass
+
+    # Read output in large blocks and split it into the lines of each chunk.
+    def _read(self):
+        fd = self._proc.stdout.fileno()
+        chunkIndices = iter(self._chunkIndices)
+        index = next(chunkIndices, None)
+        demangled = []
+        partialLine = ""
+        while True:
+            block = os.read(fd, 1 << 16)
+            if block:
+                lines = (partialLine + block).split("\n")
+                partialLine = lines.pop()
+            elif partialLine:
+                lines = [partialLine]
+                partialLine = ""
+            else:
+                break
+            position = 0
+            while position < len(lines):
+                if index is None:
+                    self.extraLines += len(lines) - position
+                    break
+                needed = len(self._chunks[index]) - len(demangled)
+                demangled.extend(lines[position:position + needed])
+                position += needed
+                if len(demangled) == len(self._chunks[index]):
+                    self._results[index] = demangled
+                    index = next(chunkIndices, None)
+                    demangled = []
+        if index is not None:
+            self._results[index] = demangled
+
+    # Wait for the process to finish and return its stderr output.
+    def join(self):
+        self._writer.join()
+        self._reader.join()
+        self._proc.stdout.close()
+        self._proc.wait()
+        self._errFile.seek(0)
+        err = self._errFile.read()
+        self._errFile.close()
+        return err
+
+# A pool of demangler processes. Names are split into chunks of chunkSize and
+# the chunks are spread across up to processes demanglers, defaulting to one
+# per CPU.
+class DemanglerPool(object):
+
+    def __init__(self, demangler, processes = None, chunkSize = 10000):
+        self._demangler = demangler
+        self._processes = processes or multiprocessing.cpu_count()
+        self._chunkSize = chunkSize
+
+    # Return the demangled names of a list of mangled names, in order.
+    def demangle(self, mangledNames):
+        if self._demangler == IN_PROCESS_DEMANGLER:
+            if not _loadCxaDemangle():
+                raise AssertionError("In-process demangling is not available: __cxa_demangle was not found.")
+            return [demangleInProcess(name) for name in mangledNames]
+
+        # Run the demangler even without names so a missing demangler is
+        # always reported.
+        chunks = [mangledNames[start:start + self._chunkSize] for start in xrange(0, len(mangledNames), self._chunkSize)] or [[]]
+        results = [[] for chunk in chunks]
+        processCount = min(self._processes, len(chunks))
+        processes = [_DemanglerProcess(self._demangler, chunks, range(first, len(chunks), processCount), results) for first in range(processCount)]
+        errors = [process.join() for process in processes]
+
+        for err in errors:
+            if err != "":
+                raise AssertionError(err)
+        demangledNames = [name for chunk in results for name in chunk]
+        mangledNameCount = len(mangledNames)
+        demangledNameCount = len(demangledNames) + sum(process.extraLines for process in processes)
+        if mangledNameCount != demangledNameCount:
+            raise AssertionError("Demangling failed: tried to demangle " + str(mangledNameCount) + " functions but " + str(demangledNameCount) + " were demangled.")
+        return demangledNames
+
+# Return a map from mangled to demangled names for a list of distinct mangled
+# names. If a cache.DemangleCache is given, names it already has are not sent
+# to the demangler and newly demangled names are added to it.
+def demangleNames(mangledNames, demangler, cache = None, processes = None):
+    demangledNameMap = cache.lookup(demangler, mangledNames) if cache else {}
+    missingNames = [name for name in mangledNames if name not in demangledNameMap]
+
+    if missingNames or cache is None:
+        with stages.stage("run demangler", len(missingNames)):
+            demangledNames = DemanglerPool(demangler, processes).demangle(missingNames)
+        newlyDemangledNameMap = dict(zip(missingNames, demangledNames))
+        if cache:
+            cache.store(demangler, newlyDemangledNameMap)
+        demangledNameMap.update(newlyDemangledNameMap)
+    return demangledNameMap
@@ -0,0 +1,197 @@
+# profraw.py - raw LLVM profile reader
+#
+# Reads the raw profile files (*.profraw) written by programs built with
+# -fprofile-instr-generate without going through llvm-profdata. The layout is
+# defined by LLVM's InstrProfData.inc and is roughly:
+#   header
+#   binary ids (version 6+)
+#   data records, one per function
+#   padding
+#   counters
+#   padding
+#   names, possibly zlib compressed
+#   padding
+#   value profile data (ignored)
+# See: https://llvm.org/docs/InstrProfileFormat.html
+#
+# Only 64-bit profiles with raw versions 5 through 8 are understood. Other
+# profiles are reported as unsupported so callers can fall back to
+# llvm-profdata.
+
+from array import array
+from collections import namedtuple
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+# "\xfflprofr\x81" as a 64-bit integer. The 32-bit magic uses "R" instead of
+# "r" and is not supported.
+_MAGIC_64 = (255 << 56) | (ord("l") << 48) | (ord("p") << 40) | (ord("r") << 32) | (ord("o") << 24) | (ord("f") << 16) | (ord("r") << 8) | 129
+
+_MIN_VERSION = 5
+_MAX_VERSION = 8
+
+# The top byte of the version field holds variant flags. Instrumentation
+# variants (IR, context sensitive, entry block) do not change the layout, but
+# debug info correlation (bit 59) and anything newer does.
+_VARIANT_MASK = 0xff << 56
+_SUPPORTED_VARIANTS = (1 << 56) | (1 << 57) | (1 << 58)
+
+# Header fields after Magic and Version. Version 6 added BinaryIdsSize.
+_HEADER_FIELDS_V5 = ["DataSize", "PaddingBytesBeforeCounters", "CountersSize", "PaddingBytesAfterCounters", "NamesSize", "CountersDelta", "NamesDelta", "ValueKindLast"]
+_HEADER_FIELDS_V6 = ["BinaryIdsSize"] + _HEADER_FIELDS_V5
+
+# A data record: NameRef, FuncHash, CounterPtr, FunctionPointer, Values,
+# NumCounters, NumValueSites[2].
+_DATA_RECORD = "QQQQQIHH"
+_DATA_RECORD_SIZE = struct.calcsize("<" + _DATA_RECORD)
+
+_COUNTER_SIZE = 8
+
+# Function names are separated by \x01 within a (possibly compressed) blob.
+_NAME_SEPARATOR = "\x01"
+
+# Counters are 64-bit. Python 2's array module lacks "Q" but "L" is 64-bit on
+# the LP64 platforms LLVM's profile runtime targets.
+try:
+    array("Q")
+    COUNTER_TYPECODE = "Q"
+except ValueError:
+    COUNTER_TYPECODE = "L"
+
+# A function in a raw profile: the PGO function name (file:function for local
+# functions), the structural hash, and the array of counter values. The first
+# counter is the function entry count.
+RawFunction = namedtuple("RawFunction", ["name", "hash", "counters"])
+
+# Return the 64-bit name reference LLVM uses for a PGO function name: the low
+# half of its MD5, read little-endian.
+def nameRef(name):
+    return struct.unpack("<Q", hashlib.md5(name).digest()[:8])[0]
+
+# Return (the ULEB128 value at offset, the offset after it), or (None, offset)
+# if the value runs past the end of buffer.
+def _readUleb128(buffer, offset):
+    result = 0
+    shift = 0
+    while True:
+        if offset >= len(buffer):
+            return None, offset
+        byte = ord(buffer[offset])
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+# Return a map from name reference to name for the names section, or None if
+# the section is corrupt or truncated.
+def _readNames(names):
+    nameMap = {}
+    offset = 0
+    while offset < len(names):
+        uncompressedSize, offset = _readUleb128(names, offset)
+        compressedSize, offset = _readUleb128(names, offset)
+        if uncompressedSize is None or compressedSize is None:
+            return None
+        if compressedSize:
+            try:
+                blob = zlib.decompress(names[offset:offset + compressedSize])
+            except zlib.error:
+                return None
+            offset += compressedSize
+        else:
+            blob = names[offset:offset + uncompressedSize]
+            offset += uncompressedSize
+        if len(blob) != uncompressedSize:
+            return None
+        for name in blob.split(_NAME_SEPARATOR):
+            nameMap[nameRef(name)] = name
+        # Skip the padding after the last blob.
+        while offset < len(names) and names[offset] == "\0":
+            offset += 1
+    return nameMap
+
+def _paddingBytes(size):
+    return (8 - size % 8) % 8
+
+def _signed64(value):
+    value &= 0xffffffffffffffff
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+# Parse a raw profile and return a list of RawFunction, or None if the profile
+# uses a format this reader does not understand.
+def readRawProfile(path):
+    size = os.path.getsize(path)
+    if size < 16:
+        return None
+    with open(path, "rb") as inFile:
+        data = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _readRawProfile(data, size)
+        finally:
+            data.close()
+
+def _readRawProfile(data, size):
+    for endian in ["<", ">"]:
+        if struct.unpack_from(endian + "Q", data, 0)[0] == _MAGIC_64:
+            break
+    else:
+        return None
+
+    version = struct.unpack_from(endian + "Q", data, 8)[0]
+    variants = version & _VARIANT_MASK
+    version &= ~_VARIANT_MASK
+    if variants & ~_SUPPORTED_VARIANTS or version < _MIN_VERSION or version > _MAX_VERSION:
+        return None
+
+    fields = _HEADER_FIELDS_V6 if version >= 6 else _HEADER_FIELDS_V5
+    offset = 16
+    if offset + 8 * len(fields) > size:
+        return None
+    header = dict(zip(fields, struct.unpack_from(endian + "Q" * len(fields), data, offset)))
+    offset += 8 * len(fields)
+
+    offset += header.get("BinaryIdsSize", 0)
+    dataOffset = offset
+    offset += header["DataSize"] * _DATA_RECORD_SIZE
+    offset += header["PaddingBytesBeforeCounters"]
+    countersOffset = offset
+    offset += header["CountersSize"] * _COUNTER_SIZE
+    offset += header["PaddingBytesAfterCounters"]
+    namesOffset = offset
+    offset += header["NamesSize"]
+    offset += _paddingBytes(header["NamesSize"])
+    if offset > size:
+        return None
+
+    counters = array(COUNTER_TYPECODE)
+    counters.fromstring(data[countersOffset:countersOffset + header["CountersSize"] * _COUNTER_SIZE])
+    if (endian == "<") != (sys.byteorder == "little"):
+        counters.byteswap()
+    nameMap = _readNames(data[namesOffset:namesOffset + header["NamesSize"]])
+    if nameMap is None:
+        return None
+
+    functions = []
+    countersDelta = header["CountersDelta"]
+    record = struct.Struct(endian + _DATA_RECORD)
+    for index in range(header["DataSize"]):
+        nameReference, functionHash, counterPointer, _, _, numCounters, _, _ = record.unpack_from(data, dataOffset + index * _DATA_RECORD_SIZE)
+        # Before version 8, CounterPtr is an absolute address and CountersDelta
+        # is the address of the counters section. Since version 8, CounterPtr
+        # is relative to its own data record and CountersDelta is the distance
+        # from the data section to the counters section.
+        counterOffset = _signed64(counterPointer - countersDelta)
+        if version >= 8:
+            counterOffset += index * _DATA_RECORD_SIZE
+        if counterOffset < 0 or counterOffset % _COUNTER_SIZE:
+            return None
+        counterIndex = counterOffset // _COUNTER_SIZE
+        if counterIndex + numCounters > header["CountersSize"] or nameReference not in nameMap:
+            return None
+        functions.append(RawFunction(nameMap[nameReference], functionHash, counters[counterIndex:counterIndex + numCounters]))
+    return functions
@@ -0,0 +1,113 @@
+# spectrum.py - spectrum-based suspiciousness of functions
+#
+# Comparing one good run against one bad run is noisy on large programs because
+# many functions' call counts vary from run to run. With several passing and
+# failing runs, a function that is called in most failing runs but few passing
+# runs is more likely to be related to the failure. Metrics such as Ochiai,
+# Tarantula and DStar turn these counts into a suspiciousness score.
+#
+# Conceptually the runs form a function x run matrix of "was the function
+# called" bits. Only the per-function sums of that matrix over the failing and
+# passing runs are needed, so each run is reduced into two count columns as it
+# is added and the matrix itself is never stored. Runs are aligned with the
+# functions seen so far using Coverage.alignCallCounts.
+
+from array import array
+from collections import namedtuple
+import heapq
+import math
+
+from coverage import Coverage
+
+# The suspiciousness of a function, and the number of failing and passing runs
+# that called it.
+Suspiciousness = namedtuple("Suspiciousness", ["file", "function", "score", "failingRuns", "passingRuns"])
+
+# Ochiai: failed / sqrt(totalFailed * (failed + passed)).
+def ochiai(failed, passed, totalFailed, totalPassed):
+    denominator = math.sqrt(totalFailed * (failed + passed))
+    return failed / denominator if denominator else 0.0
+
+# Tarantula: the failing ratio relative to the sum of the failing and passing
+# ratios.
+def tarantula(failed, passed, totalFailed, totalPassed):
+    failedRatio = float(failed) / totalFailed if totalFailed else 0.0
+    passedRatio = float(passed) / totalPassed if totalPassed else 0.0
+    if failedRatio + passedRatio == 0:
+        return 0.0
+    return failedRatio / (failedRatio + passedRatio)
+
+# DStar with * = 2: failed^2 / (passed + failing runs that did not call the
+# function). A function called by every failing run and no passing run is
+# infinitely suspicious.
+def dstar(failed, passed, totalFailed, totalPassed):
+    denominator = passed + totalFailed - failed
+    if denominator == 0:
+        return float("inf") if failed else 0.0
+    return float(failed * failed) / denominator
+
+METRICS = {
+    "ochiai": ochiai,
+    "tarantula": tarantula,
+    "dstar": dstar,
+}
+
+class Spectrum(object):
+
+    def __init__(self):
+        # Every function called in any run. The rows of _functions index the
+        # count columns below; its call counts are unused.
+        self._functions = Coverage()
+        # The number of failing and passing runs that called each function.
+        self._failingCalls = array("I")
+        self._passingCalls = array("I")
+        self.failingRuns = 0
+        self.passingRuns = 0
+
+    # Add the call counts of one run.
+    def addRun(self, coverage, failed):
+        countsA, counts, newRows = Coverage.alignCallCounts(self._functions, coverage)
+        # Functions first seen in this run get the next rows, in the order of
+        # their ids in counts.
+        for row in newRows:
+            file, function = coverage.functionAt(row)
+            self._functions.addCallCount(file, function, 0)
+        newCalls = array("I", [0]) * len(newRows)
+        self._failingCalls.extend(newCalls)
+        self._passingCalls.extend(newCalls)
+
+        if failed:
+            self.failingRuns += 1
+            calls = self._failingCalls
+        else:
+            self.passingRuns += 1
+            calls = self._passingCalls
+        for row, count in enumerate(counts):
+            if count:
+                calls[row] += 1
+
+    def __len__(self):
+        return len(self._functions)
+
+    # Return a list of Suspiciousness using one of METRICS, most suspicious
+    # first. Functions that no failing run called are not suspicious and are
+    # omitted. Ties are ranked by the number of failing runs, then passing
+    # runs, then in the order functions were first seen. If top is given, only
+    # the top most suspicious functions are returned.
+    def rank(self, metric = "ochiai", top = None):
+        if metric not in METRICS:
+            raise AssertionError("Unknown suspiciousness metric '" + metric + "'.")
+        score = METRICS[metric]
+        failingRuns = self.failingRuns
+        passingRuns = self.passingRuns
+        failingCalls = self._failingCalls
+        passingCalls = self._passingCalls
+
+        scored = ((-score(failingCalls[row], passingCalls[row], failingRuns, passingRuns), -failingCalls[row], passingCalls[row], row)
+                  for row in xrange(len(failingCalls)) if failingCalls[row])
+        ranked = sorted(scored) if top is None else heapq.nsmallest(top, scored)
+        suspiciousness = []
+        for negativeScore, negativeFailed, passed, row in ranked:
+            file, function = self._functions.functionAt(row)
+            suspiciousness.append(Suspiciousness(file, function, -negativeScore, -negativeFailed, passed))
+        return suspiciousness
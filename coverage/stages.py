@@ -0,0 +1,191 @@
+# stages.py - timing and memory use of the stages of recording and comparing
+#
+# A slow comparison can be slow for many reasons: llvm-profdata, parsing,
+# demangling or the comparison itself. Code wraps each stage in stage(name),
+# and once enable() has been called every stage records its wall time, CPU
+# time, the time of subprocesses it waited for, the peak memory use of the
+# process so far and the number of items it handled, such as functions or
+# names. Instrumentation is off by default and a stage then costs one check.
+#
+# Stages can nest and can run on several threads at once, such as when several
+# profiles are loaded concurrently. CPU time and peak memory use are for the
+# whole process, so stages running at the same time share them. Stages that run
+# in other processes, such as the workers of compare.py --baseline, are not
+# recorded.
+#
+# Records can be formatted as a table, as JSON or as Chrome trace events, which
+# can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+from collections import namedtuple
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+FORMATS = ["table", "json", "trace"]
+
+# One run of a stage. start is in seconds since the epoch, times are in seconds
+# and maxRss is in bytes. items is None if the stage does not count items.
+# depth is the number of stages the stage ran in, on its thread.
+StageRecord = namedtuple("StageRecord", ["name", "start", "wallTime", "cpuTime", "subprocessTime", "maxRss", "items", "depth", "thread"])
+
+# The records of finished stages, or None if instrumentation is disabled.
+_records = None
+_callback = None
+_recordsLock = threading.Lock()
+# The stack of running stages of each thread.
+_threadStages = threading.local()
+
+# Start recording stages. If callback is given, it is called with the
+# StageRecord of each stage as it finishes, on the stage's thread.
+def enable(callback = None):
+    global _records, _callback
+    with _recordsLock:
+        _records = []
+        _callback = callback
+
+# Stop recording stages and discard the records.
+def disable():
+    global _records, _callback
+    with _recordsLock:
+        _records = None
+        _callback = None
+
+def enabled():
+    return _records is not None
+
+# Return the StageRecords of the stages that have finished, in the order they
+# started.
+def records():
+    with _recordsLock:
+        return sorted(_records or [], key=lambda record: record.start)
+
+def _cpuTime(usage):
+    return usage.ru_utime + usage.ru_stime
+
+# ru_maxrss is in kilobytes on Linux and bytes on MacOS.
+def _maxRss(usage):
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+class _Stage(object):
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        stack = getattr(_threadStages, "stack", None)
+        if stack is None:
+            stack = _threadStages.stack = []
+        self._depth = len(stack)
+        stack.append(self)
+        self._usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        wallTime = time.time() - self._start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _threadStages.stack.pop()
+        record = StageRecord(self.name, self._start, wallTime, _cpuTime(usage) - _cpuTime(self._usage),
+                             _cpuTime(childUsage) - _cpuTime(self._childUsage), _maxRss(usage), self.items,
+                             self._depth, threading.current_thread().ident)
+        with _recordsLock:
+            if _records is None:
+                return False
+            _records.append(record)
+            callback = _callback
+        if callback:
+            callback(record)
+        return False
+
+# A stage that records nothing, used while instrumentation is disabled.
+class _NullStage(object):
+    items = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+# Return a context manager that records the stage name while instrumentation is
+# enabled. The number of items can be given here or set on the object returned
+# by the with statement:
+#    with stages.stage("demangle") as stage:
+#        stage.items = len(names)
+def stage(name, items = None):
+    if _records is None:
+        return _NULL_STAGE
+    return _Stage(name, items)
+
+def _formatSeconds(seconds):
+    return "%.3fs" % seconds
+
+def _formatSize(size):
+    return "%.1fMB" % (size / float(1 << 20))
+
+# Return records as a table with one line per stage. Nested stages are
+# indented under the stage they ran in, and the stages of each thread are kept
+# together.
+def formatTable(records):
+    threadStarts = {}
+    for record in records:
+        threadStarts[record.thread] = min(record.start, threadStarts.get(record.thread, record.start))
+    lines = ["%-40s %10s %10s %11s %10s %10s" % ("stage", "wall", "cpu", "subprocess", "peak rss", "items")]
+    for record in sorted(records, key=lambda record: (threadStarts[record.thread], record.thread, record.start)):
+        lines.append("%-40s %10s %10s %11s %10s %10s" % ("  " * record.depth + record.name, _formatSeconds(record.wallTime),
+                     _formatSeconds(record.cpuTime), _formatSeconds(record.subprocessTime), _formatSize(record.maxRss),
+                     "" if record.items is None else record.items))
+    return "\n".join(lines)
+
+# Return records as a JSON list of objects with the fields of StageRecord.
+def formatJson(records):
+    return json.dumps([record._asdict() for record in records], indent=2)
+
+# Return records as Chrome trace events. Times are in microseconds since the
+# first stage started.
+# See: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+def formatTrace(records):
+    origin = min(record.start for record in records) if records else 0
+    pid = os.getpid()
+    events = []
+    for record in records:
+        events.append({
+            "name": record.name,
+            "ph": "X",
+            "ts": int((record.start - origin) * 1e6),
+            "dur": int(record.wallTime * 1e6),
+            "pid": pid,
+            "tid": record.thread,
+            "args": {
+                "cpuTime": record.cpuTime,
+                "subprocessTime": record.subprocessTime,
+                "maxRss": record.maxRss,
+                "items": record.items,
+            },
+        })
+    return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+# Write the records so far in one of FORMATS to path, or to stderr if no path
+# is given.
+def writeReport(format, path = None):
+    formatter = {"table": formatTable, "json": formatJson, "trace": formatTrace}[format]
+    report = formatter(records()) + "\n"
+    if path:
+        with open(path, "w") as outFile:
+            outFile.write(report)
+    else:
+        sys.stderr.write(report)
+
+# Add the --profile-stages options to an argparse parser.
+def addArguments(parser):
+    parser.add_argument("--profile-stages", action="store_true", help="Report the time and memory use of each stage")
+    parser.add_argument("--profile-stages-format", choices=FORMATS, default="table", help="Format of the --profile-stages report: a table (default), JSON or Chrome trace events")
+    parser.add_argument("--profile-stages-output", help="Write the --profile-stages report to a file instead of stderr", metavar="PATH")
@@ -3,54 +3,348 @@
 # record.py - Helper for running a program and recording a raw coverage file.
 #
 # Usage: record.py executable -o coverage.profraw
+#        record.py --shards executable -o coverage.snapshot
+#        record.py --batch commands.txt -o outputDirectory
 #
 # This is just a convenience tool for running an executable that has coverage
 # enabled using the LLVM_PROFILE_FILE environmental variable. For information
 # about doing this manually, see:
 # https://clang.llvm.org/docs/SourceBasedCodeCoverage.html#running-the-instrumented-program
+#
+# Programs with several processes, such as a browser with renderer and GPU
+# processes, would overwrite each other's raw coverage file. With --shards,
+# every process writes its own shard and the shards are merged into a single
+# coverage snapshot, which compare.py reads like a raw coverage file. With
+# --batch, each line of a file is a command to record, and the commands are
+# recorded concurrently.
+#
+# The program's output is streamed to the terminal (or a log file) rather than
+# buffered, so programs that log hundreds of megabytes do not use more memory.
+# Only the end of its stderr output is kept for error messages. Each recording
+# reports its wall time, CPU time, peak memory use and raw coverage size.
 
 import argparse
+from collections import deque, namedtuple
+import glob
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os.path
+import shlex
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-# Run the executable and generate a raw coverage file (*.profraw).
-def recordRawCoverageFile(outputFile, executable, argsList = None, verbose = False):
-    # Check the executable to ensure it was built with coverage.
-    with open (executable, 'r') as inFile:
-        executableData = inFile.read()
-    # Count the instances of __llvm_profile. A simple hello world has 34.
-    if executableData.count("__llvm_profile") < 10:
-        raise AssertionError("No coverage data found in executable. Ensure the \"-fprofile-instr-generate -fcoverage-mapping\" build flags are used.")
+from coverage import binary
+from coverage import stages
+from coverage.coverage import Coverage
 
-    # If the output file already exists, delete it before writing a new one.
-    if os.path.isfile(outputFile):
-        os.remove(outputFile)
+# The LLVM_PROFILE_FILE pattern for shards. %p is replaced with the process id
+# and %m with a signature of the instrumented binary, so every process and
+# instrumented shared library writes its own shard.
+# See: https://clang.llvm.org/docs/SourceBasedCodeCoverage.html#running-the-instrumented-program
+_SHARD_PATTERN = "shard-%p-%m.profraw"
 
-    # Run the executable and generate a raw coverage file.
+# The number of bytes at the end of a recorded program's stderr output that are
+# kept for error messages.
+_STDERR_TAIL_SIZE = 1 << 16
+
+# The cost of a recorded run. Times are in seconds and sizes in bytes. maxRss is
+# the peak resident memory of the executable's main process, or None if it is
+# not available on this platform. profileSize is the total size of the raw
+# coverage files written.
+RunStatistics = namedtuple("RunStatistics", ["wallTime", "userTime", "systemTime", "maxRss", "profileSize"])
+
+def _formatSize(size):
+    return "%.1fMB" % (size / (1024.0 * 1024.0))
+
+def formatRunStatistics(statistics):
+    return ("wall time %.2fs, CPU time %.2fs user + %.2fs system, max RSS %s, raw coverage %s"
+            % (statistics.wallTime, statistics.userTime, statistics.systemTime, "unknown" if statistics.maxRss is None else _formatSize(statistics.maxRss), _formatSize(statistics.profileSize)))
+
+# Copy a pipe to outFiles as it is read, on a separate thread, and keep the last
+# _STDERR_TAIL_SIZE bytes.
+class _PipeTail(object):
+
+    def __init__(self, pipe, outFiles):
+        self._pipe = pipe
+        self._outFiles = outFiles
+        self._chunks = deque()
+        self._thread = threading.Thread(target=self._read)
+        self._thread.start()
+
+    def _read(self):
+        size = 0
+        for block in iter(lambda: os.read(self._pipe.fileno(), 1 << 16), ""):
+            for outFile in self._outFiles:
+                outFile.write(block)
+                outFile.flush()
+            self._chunks.append(block)
+            size += len(block)
+            while size - len(self._chunks[0]) >= _STDERR_TAIL_SIZE:
+                size -= len(self._chunks.popleft())
+
+    # Wait for the pipe to close and return the end of its output.
+    def join(self):
+        self._thread.join()
+        self._pipe.close()
+        return "".join(self._chunks)[-_STDERR_TAIL_SIZE:]
+
+# Ensure the executable was built with coverage.
+def _checkExecutable(executable):
+    if not binary.isInstrumented(executable):
+        raise AssertionError("No coverage data found in executable. Ensure the \"-fprofile-instr-generate -fcoverage-mapping\" build flags are used.")
+
+# Run the executable with LLVM_PROFILE_FILE set to profileFile. Return (the end
+# of its stderr output, wall time, resource usage or None). If verbose, the
+# executable's output is streamed to this process's stdout and stderr. If log
+# is a path, its output is written to that file instead. Otherwise its output
+# is discarded. If the executable runs for more than timeout seconds, it and the
+# processes it started are killed.
+def _runWithProfileFile(profileFile, executable, argsList = None, verbose = False, timeout = None, log = None):
     # See: https://clang.llvm.org/docs/SourceBasedCodeCoverage.html#running-the-instrumented-program
     command = [ executable ]
     if argsList:
         command.extend(argsList)
     environment = os.environ.copy()
-    environment["LLVM_PROFILE_FILE"] = outputFile
-    proc = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
-    out, err = proc.communicate()
-    if verbose:
-        if err != "":
-            print err
-        print out
-
-    # Ensure the raw code coverage file was written.
-    if not os.path.isfile(outputFile):
+    environment["LLVM_PROFILE_FILE"] = profileFile
+
+    if log:
+        # Unbuffered and appending, so stderr copied from the pipe interleaves
+        # with stdout written directly by the executable.
+        stdout = open(log, "ab", 0)
+    elif verbose:
+        stdout = None
+    else:
+        stdout = open(os.devnull, "wb")
+    proc = None
+    errTail = None
+    try:
+        start = time.time()
+        # With a timeout, the executable leads its own process group so the
+        # processes it started, which would keep stderr open, are killed too.
+        proc = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=stdout, env=environment, preexec_fn=os.setsid if timeout is not None else None)
+        errTail = _PipeTail(proc.stderr, [stdout] if log else [sys.stderr] if verbose else [])
+        timedOut = False
+        usage = None
+        if timeout is not None:
+            # Poll rather than kill from a timer thread, so the process group
+            # is only killed before the executable has been reaped, when its
+            # process id cannot have been reused.
+            deadline = start + timeout
+            interval = 0.001
+            while proc.returncode is None:
+                if hasattr(os, "wait4"):
+                    pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                    if pid:
+                        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                        break
+                elif proc.poll() is not None:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    timedOut = True
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    break
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, 0.05)
+        if proc.returncode is None:
+            if hasattr(os, "wait4"):
+                pid, status, usage = os.wait4(proc.pid, 0)
+                proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            else:
+                proc.wait()
+        wallTime = time.time() - start
+    finally:
+        if proc is not None and proc.returncode is None:
+            # Waiting was interrupted, such as by Ctrl-C, which the executable
+            # does not see outside the terminal's process group. Kill and reap
+            # it so its stderr closes.
+            try:
+                if timeout is not None:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                else:
+                    proc.kill()
+            except OSError:
+                pass
+            proc.wait()
+        # Finish copying stderr before the log it is copied to is closed.
+        if errTail:
+            err = errTail.join()
+        if stdout:
+            stdout.close()
+
+    if timedOut:
+        raise AssertionError("\"" + executable + "\" did not finish within " + str(timeout) + " seconds." + ("\n" + err if err else ""))
+    return err, wallTime, usage
+
+# Return RunStatistics for a run from _runWithProfileFile that wrote the raw
+# coverage files in profiles.
+def _runStatistics(wallTime, usage, profiles):
+    profileSize = sum(os.path.getsize(profile) for profile in profiles)
+    if usage is None:
+        return RunStatistics(wallTime, 0.0, 0.0, None, profileSize)
+    # ru_maxrss is in kilobytes on Linux and bytes on MacOS.
+    maxRss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return RunStatistics(wallTime, usage.ru_utime, usage.ru_stime, maxRss, profileSize)
+
+# Run the executable and generate a raw coverage file (*.profraw). Return the
+# RunStatistics of the run. See _runWithProfileFile for verbose, timeout and
+# log.
+def recordRawCoverageFile(outputFile, executable, argsList = None, verbose = False, timeout = None, log = None):
+    # Check the executable to ensure it was built with coverage.
+    _checkExecutable(executable)
+
+    # If the output file, or filtered output files from FilterCoverage.h,
+    # already exist, delete them before writing new ones.
+    for path in Coverage.filteredProfilePaths(outputFile).itervalues():
+        os.remove(path)
+
+    # Run the executable and generate a raw coverage file.
+    with stages.stage("run executable"):
+        err, wallTime, usage = _runWithProfileFile(outputFile, executable, argsList, verbose, timeout, log)
+
+    # Ensure the raw code coverage file was written. Programs that only filter
+    # coverage into named regions write outputFile + ".region-" + name instead.
+    profiles = Coverage.filteredProfilePaths(outputFile).values()
+    if not profiles:
         raise AssertionError("Raw code coverage was not saved to \"" + outputFile + "\"" + (": " + err if err else ""))
+    return _runStatistics(wallTime, usage, profiles)
+
+# Run the executable, with every process it starts writing its own raw
+# coverage file (shard) in shardDirectory. Return (the list of shards, the
+# RunStatistics of the run).
+def recordRawCoverageShards(shardDirectory, executable, argsList = None, verbose = False, timeout = None, log = None):
+    _checkExecutable(executable)
+
+    # Shards left over from an earlier run would be merged too.
+    if glob.glob(os.path.join(shardDirectory, "*.profraw")):
+        raise AssertionError("\"" + shardDirectory + "\" already contains raw coverage files.")
+
+    with stages.stage("run executable"):
+        err, wallTime, usage = _runWithProfileFile(os.path.join(shardDirectory, _SHARD_PATTERN), executable, argsList, verbose, timeout, log)
+
+    shards = sorted(glob.glob(os.path.join(shardDirectory, "*.profraw")))
+    if not shards:
+        raise AssertionError("Raw code coverage was not saved to \"" + shardDirectory + "\"" + (": " + err if err else ""))
+    return shards, _runStatistics(wallTime, usage, shards)
+
+def _readShard(shard):
+    return Coverage.fromRawLlvmProfile(shard, useSnapshots = False)
+
+# Merge raw coverage files into a single Coverage object. Shards are read by up
+# to processes worker processes, defaulting to one per CPU, and each shard is
+# merged as soon as it has been read, so at most a few shards are held in
+# memory at once.
+def mergeRawCoverageShards(shards, processes = None):
+    with stages.stage("merge shards", len(shards)):
+        return _mergeRawCoverageShards(shards, processes)
+
+def _mergeRawCoverageShards(shards, processes):
+    merged = Coverage()
+    processes = min(processes or multiprocessing.cpu_count(), len(shards))
+    if processes <= 1:
+        for shard in shards:
+            merged.addCoverage(_readShard(shard))
+        return merged
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for coverage in pool.imap_unordered(_readShard, shards):
+            merged.addCoverage(coverage)
+    finally:
+        pool.close()
+        pool.join()
+    return merged
+
+# Run the executable, merge the shards written by all of its processes and save
+# them as a coverage snapshot at outputFile. Return (the merged Coverage object,
+# the RunStatistics of the run).
+def recordCoverage(outputFile, executable, argsList = None, verbose = False, processes = None, timeout = None, log = None):
+    shardDirectory = tempfile.mkdtemp()
+    try:
+        shards, statistics = recordRawCoverageShards(shardDirectory, executable, argsList, verbose, timeout, log)
+        coverage = mergeRawCoverageShards(shards, processes)
+    finally:
+        shutil.rmtree(shardDirectory)
+    coverage.saveSnapshot(outputFile)
+    return coverage, statistics
+
+# Record several invocations concurrently, up to processes at a time, defaulting
+# to one per CPU. Each invocation is a list of the executable and its arguments.
+# The coverage of invocation i is saved as a snapshot named "run<i>.snapshot" in
+# outputDirectory and its output is written to "run<i>.log". Return a list of
+# (snapshot, RunStatistics).
+def recordBatch(invocations, outputDirectory, processes = None, timeout = None):
+    if not os.path.isdir(outputDirectory):
+        os.makedirs(outputDirectory)
+    outputFiles = [os.path.join(outputDirectory, "run" + str(index)) for index in range(len(invocations))]
+
+    # Each invocation is mostly spent waiting on its executable, so threads are
+    # enough to run them concurrently. Shards are merged on the recording
+    # thread because the invocations already use the available CPUs.
+    def recordInvocation(index):
+        invocation = invocations[index]
+        snapshotFile = outputFiles[index] + ".snapshot"
+        coverage, statistics = recordCoverage(snapshotFile, invocation[0], invocation[1:], processes = 1, timeout = timeout, log = outputFiles[index] + ".log")
+        return snapshotFile, statistics
+
+    pool = ThreadPool(processes or multiprocessing.cpu_count())
+    try:
+        return pool.map(recordInvocation, range(len(invocations)))
+    finally:
+        pool.close()
+
+# Read invocations from a file with one command per line. Empty lines and lines
+# starting with # are ignored.
+def readInvocations(path):
+    invocations = []
+    with open(path, "r") as inFile:
+        for line in inFile:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                invocations.append(shlex.split(line))
+    return invocations
 
 def main():
     parser = argparse.ArgumentParser(description="Record code coverage")
-    parser.add_argument("executable", help="Executable to run (any additional arguments are forwarded to this executable)")
-    parser.add_argument("-o", "--output", help="Output raw code coverage file")
+    parser.add_argument("executable", nargs="?", help="Executable to run (any additional arguments are forwarded to this executable)")
+    parser.add_argument("-o", "--output", help="Output raw code coverage file, coverage snapshot with --shards, or directory with --batch")
+    parser.add_argument("--shards", action="store_true", help="Record a raw coverage file per process and merge them into a coverage snapshot")
+    parser.add_argument("--batch", help="File with one command per line to record concurrently, each into a coverage snapshot", metavar="COMMANDS")
+    parser.add_argument("-j", "--processes", type=int, help="Number of commands to record, or shards to merge, in parallel (default: one per CPU)", metavar="N")
+    parser.add_argument("--timeout", type=float, help="Kill the executable if it runs for longer than SECONDS", metavar="SECONDS")
+    parser.add_argument("--log", help="Write the executable's output to LOG instead of the terminal")
+    stages.addArguments(parser)
     args, leftoverArgs = parser.parse_known_args()
 
-    recordRawCoverageFile(args.output, args.executable, argsList = leftoverArgs, verbose = True)
+    if args.profile_stages:
+        stages.enable()
+    try:
+        _run(parser, args, leftoverArgs)
+    finally:
+        if args.profile_stages:
+            stages.writeReport(args.profile_stages_format, args.profile_stages_output)
+
+def _run(parser, args, leftoverArgs):
+    if args.batch:
+        if args.executable:
+            parser.error("--batch cannot be combined with an executable")
+        for outputFile, statistics in recordBatch(readInvocations(args.batch), args.output, args.processes, args.timeout):
+            print outputFile + ": " + formatRunStatistics(statistics)
+        return
+
+    if not args.executable:
+        parser.error("an executable is required")
+    if args.shards:
+        coverage, statistics = recordCoverage(args.output, args.executable, argsList = leftoverArgs, verbose = True, processes = args.processes, timeout = args.timeout, log = args.log)
+    else:
+        statistics = recordRawCoverageFile(args.output, args.executable, argsList = leftoverArgs, verbose = True, timeout = args.timeout, log = args.log)
+    # The executable's output goes to stdout, so the report goes to stderr.
+    sys.stderr.write("Recorded \"" + args.output + "\": " + formatRunStatistics(statistics) + "\n")
 
 if __name__ == "__main__":
     main()
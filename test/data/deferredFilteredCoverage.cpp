@@ -0,0 +1,51 @@
+// A simple program for testing deferred filtered code coverage output.
+//
+// This program makes five kinds of function calls (A, B, C, D, and E), but only
+// a subset should record code coverage (B three times, C, and E).
+
+#include <stdio.h>
+#include "../../FilterCoverage.h"
+
+void functionA() {
+    fprintf(stdout, "A\n");
+}
+
+void functionB() {
+    FilterCoverage::Scope scope(FilterCoverage::Deferred);
+    fprintf(stdout, "B\n");
+}
+
+void functionC() {
+    fprintf(stdout, "C\n");
+}
+
+void functionD() {
+    fprintf(stdout, "D\n");
+}
+
+void functionE() {
+    fprintf(stdout, "E\n");
+}
+
+int main(int argc, char *argv[]) {
+    fprintf(stdout, "main\n");
+
+    functionA();
+
+    for (int i = 0; i < 3; i++)
+        functionB();
+
+    {
+        FilterCoverage::Scope scope(FilterCoverage::Deferred);
+        functionC();
+    }
+
+    functionD();
+
+    FilterCoverage::beginDeferredFilteringCoverage();
+    functionE();
+    FilterCoverage::endDeferredFilteringCoverage();
+
+    // The filtered coverage is written at exit.
+    return 0;
+}
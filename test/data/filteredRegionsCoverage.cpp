@@ -0,0 +1,52 @@
+// A simple program for testing named filter regions.
+//
+// This program makes five kinds of function calls (A, B, C, D, and E). B is
+// called twice in the "layout" region, C is called in the "paint" region, D is
+// called in both regions, and A and E are not filtered.
+
+#include <stdio.h>
+#include "../../FilterCoverage.h"
+
+void functionA() {
+    fprintf(stdout, "A\n");
+}
+
+void functionB() {
+    FilterCoverage::Scope scope("layout");
+    fprintf(stdout, "B\n");
+}
+
+void functionC() {
+    fprintf(stdout, "C\n");
+}
+
+void functionD() {
+    fprintf(stdout, "D\n");
+}
+
+void functionE() {
+    fprintf(stdout, "E\n");
+}
+
+int main(int argc, char *argv[]) {
+    fprintf(stdout, "main\n");
+
+    functionA();
+
+    for (int i = 0; i < 2; i++)
+        functionB();
+
+    FilterCoverage::Region& paint = FilterCoverage::region("paint");
+    FilterCoverage::beginFilteringRegion(paint);
+    functionC();
+    {
+        FilterCoverage::Scope scope("layout");
+        functionD();
+    }
+    FilterCoverage::endFilteringRegion(paint);
+
+    functionE();
+
+    // The coverage of each region is written at exit.
+    return 0;
+}
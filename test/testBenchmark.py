@@ -0,0 +1,40 @@
+import unittest
+
+from benchmark import benchmarkCoverage
+from benchmark import synthetic
+from coverage.coverage import Coverage
+from coverage.demangle import demangleInProcess, inProcessDemanglingAvailable
+
+class TestBenchmark(unittest.TestCase):
+
+    def testSyntheticNames(self):
+        names = synthetic.mangledNames(1000)
+        self.assertEqual(len(set(names)), 1000)
+        if inProcessDemanglingAvailable():
+            self.assertEqual(demangleInProcess(names[7]), "ui::LayoutObject7::paintInternal7(content::PaintInfo7 const&, base::Vector<int> const&)")
+
+    # The synthetic dump should parse into the same call counts as the
+    # synthetic Coverage object.
+    def testSyntheticProfDataShowAllFunctions(self):
+        parsed = Coverage._fromProfDataShowAllFunctions(synthetic.profDataShowAllFunctions(1000))
+        expected = synthetic.coverage(1000)
+        self.assertEqual(len(parsed), 1000)
+        self.assertEqual(list(parsed.callCounts()), list(expected.callCounts()))
+        self.assertEqual(parsed.callCount("../../third_party/blink/renderer/core/layout/layout_object_10.cc", synthetic.mangledName(10)), expected.callCount("../../third_party/blink/renderer/core/layout/layout_object_10.cc", synthetic.mangledName(10)))
+
+    def testSyntheticChanges(self):
+        coverageA = synthetic.coverage(1000)
+        coverageB = synthetic.coverage(1000, changedFraction = 0.1)
+        changed = sum(1 for a, b in zip(coverageA.callCounts(), coverageB.callCounts()) if a != b)
+        self.assertTrue(50 < changed < 150)
+
+    def testMeasure(self):
+        for stage, run in benchmarkCoverage.STAGES:
+            result = benchmarkCoverage._measure(stage, 100, "c++filt -n")
+            self.assertEqual(result["stage"], stage)
+            self.assertEqual(result["functions"], 100)
+            self.assertGreaterEqual(result["seconds"], 0)
+            self.assertGreaterEqual(result["maxRss"], result["maxRssIncrease"])
+
+if __name__ == "__main__":
+    unittest.main()
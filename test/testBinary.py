@@ -0,0 +1,129 @@
+import json
+import os
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+from coverage import binary
+
+# Return a little endian 64-bit ELF file with the given section names.
+def elfWithSections(sectionNames):
+    names = "\0" + "\0".join([".shstrtab"] + sectionNames) + "\0"
+    nameOffsets = [0]
+    for name in [".shstrtab"] + sectionNames:
+        nameOffsets.append(names.index("\0" + name + "\0") + 1)
+    namesOffset = 64
+    sectionHeaderOffset = namesOffset + len(names)
+    header = _ELF_IDENT + struct.pack("<HHIQQQIHHHHHH", 2, 62, 1, 0, 0, sectionHeaderOffset, 0, 64, 0, 0, 64, len(nameOffsets), 1)
+    sectionHeaders = struct.pack("<IIQQQQIIQQ", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    sectionHeaders += struct.pack("<IIQQQQIIQQ", nameOffsets[1], 3, 0, 0, namesOffset, len(names), 0, 0, 1, 0)
+    for nameOffset in nameOffsets[2:]:
+        sectionHeaders += struct.pack("<IIQQQQIIQQ", nameOffset, 1, 0, 0, 0, 0, 0, 0, 1, 0)
+    return header + names + sectionHeaders
+
+_ELF_IDENT = "\x7fELF\x02\x01\x01" + "\0" * 9
+
+# Return a 64-bit Mach-O file with one __DATA segment with the given sections.
+def machOWithSections(sectionNames):
+    segment = struct.pack("<II16sQQQQIIII", 0x19, 72 + 80 * len(sectionNames), "__DATA", 0, 0, 0, 0, 3, 3, len(sectionNames), 0)
+    for name in sectionNames:
+        segment += struct.pack("<16s16sQQIIIIIIII", name, "__DATA", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    return struct.pack("<IiiIIIII", 0xfeedfacf, 0x01000007, 3, 2, 1, len(segment), 0, 0) + segment
+
+class TestBinary(unittest.TestCase):
+
+    def setUp(self):
+        self.tempOutputDir = tempfile.mkdtemp()
+        # Keep cached results out of the user's cache directory.
+        os.environ["CCDB_CACHE_DIR"] = os.path.join(self.tempOutputDir, "cache")
+
+    def tearDown(self):
+        del os.environ["CCDB_CACHE_DIR"]
+        shutil.rmtree(self.tempOutputDir)
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.tempOutputDir, name)
+        with open(path, "wb") as outFile:
+            outFile.write(data)
+        return path
+
+    def testElfSections(self):
+        self.assertEqual(binary.sectionNames(elfWithSections(["__llvm_prf_cnts", "__llvm_prf_data"])), set(["", ".shstrtab", "__llvm_prf_cnts", "__llvm_prf_data"]))
+        self.assertTrue(binary.isInstrumented(self.writeFile("instrumented", elfWithSections([".text", "__llvm_prf_cnts", "__llvm_prf_data"]))))
+        self.assertFalse(binary.isInstrumented(self.writeFile("notInstrumented", elfWithSections([".text", "__llvm_prf_names"]))))
+        # A real executable without coverage.
+        self.assertFalse(binary.isInstrumented(os.path.realpath(sys.executable)))
+
+    def testMachOSections(self):
+        machO = machOWithSections(["__data", "__llvm_prf_cnts", "__llvm_prf_data"])
+        self.assertEqual(binary.sectionNames(machO), set(["__data", "__llvm_prf_cnts", "__llvm_prf_data"]))
+        self.assertTrue(binary.isInstrumented(self.writeFile("instrumented", machO)))
+        self.assertFalse(binary.isInstrumented(self.writeFile("notInstrumented", machOWithSections(["__data"]))))
+
+        # Universal binaries have a Mach-O file per architecture.
+        fat = struct.pack(">IIIIIII", 0xcafebabe, 1, 0x01000007, 3, 64, len(machO), 0)
+        fat += "\0" * (64 - len(fat)) + machO
+        self.assertTrue(binary.isInstrumented(self.writeFile("universal", fat)))
+
+    def testOtherFormats(self):
+        # Other files are scanned for the profile runtime.
+        self.assertTrue(binary.isInstrumented(self.writeFile("script", "#!/bin/sh\n# " + "__llvm_profile " * 10 + "\n")))
+        self.assertFalse(binary.isInstrumented(self.writeFile("empty", "")))
+        # Truncated headers fall back to scanning too.
+        self.assertFalse(binary.isInstrumented(self.writeFile("truncated", elfWithSections(["__llvm_prf_cnts"])[:80])))
+
+    def testCachedByModificationTime(self):
+        path = self.writeFile("instrumented", elfWithSections(["__llvm_prf_cnts", "__llvm_prf_data"]))
+        os.utime(path, (1000000, 1000000))
+        self.assertTrue(binary.isInstrumented(path))
+
+        # The result is reused, even by a new process, while the size and
+        # modification time are unchanged.
+        self.writeFile("instrumented", elfWithSections(["__llvm_prf_cnts", "__llvm_prf_xxxx"]))
+        os.utime(path, (1000000, 1000000))
+        binary._instrumentedCache = None
+        self.assertTrue(binary.isInstrumented(path))
+
+        os.utime(path, (1000000, 1000001))
+        self.assertFalse(binary.isInstrumented(path))
+
+    def testCacheBounded(self):
+        paths = [self.writeFile("script" + str(index), "#!/bin/sh\n") for index in xrange(3)]
+        maxEntries = binary._INSTRUMENTED_CACHE_MAX_ENTRIES
+        binary._INSTRUMENTED_CACHE_MAX_ENTRIES = 2
+        try:
+            binary.isInstrumented(paths[0])
+            binary.isInstrumented(paths[1])
+            # Checking the first executable again makes the second the least
+            # recently checked.
+            binary.isInstrumented(paths[0])
+            binary.isInstrumented(paths[2])
+            with open(binary._instrumentedCachePath(), "r") as inFile:
+                self.assertEqual(sorted(json.load(inFile)), [paths[0], paths[2]])
+
+            # Executables that no longer exist are forgotten.
+            os.remove(paths[0])
+            binary.isInstrumented(paths[1])
+            with open(binary._instrumentedCachePath(), "r") as inFile:
+                self.assertEqual(sorted(json.load(inFile)), [paths[1], paths[2]])
+        finally:
+            binary._INSTRUMENTED_CACHE_MAX_ENTRIES = maxEntries
+
+    def testCacheDirectoryChanges(self):
+        path = self.writeFile("instrumented", elfWithSections(["__llvm_prf_cnts", "__llvm_prf_data"]))
+        os.utime(path, (1000000, 1000000))
+        self.assertTrue(binary.isInstrumented(path))
+        self.writeFile("instrumented", elfWithSections(["__llvm_prf_cnts", "__llvm_prf_xxxx"]))
+        os.utime(path, (1000000, 1000000))
+
+        # Each cache directory has its own results.
+        os.environ["CCDB_CACHE_DIR"] = os.path.join(self.tempOutputDir, "otherCache")
+        self.assertFalse(binary.isInstrumented(path))
+        os.environ["CCDB_CACHE_DIR"] = os.path.join(self.tempOutputDir, "cache")
+        self.assertTrue(binary.isInstrumented(path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from coverage.cache import DemangleCache, pruneSnapshots, snapshotPath, touchSnapshot
+from coverage.coverage import Coverage
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempCacheDir = tempfile.mkdtemp()
+        self.cachePath = os.path.join(self.tempCacheDir, "demangle.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempCacheDir)
+
+    def testLookupAndStore(self):
+        cache = DemangleCache(self.cachePath)
+        self.assertEqual(cache.lookup("c++filt -n", ["_Z1Av"]), {})
+        cache.store("c++filt -n", {"_Z1Av": "A()", "_Z1Bv": "B()"})
+        self.assertEqual(cache.lookup("c++filt -n", ["_Z1Av", "_Z1Cv"]), {"_Z1Av": "A()"})
+        # Names are cached per demangler.
+        self.assertEqual(cache.lookup("c++filt", ["_Z1Av"]), {})
+        cache.close()
+
+        # The cache persists across instances.
+        cache = DemangleCache(self.cachePath)
+        self.assertEqual(cache.lookup("c++filt -n", ["_Z1Bv"]), {"_Z1Bv": "B()"})
+        cache.close()
+
+    def testEviction(self):
+        cache = DemangleCache(self.cachePath, maxEntries = 2)
+        cache.store("c++filt -n", {"_Z1Av": "A()"})
+        cache.store("c++filt -n", {"_Z1Bv": "B()"})
+        # Using A makes B the least recently used name.
+        cache.lookup("c++filt -n", ["_Z1Av"])
+        cache.store("c++filt -n", {"_Z1Cv": "C()"})
+        self.assertEqual(cache.lookup("c++filt -n", ["_Z1Av", "_Z1Bv", "_Z1Cv"]), {"_Z1Av": "A()", "_Z1Cv": "C()"})
+        cache.close()
+
+    def testSnapshotEviction(self):
+        os.environ["CCDB_CACHE_DIR"] = self.tempCacheDir
+        try:
+            snapshots = [snapshotPath("run" + str(index) + ".profraw") for index in xrange(3)]
+            for index, snapshot in enumerate(snapshots):
+                with open(snapshot, "wb") as outFile:
+                    outFile.write("x" * 100)
+                os.utime(snapshot, (1000 + index, 1000 + index))
+            # Using the oldest snapshot makes the second the least recently used.
+            touchSnapshot(snapshots[0])
+            pruneSnapshots(maxEntries = 2)
+            self.assertEqual([os.path.exists(snapshot) for snapshot in snapshots], [True, False, True])
+            # Snapshots are removed by total size too.
+            pruneSnapshots(maxBytes = 150)
+            self.assertEqual([os.path.exists(snapshot) for snapshot in snapshots], [True, False, False])
+        finally:
+            del os.environ["CCDB_CACHE_DIR"]
+
+    def testDemanglingWithCache(self):
+        cache = DemangleCache(self.cachePath)
+        coverage = Coverage()
+        coverage.addCallCount("", "_Z8MangledAv", 1)
+        coverage.demangle("c++filt -n", cache)
+        self.assertEqual(coverage.callCount("", "MangledA()"), 1)
+
+        # Cached names should not be sent to the demangler.
+        cache.store("c++filt -n", {"_Z8MangledBv": "FromCache()"})
+        coverage = Coverage()
+        coverage.addCallCount("", "_Z8MangledAv", 2)
+        coverage.addCallCount("", "_Z8MangledBv", 3)
+        coverage.demangle("c++filt -n", cache)
+        self.assertEqual(coverage.callCount("", "MangledA()"), 2)
+        self.assertEqual(coverage.callCount("", "FromCache()"), 3)
+        cache.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,28 @@
+import os
+import os.path
+import shutil
+import tempfile
 import unittest
 
 import compare
-from coverage.coverage import Coverage
+from coverage.coverage import Coverage, Region
 import record
 
 from testCoverage import TestCoverage
+from testProfraw import writeRawProfile
 
 class TestCompare(unittest.TestCase):
 
+    def setUp(self):
+        # Keep cached instrumentation checks, profile snapshots and demangled
+        # names out of the user's cache directory.
+        self.cacheDir = tempfile.mkdtemp()
+        os.environ["CCDB_CACHE_DIR"] = self.cacheDir
+
+    def tearDown(self):
+        del os.environ["CCDB_CACHE_DIR"]
+        shutil.rmtree(self.cacheDir)
+
     def testFunctionInANotB(self):
         coverageA = Coverage()
         coverageA.addCallCount("", "fn", 5)
@@ -72,6 +87,211 @@ class TestCompare(unittest.TestCase):
         self.assertEqual(differences[1], "a call count difference: 0 != 5")
         self.assertEqual(differences[2], "c call count difference: 0 != 6")
 
+    def testTopDifferences(self):
+        coverageA = Coverage()
+        coverageA.addCallCount("", "a", 5)
+        coverageA.addCallCount("", "b", 4)
+        coverageA.addCallCount("", "c", 6)
+        coverageA.addCallCount("", "d", 1)
+        coverageB = Coverage()
+        coverageB.addCallCount("", "d", 1)
+
+        # Only the two largest differences should be returned, still ascending.
+        differences = compare.compare(coverageA, coverageB, top = 2)
+        self.assertEqual(len(differences), 2)
+        self.assertEqual(differences[0], "a call count difference: 5 != 0")
+        self.assertEqual(differences[1], "c call count difference: 6 != 0")
+
+    def testCallCountDifferences(self):
+        coverageA = Coverage()
+        coverageA.addCallCount("", "a", 5)
+        coverageA.addCallCount("", "same", 2)
+        coverageB = Coverage()
+        coverageB.addCallCount("", "same", 2)
+        coverageB.addCallCount("file.cpp", "b", 3)
+        coverageB.addCallCount("", "a", 7)
+
+        differences, functionForId = compare.callCountDifferences(coverageA, coverageB)
+        self.assertEqual(len(differences), 2)
+        self.assertEqual(functionForId(differences[0].id), ("", "a"))
+        self.assertEqual((differences[0].countA, differences[0].countB, differences[0].delta), (5, 7, 2))
+        self.assertEqual(functionForId(differences[1].id), ("file.cpp", "b"))
+        self.assertEqual((differences[1].countA, differences[1].countB, differences[1].delta), (0, 3, 3))
+
+    def testRegionDifferences(self):
+        coverageA = Coverage()
+        coverageA.addCallCount("", "fn", 2)
+        coverageA.addRegions("", "fn", [Region("a.cpp", 1, 1, 9, 2, 2), Region("a.cpp", 3, 5, 4, 6, 2), Region("a.cpp", 5, 5, 6, 6, 0)])
+        coverageA.addCallCount("", "same", 1)
+        coverageB = Coverage()
+        coverageB.addCallCount("", "fn", 2)
+        coverageB.addRegions("", "fn", [Region("a.cpp", 1, 1, 9, 2, 2), Region("a.cpp", 3, 5, 4, 6, 1), Region("a.cpp", 5, 5, 6, 6, 1)])
+        coverageB.addCallCount("", "same", 1)
+        coverageB.addRegions("", "new", [Region("b.cpp", 1, 1, 2, 2, 3)])
+        coverageB.addCallCount("", "new", 3)
+
+        self.assertEqual(compare.regionDifferences(coverageA, coverageB, "", "fn"), [
+            compare.RegionDifference("a.cpp", 3, 5, 4, 6, 2, 1),
+            compare.RegionDifference("a.cpp", 5, 5, 6, 6, 0, 1)])
+        # The call count of "fn" is the same, but its regions differ.
+        self.assertEqual(compare.compare(coverageA, coverageB), [
+            "fn region count difference with the same call count: 2",
+            "    a.cpp:3:5-4:6 region count difference: 2 != 1",
+            "    a.cpp:5:5-6:6 region count difference: 0 != 1",
+            "new call count difference: 0 != 3",
+            "    b.cpp:1:1-2:2 region count difference: 0 != 3"])
+        self.assertEqual(compare.compare(coverageA, coverageB, top = 1), [
+            "new call count difference: 0 != 3",
+            "    b.cpp:1:1-2:2 region count difference: 0 != 3"])
+
+    def testStreamCompare(self):
+        coverageA = Coverage()
+        coverageB = Coverage()
+        for index in range(10):
+            coverageA.addCallCount("", "_Z2f%dv" % index, index)
+            coverageB.addCallCount("", "_Z2f%dv" % index, 2 * index)
+        coverageA.addCallCount("", "same", 1)
+        coverageA.addRegions("", "same", [Region("a.cpp", 1, 1, 2, 2, 1)])
+        coverageB.addCallCount("", "same", 1)
+        coverageB.addRegions("", "same", [Region("a.cpp", 1, 1, 2, 2, 0)])
+
+        batches = []
+        def demangle(functions):
+            batches.append(sorted(functions))
+            return dict((function, function[3:5] + "()") for function in functions if function.startswith("_Z"))
+
+        # The largest differences come first, then region-only differences.
+        differences = list(compare.streamCompare(coverageA, coverageB, demangle = demangle, maxBatchSize = 4))
+        self.assertEqual(differences[:3], [
+            "f9() call count difference: 9 != 18",
+            "f8() call count difference: 8 != 16",
+            "f7() call count difference: 7 != 14"])
+        self.assertEqual(differences[-2:], [
+            "same region count difference with the same call count: 1",
+            "    a.cpp:1:1-2:2 region count difference: 1 != 0"])
+        self.assertEqual(len(differences), 11)
+        # Only shown functions are demangled, in batches of 1, 2, 4 and 4.
+        self.assertEqual([len(batch) for batch in batches], [1, 2, 4, 3])
+        self.assertEqual(batches[0], ["_Z2f9v"])
+
+        # Only the top differences are demangled.
+        batches = []
+        self.assertEqual(len(list(compare.streamCompare(coverageA, coverageB, top = 2, demangle = demangle))), 2)
+        self.assertEqual(batches, [["_Z2f9v"], ["_Z2f8v"]])
+
+        # Without demangling, the stream has the same differences as compare,
+        # largest first.
+        self.assertEqual(list(compare.streamCompare(coverageA, coverageB, top = 3)), list(reversed(compare.compare(coverageA, coverageB, top = 3))))
+
+        # Unlike demangleCoverages, the stream does not merge functions that
+        # demangle to the same name, such as constructor variants.
+        coverageA = Coverage()
+        coverageA.addCallCount("", "_ZN1AC1Ev", 3)
+        coverageA.addCallCount("", "_ZN1AC2Ev", 0)
+        coverageB = Coverage()
+        coverageB.addCallCount("", "_ZN1AC1Ev", 0)
+        coverageB.addCallCount("", "_ZN1AC2Ev", 3)
+        demangle = lambda functions: dict((function, "A::A()") for function in functions)
+        self.assertEqual(list(compare.streamCompare(coverageA, coverageB, demangle = demangle)), [
+            "A::A() call count difference: 3 != 0",
+            "A::A() call count difference: 0 != 3"])
+
+    def testFunctionFilter(self):
+        coverageA = Coverage()
+        coverageA.addCallCount("", "_ZN5blink12LayoutObject5paintEv", 1)
+        coverageA.addCallCount("layout.cc", "_ZL6helperv", 1)
+        coverageA.addCallCount("", "_ZN2cc5Layer4drawEv", 1)
+        coverageB = Coverage()
+
+        matches = compare.functionFilter("LayoutObject|layout\\.cc")
+        self.assertEqual([difference[:2] for difference in compare.iterDifferences(coverageA, coverageB, matches)], [
+            ("", "_ZN5blink12LayoutObject5paintEv"), ("layout.cc", "_ZL6helperv")])
+        self.assertEqual(list(compare.streamCompare(coverageA, coverageB, functionFilter = matches, demangle = lambda functions: {})), [
+            "_ZN5blink12LayoutObject5paintEv call count difference: 1 != 0",
+            "layout.cc: _ZL6helperv call count difference: 1 != 0"])
+
+        # Regions are only compared for functions that match.
+        regionCoverageA = Coverage()
+        regionCoverageB = Coverage()
+        for function in ["_ZN5blink12LayoutObject5paintEv", "_ZN2cc5Layer4drawEv"]:
+            for coverage, count in [(regionCoverageA, 1), (regionCoverageB, 0)]:
+                coverage.addCallCount("", function, 1)
+                coverage.addRegions("", function, [Region("a.cpp", 1, 1, 2, 2, count)])
+        comparedRegions = []
+        regions = regionCoverageA.regions
+        regionCoverageA.regions = lambda file, function: comparedRegions.append(function) or regions(file, function)
+        self.assertEqual([difference[:2] for difference in compare.iterDifferences(regionCoverageA, regionCoverageB, matches)], [
+            ("", "_ZN5blink12LayoutObject5paintEv")])
+        self.assertEqual(comparedRegions, ["_ZN5blink12LayoutObject5paintEv"])
+
+        # Filtering before demangling only keeps the matching names.
+        filtered = coverageA.filtered(matches)
+        self.assertEqual(filtered.functions(), [("", "_ZN5blink12LayoutObject5paintEv"), ("layout.cc", "_ZL6helperv")])
+        filtered.demangle("c++filt -n")
+        self.assertEqual(compare.compare(filtered, coverageB), [
+            "layout.cc: helper() call count difference: 1 != 0",
+            "blink::LayoutObject::paint() call count difference: 1 != 0"])
+
+    def testLoadCoverages(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            rawCoverageFileA = os.path.join(tempOutputDir, "a.profraw")
+            rawCoverageFileB = os.path.join(tempOutputDir, "b.profraw")
+            writeRawProfile(rawCoverageFileA, [("main", [1]), ("_Z1Av", [2])])
+            writeRawProfile(rawCoverageFileB, [("main", [1]), ("_Z1Av", [3])])
+            coverageA, coverageB = compare.loadCoverages([rawCoverageFileA, rawCoverageFileB], useSnapshots = False)
+            compare.demangleCoverages([coverageA, coverageB], "c++filt -n")
+            self.assertEqual(compare.compare(coverageA, coverageB), ["A() call count difference: 2 != 3"])
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testAggregateDifferences(self):
+        runDifferences = [
+            [("", "a", 1, 2), ("", "b", 5, 4)],
+            [("", "a", 1, 3), ("", "b", 5, 6), ("file.cpp", "c", 0, 9)],
+            [("", "a", 1, 2)]]
+        statistics = compare.aggregateDifferences(runDifferences)
+        self.assertEqual([(s.file, s.function) for s in statistics], [("", "a"), ("file.cpp", "c"), ("", "b")])
+        self.assertEqual(statistics[0], compare.FunctionStatistics("", "a", 1, 3, 4 / 3.0, 1.0))
+        self.assertEqual(statistics[1], compare.FunctionStatistics("file.cpp", "c", 0, 1, 3.0, 1 / 3.0))
+        # "b" differs in two runs but in opposite directions.
+        self.assertEqual(statistics[2], compare.FunctionStatistics("", "b", 5, 2, 0.0, 0.0))
+
+    def testCompareBatch(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            baselineFile = os.path.join(tempOutputDir, "good.profraw")
+            writeRawProfile(baselineFile, [("main", [1]), ("_Z1Av", [2]), ("_Z1Bv", [4])])
+            runPaths = []
+            for index, counts in enumerate([(3, 4), (3, 5), (2, 4)]):
+                runPaths.append(os.path.join(tempOutputDir, "bad" + str(index) + ".profraw"))
+                writeRawProfile(runPaths[-1], [("main", [1]), ("_Z1Av", [counts[0]]), ("_Z1Bv", [counts[1]])])
+            self.assertEqual(compare._expandRunPaths([tempOutputDir]), runPaths + [baselineFile])
+            # The baseline is not compared with itself.
+            self.assertEqual(compare._expandRunPaths([tempOutputDir], baselineFile), runPaths)
+            self.assertEqual(compare._expandRunPaths([os.path.join(tempOutputDir, "*.profraw")], os.path.join(tempOutputDir, ".", "good.profraw")), runPaths)
+
+            baseline = Coverage.fromRawLlvmProfile(baselineFile, useSnapshots = False)
+            statistics = compare.compareBatch(baseline, runPaths, processes = 2, useSnapshots = False)
+            self.assertEqual(statistics, [
+                compare.FunctionStatistics("", "_Z1Av", 2, 2, 2 / 3.0, 2 / 3.0),
+                compare.FunctionStatistics("", "_Z1Bv", 4, 1, 1 / 3.0, 1 / 3.0)])
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testSpectrumFromRawProfiles(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            paths = []
+            for index, functions in enumerate([[("main", [1]), ("_Z1Av", [2])], [("main", [1])], [("main", [1]), ("_Z1Av", [1]), ("_Z1Bv", [3])]]):
+                paths.append(os.path.join(tempOutputDir, str(index) + ".profraw"))
+                writeRawProfile(paths[-1], functions)
+            spectrum = compare.spectrumFromRawProfiles(paths[:2], paths[2:], useSnapshots = False, threads = 2)
+            self.assertEqual((spectrum.passingRuns, spectrum.failingRuns), (2, 1))
+            self.assertEqual([(s.function, s.failingRuns, s.passingRuns) for s in spectrum.rank()], [("_Z1Bv", 1, 0), ("_Z1Av", 1, 1), ("main", 1, 2)])
+        finally:
+            shutil.rmtree(tempOutputDir)
+
     # Integration test using the broken quicksort example.
     def testBrokenQuicksortExample(self):
         executable = "examples/brokenQuicksort/brokenQuicksort"
@@ -1,13 +1,26 @@
+import os
 import os.path
 import shutil
+import subprocess
+import sys
 import tempfile
 import unittest
 
-from coverage.coverage import Coverage
+from coverage.coverage import Coverage, Region
 import record
 
 class TestCoverage(unittest.TestCase):
 
+    def setUp(self):
+        # Keep cached instrumentation checks and profile snapshots out of the
+        # user's cache directory.
+        self.cacheDir = tempfile.mkdtemp()
+        os.environ["CCDB_CACHE_DIR"] = self.cacheDir
+
+    def tearDown(self):
+        del os.environ["CCDB_CACHE_DIR"]
+        shutil.rmtree(self.cacheDir)
+
     def testConstruction(self):
         coverage = Coverage()
 
@@ -45,6 +58,34 @@ class TestCoverage(unittest.TestCase):
         self.assertEqual(coverage.callCount("", "MangledB()"), 3)
         self.assertEqual(coverage.callCount("", "NotMangledAbc"), 1)
 
+    def testMissingCallCounts(self):
+        coverage = Coverage()
+        coverage.addCallCount("file.cpp", "fn1", 1)
+        # Looking up functions without call counts should not add them.
+        self.assertEqual(coverage.callCount("", "fn1"), 0)
+        self.assertEqual(coverage.callCount("file.cpp", "fn2"), 0)
+        self.assertEqual(coverage.functions(), [("file.cpp", "fn1")])
+
+    # A function name that demangles to an empty line should not cause a
+    # count mismatch.
+    def testDemanglingToEmptyName(self):
+        coverage = Coverage()
+        coverage.addCallCount("", "empty", 1)
+        coverage.addCallCount("", "_Z8MangledAv", 2)
+        coverage.demangle("sed -e 's/^empty$//'")
+        self.assertEqual(coverage.callCount("", ""), 1)
+        self.assertEqual(coverage.callCount("", "_Z8MangledAv"), 2)
+
+    # Complete and base object constructors (C1 and C2) demangle to the same
+    # name and should be merged.
+    def testDemanglingMergesFunctions(self):
+        coverage = Coverage()
+        coverage.addCallCount("", "_ZN1AC1Ev", 2)
+        coverage.addCallCount("", "_ZN1AC2Ev", 3)
+        coverage.demangle("c++filt -n")
+        self.assertEqual(coverage.functions(), [("", "A::A()")])
+        self.assertEqual(coverage.callCount("", "A::A()"), 5)
+
     def testJsonEncoding(self):
         coverage = Coverage()
         coverage.addCallCount("", "fn1", 1)
@@ -52,6 +93,114 @@ class TestCoverage(unittest.TestCase):
         coverage.addCallCount("file.cpp", "fn3", 3)
         self.assertEquals(coverage.asJson(), "{\"files\": {\"\": {\"fn2\": 2, \"fn1\": 1}, \"file.cpp\": {\"fn3\": 3}}}")
 
+    def testSnapshot(self):
+        coverage = Coverage()
+        coverage.addCallCount("", "fn1", 1)
+        coverage.addCallCount("file.cpp", "fn2", 2)
+        coverage.addCallCount("file.cpp", "fn1", 1 << 40)
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            snapshotFile = os.path.join(tempOutputDir, "coverage.snapshot")
+            coverage.saveSnapshot(snapshotFile, (10, 2.5, "x" * 20))
+            self.assertEqual(Coverage.snapshotSource(snapshotFile), (10, 2.5, "x" * 20))
+
+            loaded = Coverage.fromSnapshot(snapshotFile)
+            self.assertEqual(loaded.functions(), coverage.functions())
+            self.assertEqual(loaded.callCount("file.cpp", "fn1"), 1 << 40)
+            self.assertEqual(loaded.asJson(), coverage.asJson())
+
+            # Loaded coverage can still be added to.
+            loaded.addCallCount("", "fn1", 1)
+            loaded.addCallCount("", "fn3", 3)
+            self.assertEqual(loaded.callCount("", "fn1"), 2)
+            self.assertEqual(len(loaded.functions()), 4)
+
+            # Empty coverage round trips too.
+            Coverage().saveSnapshot(snapshotFile)
+            self.assertEqual(len(Coverage.fromSnapshot(snapshotFile).functions()), 0)
+
+            # Other files are not snapshots.
+            with open(snapshotFile, "wb") as outFile:
+                outFile.write("not a snapshot")
+            self.assertEqual(Coverage.snapshotSource(snapshotFile), None)
+            self.assertRaises(AssertionError, Coverage.fromSnapshot, snapshotFile)
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testRegions(self):
+        coverage = Coverage()
+        coverage.addCallCount("", "_ZN1AC1Ev", 2)
+        coverage.addRegions("", "_ZN1AC1Ev", [Region("a.cpp", 1, 10, 5, 2, 2), Region("a.cpp", 2, 5, 3, 6, 1)])
+        coverage.addRegions("", "_ZN1AC2Ev", [Region("a.cpp", 1, 10, 5, 2, 3), Region("a.cpp", 2, 5, 3, 6, 0)])
+        self.assertTrue(coverage.hasRegions())
+        self.assertEqual(coverage.regions("", "_ZN1AC1Ev"), [Region("a.cpp", 1, 10, 5, 2, 2), Region("a.cpp", 2, 5, 3, 6, 1)])
+        self.assertEqual(coverage.regions("", "missing"), [])
+
+        # Adding the same regions again adds their counts.
+        coverage.addRegions("", "_ZN1AC1Ev", [Region("a.cpp", 1, 10, 5, 2, 1), Region("a.cpp", 2, 5, 3, 6, 1)])
+        self.assertEqual([region.count for region in coverage.regions("", "_ZN1AC1Ev")], [3, 2])
+        self.assertRaises(AssertionError, coverage.addRegions, "", "_ZN1AC1Ev", [Region("a.cpp", 1, 10, 5, 2, 1)])
+
+        # Regions survive snapshots.
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            snapshotFile = os.path.join(tempOutputDir, "coverage.snapshot")
+            coverage.saveSnapshot(snapshotFile)
+            loaded = Coverage.fromSnapshot(snapshotFile)
+            self.assertEqual(loaded.regions("", "_ZN1AC2Ev"), coverage.regions("", "_ZN1AC2Ev"))
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+        # Functions that are merged by demangling have their region counts
+        # added together.
+        coverage.demangle("c++filt -n")
+        self.assertEqual(coverage.regions("", "A::A()"), [Region("a.cpp", 1, 10, 5, 2, 6), Region("a.cpp", 2, 5, 3, 6, 2)])
+
+    def testFiltered(self):
+        coverage = Coverage()
+        coverage.addCallCount("", "keep", 2)
+        coverage.addRegions("", "keep", [Region("a.cpp", 1, 1, 2, 2, 2)])
+        coverage.addCallCount("b.cpp", "drop", 1)
+        coverage.addRegions("b.cpp", "drop", [Region("b.cpp", 1, 1, 2, 2, 1)])
+        filtered = coverage.filtered(lambda file, function: function == "keep")
+        self.assertEqual(filtered.functions(), [("", "keep")])
+        self.assertEqual(filtered.callCount("", "keep"), 2)
+        self.assertEqual(filtered.regions("", "keep"), [Region("a.cpp", 1, 1, 2, 2, 2)])
+        # Names of other functions are not kept.
+        self.assertEqual(list(filtered._functionNames), ["keep"])
+        self.assertEqual(list(filtered._files), ["", "a.cpp"])
+
+    def testLlvmCovExportParsing(self):
+        coverage = Coverage.fromLlvmCovExport("""{"type": "llvm.coverage.json.export", "version": "2.0.1", "data": [{"files": [], "functions": [
+            {"name": "main", "count": 1, "filenames": ["/src/main.cpp"], "branches": [],
+             "regions": [[3, 16, 8, 2, 1, 0, 0, 0], [5, 9, 5, 14, 1, 0, 0, 0], [5, 15, 7, 4, 0, 0, 0, 0], [6, 5, 6, 8, 3, 0, 1, 1], [9, 1, 9, 5, 0, 0, 0, 2]]},
+            {"name": "util.h:_ZL1Av", "count": 4, "filenames": ["/src/main.cpp", "/src/util.h"], "branches": [],
+             "regions": [[1, 12, 3, 2, 4, 1, 0, 0]]},
+            {"name": "_Z1Bv", "count": 0, "filenames": ["/src/main.cpp"], "branches": [],
+             "regions": [[10, 10, 12, 2, 0, 0, 0, 0]]}]}]}""")
+        self.assertEqual(coverage.functions(), [("", "main"), ("util.h", "_ZL1Av")])
+        self.assertEqual(coverage.callCount("", "main"), 1)
+        # Only code regions are kept.
+        self.assertEqual(coverage.regions("", "main"), [
+            Region("/src/main.cpp", 3, 16, 8, 2, 1),
+            Region("/src/main.cpp", 5, 9, 5, 14, 1),
+            Region("/src/main.cpp", 5, 15, 7, 4, 0)])
+        self.assertEqual(coverage.regions("util.h", "_ZL1Av"), [Region("/src/util.h", 1, 12, 3, 2, 4)])
+
+    def testAddCoverage(self):
+        coverage = Coverage()
+        coverage.addCallCount("", "fn1", 1)
+        coverage.addRegions("", "fn1", [Region("a.cpp", 1, 1, 2, 2, 1)])
+        other = Coverage()
+        other.addCallCount("file.cpp", "fn2", 2)
+        other.addCallCount("", "fn1", 3)
+        other.addRegions("", "fn1", [Region("a.cpp", 1, 1, 2, 2, 3)])
+        coverage.addCoverage(other)
+        self.assertEqual(coverage.functions(), [("", "fn1"), ("file.cpp", "fn2")])
+        self.assertEqual(coverage.callCount("", "fn1"), 4)
+        self.assertEqual(coverage.callCount("file.cpp", "fn2"), 2)
+        self.assertEqual(coverage.regions("", "fn1"), [Region("a.cpp", 1, 1, 2, 2, 4)])
+
     def testProfDataShowAllFunctionsParsing(self):
         coverage = Coverage._fromProfDataShowAllFunctions("""Counters:
                   functionA:
@@ -75,6 +224,82 @@ class TestCoverage(unittest.TestCase):
         self.assertEquals(coverage.callCount("filename.cpp", "functionB"), 3)
         self.assertEquals(coverage.callCount("", "main"), 1)
 
+    def testProfDataShowAllFunctionsParsingLines(self):
+        lines = iter([
+            "Counters:\n",
+            "  functionA:\n",
+            "    Hash: 0x123\n",
+            "    Counters: 1\n",
+            "    Function count: 4\n",
+            "  filename.cpp:functionB:\n",
+            "    Hash: 0x456\n",
+            "    Counters: 6\n",
+            "    Function count: 0\n",
+            "  notAFunction:\n",
+            "    Counters: 2\n",
+            "    Function count: 9\n",
+            "Instrumentation level: Front-end\n"])
+        coverage = Coverage._fromProfDataShowAllFunctions(lines)
+        self.assertEquals(len(coverage.functions()), 1)
+        self.assertEquals(coverage.callCount("", "functionA"), 4)
+
+    # Parsing a large llvm-profdata dump should use memory proportional to the
+    # number of distinct functions, not the size of the dump. The parse runs in
+    # a separate process so its peak memory usage can be measured.
+    def testProfDataShowAllFunctionsPeakMemory(self):
+        script = "\n".join([
+            "import resource",
+            "from coverage.coverage import Coverage",
+            "def dump(functionCount):",
+            "    yield 'Counters:\\n'",
+            "    for index in xrange(functionCount):",
+            "        yield '  file%d.cpp:_ZN7content14RenderWidget%dEv:\\n' % (index % 100, index % 1000)",
+            "        yield '    Hash: 0x0123456789abcdef\\n'",
+            "        yield '    Counters: 12\\n'",
+            "        yield '    Function count: 1\\n'",
+            "coverage = Coverage._fromProfDataShowAllFunctions(dump(2000000))",
+            "assert len(coverage.functions()) == 1000",
+            "assert coverage.callCount('file1.cpp', '_ZN7content14RenderWidget1Ev') == 2000",
+            "print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss"])
+        maxRss = int(subprocess.check_output([sys.executable, "-c", script]))
+        # The dump is about 220MB. ru_maxrss is in kilobytes on Linux and bytes
+        # on MacOS.
+        if sys.platform == "darwin":
+            maxRss /= 1024
+        self.assertLess(maxRss, 64 * 1024)
+
+    # Parsing a large llvm-cov export should use memory proportional to the
+    # number of distinct functions, not the size of the export. The export is
+    # read from a file object, like the stdout of llvm-cov, in a separate
+    # process so its peak memory usage can be measured.
+    def testLlvmCovExportPeakMemory(self):
+        script = "\n".join([
+            "import resource",
+            "from coverage.coverage import Coverage",
+            "def export(functionCount):",
+            "    yield '{\"data\": [{\"files\": ['",
+            "    for index in xrange(functionCount / 10):",
+            "        yield (',' if index else '') + '{\"filename\": \"/src/file%d.cpp\", \"segments\": [' % index + ','.join(['[1, 2, 3, true, true, false]'] * 20) + ']}'",
+            "    yield '], \"functions\": ['",
+            "    for index in xrange(functionCount):",
+            "        yield (',' if index else '') + '{\"name\": \"_ZN7content14RenderWidget%dEv\", \"count\": 1, \"filenames\": [\"/src/file%d.cpp\"], \"branches\": [], \"regions\": [' % (index % 1000, index % 100) + ','.join(['[%d, 5, %d, 9, 1, 0, 0, 0]' % (line, line + 1) for line in xrange(10)]) + ']}'",
+            "    yield ']}], \"type\": \"llvm.coverage.json.export\", \"version\": \"2.0.1\"}'",
+            "class ExportFile(object):",
+            "    def __init__(self, chunks):",
+            "        self.chunks = chunks",
+            "    def read(self, size):",
+            "        return next(self.chunks, '')",
+            "coverage = Coverage.fromLlvmCovExport(ExportFile(export(100000)))",
+            "assert len(coverage.functions()) == 1000",
+            "assert coverage.callCount('', '_ZN7content14RenderWidget1Ev') == 100",
+            "print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss"])
+        maxRss = int(subprocess.check_output([sys.executable, "-c", script]))
+        # The export is about 40MB. ru_maxrss is in kilobytes on Linux and
+        # bytes on MacOS.
+        if sys.platform == "darwin":
+            maxRss /= 1024
+        self.assertLess(maxRss, 64 * 1024)
+
     # Run an executable with coverage enabled, then parse the raw coverage output
     # and return a Coverage object.
     @staticmethod
@@ -87,8 +312,9 @@ class TestCoverage(unittest.TestCase):
             # Generate the raw coverage file.
             record.recordRawCoverageFile(rawCoverageFile, executable, argsList)
 
-            # Parse the raw coverage file, returning the Coverage object.
-            return Coverage.fromRawLlvmProfile(rawCoverageFile)
+            # Parse the raw coverage file, returning the Coverage object. There
+            # is no point in caching a snapshot of a temporary file.
+            return Coverage.fromRawLlvmProfile(rawCoverageFile, useSnapshots = False)
         finally:
             shutil.rmtree(tempOutputDir)
 
@@ -129,5 +355,43 @@ class TestCoverage(unittest.TestCase):
         self.assertEqual(coverage.callCount("", "_Z9functionFv"), 1)
         self.assertEqual(coverage.callCount("", "_Z9functionGv"), 0)
 
+    # Integration test using the deferred filtered coverage executable. Only
+    # filtered functions should be in the recording, which is written at exit.
+    def testDeferredFiltering(self):
+        executable = "test/data/out/deferredFilteredCoverage"
+        coverage = TestCoverage.recordCoverage(executable)
+        self.assertEqual(coverage.callCount("", "_Z9functionAv"), 0)
+        self.assertEqual(coverage.callCount("", "_Z9functionBv"), 3)
+        self.assertEqual(coverage.callCount("", "_Z9functionCv"), 1)
+        self.assertEqual(coverage.callCount("", "_Z9functionDv"), 0)
+        self.assertEqual(coverage.callCount("", "_Z9functionEv"), 1)
+
+    # Integration test using the named filter regions executable. Each region
+    # should be loaded with only its own coverage.
+    def testFilteredRegions(self):
+        executable = "test/data/out/filteredRegionsCoverage"
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            rawCoverageFile = os.path.join(tempOutputDir, "coverage.profraw")
+            record.recordRawCoverageFile(rawCoverageFile, executable)
+            regions = Coverage.fromFilteredRawLlvmProfiles(rawCoverageFile, useSnapshots = False)
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+        self.assertEqual(sorted(regions.keys()), ["layout", "paint", "unfiltered"])
+        layout = regions["layout"]
+        self.assertEqual(layout.callCount("", "_Z9functionBv"), 2)
+        self.assertEqual(layout.callCount("", "_Z9functionCv"), 0)
+        self.assertEqual(layout.callCount("", "_Z9functionDv"), 1)
+        paint = regions["paint"]
+        self.assertEqual(paint.callCount("", "_Z9functionBv"), 0)
+        self.assertEqual(paint.callCount("", "_Z9functionCv"), 1)
+        self.assertEqual(paint.callCount("", "_Z9functionDv"), 1)
+        unfiltered = regions["unfiltered"]
+        self.assertEqual(unfiltered.callCount("", "_Z9functionAv"), 1)
+        self.assertEqual(unfiltered.callCount("", "_Z9functionBv"), 0)
+        self.assertEqual(unfiltered.callCount("", "_Z9functionDv"), 0)
+        self.assertEqual(unfiltered.callCount("", "_Z9functionEv"), 1)
+
 if __name__ == "__main__":
     unittest.main()
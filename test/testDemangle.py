@@ -0,0 +1,35 @@
+import unittest
+
+from coverage import demangle
+
+class TestDemangle(unittest.TestCase):
+
+    def testDemanglerPool(self):
+        mangledNames = ["_Z%d%sv" % (len(name), name) for name in ["function%d" % index for index in range(100)]]
+        # Use small chunks so names are spread across several processes.
+        pool = demangle.DemanglerPool("c++filt -n", processes = 3, chunkSize = 7)
+        demangledNames = pool.demangle(mangledNames)
+        self.assertEqual(demangledNames, ["function%d()" % index for index in range(100)])
+
+    def testEmptyNames(self):
+        pool = demangle.DemanglerPool("c++filt -n", processes = 2)
+        self.assertEqual(pool.demangle([]), [])
+        self.assertEqual(pool.demangle(["", "_Z1Av", ""]), ["", "A()", ""])
+
+    def testMissingDemangler(self):
+        pool = demangle.DemanglerPool("c--filt")
+        self.assertRaises(AssertionError, pool.demangle, [])
+        self.assertRaises(AssertionError, pool.demangle, ["_Z1Av"])
+
+    # A demangler that does not output one line per name should assert.
+    def testDemangledCountMismatch(self):
+        pool = demangle.DemanglerPool("sed -e p", processes = 2, chunkSize = 1)
+        self.assertRaises(AssertionError, pool.demangle, ["_Z1Av", "_Z1Bv"])
+
+    @unittest.skipUnless(demangle.inProcessDemanglingAvailable(), "__cxa_demangle is not available")
+    def testInProcessDemangling(self):
+        pool = demangle.DemanglerPool(demangle.IN_PROCESS_DEMANGLER)
+        self.assertEqual(pool.demangle(["_Z1Av", "_ZN1AC1Ev", "main", "_Znot_mangled"]), ["A()", "A::A()", "main", "_Znot_mangled"])
+
+if __name__ == "__main__":
+    unittest.main()
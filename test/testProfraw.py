@@ -0,0 +1,183 @@
+import os.path
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from coverage import cache
+from coverage import profraw
+from coverage.coverage import Coverage
+import record
+
+import testRecord
+
+# Write a version 8 raw profile containing the (name, counters) pairs in
+# functions. This mirrors what LLVM's profile runtime writes on a 64-bit little
+# endian machine.
+def writeRawProfile(path, functions, version = 8, compressNames = False):
+    names = "\x01".join(name for name, counters in functions)
+    if compressNames:
+        compressed = zlib.compress(names)
+        namesSection = _uleb128(len(names)) + _uleb128(len(compressed)) + compressed
+    else:
+        namesSection = _uleb128(len(names)) + _uleb128(0) + names
+
+    counters = []
+    for name, functionCounters in functions:
+        counters.extend(functionCounters)
+    dataSize = len(functions)
+    dataSectionSize = dataSize * 48
+    countersDelta = dataSectionSize
+
+    header = struct.pack("<QQQQQQQQQQQ", profraw._MAGIC_64, version, 0, dataSize, 0, len(counters), 0, len(namesSection), countersDelta, 0, 1)
+    records = ""
+    counterIndex = 0
+    for index, (name, functionCounters) in enumerate(functions):
+        # Version 8 counter pointers are relative to their data record.
+        counterPointer = (countersDelta + counterIndex * 8 - index * 48) & 0xffffffffffffffff
+        records += struct.pack("<QQQQQIHH", profraw.nameRef(name), 0x1234, counterPointer, 0, 0, len(functionCounters), 0, 0)
+        counterIndex += len(functionCounters)
+    countersSection = struct.pack("<" + "Q" * len(counters), *counters)
+    padding = "\0" * ((8 - len(namesSection) % 8) % 8)
+
+    with open(path, "wb") as outFile:
+        outFile.write(header + records + countersSection + namesSection + padding)
+
+def _uleb128(value):
+    encoded = ""
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded += chr(byte | 0x80)
+        else:
+            return encoded + chr(byte)
+
+class TestProfraw(unittest.TestCase):
+
+    def setUp(self):
+        self.tempOutputDir = tempfile.mkdtemp()
+        self.rawCoverageFile = os.path.join(self.tempOutputDir, "coverage.profraw")
+        # Keep profile snapshots out of the user's cache directory.
+        os.environ["CCDB_CACHE_DIR"] = os.path.join(self.tempOutputDir, "cache")
+
+    def tearDown(self):
+        del os.environ["CCDB_CACHE_DIR"]
+        shutil.rmtree(self.tempOutputDir)
+
+    def testReadRawProfile(self):
+        writeRawProfile(self.rawCoverageFile, [("main", [1, 2]), ("_Z1Av", [3]), ("file.cpp:_ZL1Bv", [0, 5, 6])])
+        functions = profraw.readRawProfile(self.rawCoverageFile)
+        self.assertEqual(len(functions), 3)
+        self.assertEqual(functions[0].name, "main")
+        self.assertEqual(list(functions[0].counters), [1, 2])
+        self.assertEqual(functions[1].name, "_Z1Av")
+        self.assertEqual(list(functions[1].counters), [3])
+        self.assertEqual(functions[2].name, "file.cpp:_ZL1Bv")
+        self.assertEqual(list(functions[2].counters), [0, 5, 6])
+
+    def testCompressedNames(self):
+        writeRawProfile(self.rawCoverageFile, [("main", [1]), ("_Z1Av", [7])], compressNames = True)
+        functions = profraw.readRawProfile(self.rawCoverageFile)
+        self.assertEqual([(function.name, list(function.counters)) for function in functions], [("main", [1]), ("_Z1Av", [7])])
+
+    # Corrupt or truncated names sections are left to llvm-profdata.
+    def testCorruptNames(self):
+        def patch(offset, data):
+            with open(self.rawCoverageFile, "r+b") as outFile:
+                outFile.seek(offset)
+                outFile.write(data)
+        # The names section follows the 88 byte header, a 48 byte data record
+        # and an 8 byte counter.
+        namesOffset = 88 + 48 + 8
+
+        writeRawProfile(self.rawCoverageFile, [("main", [1])], compressNames = True)
+        # The compressed names start after two one-byte sizes.
+        patch(namesOffset + 2, "\xff\xff")
+        self.assertEqual(profraw.readRawProfile(self.rawCoverageFile), None)
+
+        writeRawProfile(self.rawCoverageFile, [("main", [1])])
+        # A size that runs past the end of the section.
+        patch(namesOffset, "\x80" * 6)
+        self.assertEqual(profraw.readRawProfile(self.rawCoverageFile), None)
+
+        writeRawProfile(self.rawCoverageFile, [("main", [1])])
+        # A size larger than the section.
+        patch(namesOffset, "\x05")
+        self.assertEqual(profraw.readRawProfile(self.rawCoverageFile), None)
+
+    def testUnsupportedVersion(self):
+        writeRawProfile(self.rawCoverageFile, [("main", [1])], version = 99)
+        self.assertEqual(profraw.readRawProfile(self.rawCoverageFile), None)
+
+    def testNotARawProfile(self):
+        with open(self.rawCoverageFile, "wb") as outFile:
+            outFile.write("Counters:\n  main:\n")
+        self.assertEqual(profraw.readRawProfile(self.rawCoverageFile), None)
+
+    def testCoverageFromRawProfile(self):
+        writeRawProfile(self.rawCoverageFile, [("main", [1, 2]), ("_Z1Av", [3]), ("_Z1Bv", [0]), ("file.cpp:_ZL1Cv", [4])])
+        coverage = Coverage.fromRawLlvmProfile(self.rawCoverageFile)
+        # Functions that were never called are omitted.
+        self.assertEqual(len(coverage.functions()), 3)
+        self.assertEqual(coverage.callCount("", "main"), 1)
+        self.assertEqual(coverage.callCount("", "_Z1Av"), 3)
+        self.assertEqual(coverage.callCount("file.cpp", "_ZL1Cv"), 4)
+
+    def testSnapshotReuse(self):
+        writeRawProfile(self.rawCoverageFile, [("main", [1]), ("_Z1Av", [3])])
+        self.assertEqual(Coverage.fromRawLlvmProfile(self.rawCoverageFile).callCount("", "_Z1Av"), 3)
+        snapshotFile = cache.snapshotPath(self.rawCoverageFile)
+        self.assertTrue(os.path.isfile(snapshotFile))
+
+        # Replace the snapshot's contents, keeping its source. An unchanged raw
+        # profile should be loaded from the snapshot.
+        replacement = Coverage()
+        replacement.addCallCount("", "fromSnapshot", 1)
+        replacement.saveSnapshot(snapshotFile, Coverage.snapshotSource(snapshotFile))
+        self.assertEqual(Coverage.fromRawLlvmProfile(self.rawCoverageFile).functions(), [("", "fromSnapshot")])
+        self.assertEqual(Coverage.fromRawLlvmProfile(self.rawCoverageFile, useSnapshots = False).callCount("", "_Z1Av"), 3)
+
+        # A raw profile with the same size and modification time but different
+        # contents should be parsed again.
+        stat = os.stat(self.rawCoverageFile)
+        writeRawProfile(self.rawCoverageFile, [("main", [1]), ("_Z1Av", [4])])
+        os.utime(self.rawCoverageFile, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(Coverage.fromRawLlvmProfile(self.rawCoverageFile).callCount("", "_Z1Av"), 4)
+
+    def testFilteredRawProfiles(self):
+        writeRawProfile(self.rawCoverageFile + ".region-layout", [("main", [0]), ("_Z6layoutv", [2])])
+        writeRawProfile(self.rawCoverageFile + ".region-paint", [("main", [0]), ("_Z5paintv", [3])])
+        writeRawProfile(self.rawCoverageFile + "_unfiltered", [("main", [1]), ("_Z6layoutv", [0])])
+        # Files for other profiles in the same directory are not regions, and
+        # neither are other files whose names start with the profile's.
+        writeRawProfile(os.path.join(self.tempOutputDir, "other.profraw.region-layout"), [("main", [1])])
+        writeRawProfile(self.rawCoverageFile + "_x", [("main", [1])])
+
+        self.assertEqual(sorted(Coverage.filteredProfilePaths(self.rawCoverageFile).keys()), ["layout", "paint", "unfiltered"])
+        regions = Coverage.fromFilteredRawLlvmProfiles(self.rawCoverageFile)
+        self.assertEqual(regions["layout"].functions(), [("", "_Z6layoutv")])
+        self.assertEqual(regions["layout"].callCount("", "_Z6layoutv"), 2)
+        self.assertEqual(regions["paint"].functions(), [("", "_Z5paintv")])
+        self.assertEqual(regions["unfiltered"].functions(), [("", "main")])
+
+        # The unnamed region is the raw profile itself.
+        writeRawProfile(self.rawCoverageFile, [("_Z8filteredv", [4])])
+        regions = Coverage.fromFilteredRawLlvmProfiles(self.rawCoverageFile)
+        self.assertEqual(sorted(regions.keys()), ["", "layout", "paint", "unfiltered"])
+        self.assertEqual(regions[""].callCount("", "_Z8filteredv"), 4)
+
+        # Recording again removes the old regions, but not the unrelated file.
+        executable = os.path.join(self.tempOutputDir, "multiprocess")
+        testRecord.TestRecord.writeMultiprocessExecutable(executable)
+        record.recordRawCoverageFile(self.rawCoverageFile, executable)
+        self.assertEqual(Coverage.filteredProfilePaths(self.rawCoverageFile).keys(), [""])
+        self.assertTrue(os.path.isfile(self.rawCoverageFile + "_x"))
+
+    def testNoFilteredRawProfiles(self):
+        self.assertEqual(Coverage.filteredProfilePaths(self.rawCoverageFile), {})
+        self.assertRaises(AssertionError, Coverage.fromFilteredRawLlvmProfiles, self.rawCoverageFile)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,62 @@
+import os
 import os.path
 import shutil
+import stat
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
+from coverage.coverage import Coverage
 import record
 
+# A stand-in for an instrumented executable that starts a child process. Each
+# process writes a raw coverage file to LLVM_PROFILE_FILE, expanding %p and %m
+# like LLVM's profile runtime. The parent calls "parent" as many times as its
+# first argument.
+_MULTIPROCESS_EXECUTABLE = """#!%(python)s
+# """ + "__llvm_profile " * 10 + """
+import os
+import subprocess
+import sys
+sys.path[:0] = [%(testDirectory)r, os.path.dirname(%(testDirectory)r)]
+from testProfraw import writeRawProfile
+path = os.environ["LLVM_PROFILE_FILE"].replace("%%p", str(os.getpid())).replace("%%m", "0")
+if sys.argv[1:] in (["sleep"], ["grandchild"]):
+    import time
+    if sys.argv[1:] == ["grandchild"]:
+        # Outlives this process and keeps its stderr open.
+        subprocess.Popen(["sleep", "20"])
+    sys.stderr.write("sleeping\\n")
+    sys.stderr.flush()
+    time.sleep(60)
+if sys.argv[1:] == ["child"]:
+    writeRawProfile(path, [("main", [1]), ("_Z5childv", [2])])
+else:
+    subprocess.check_call([sys.argv[0], "child"])
+    sys.stdout.write("out\\n")
+    sys.stderr.write("err\\n")
+    writeRawProfile(path, [("main", [1]), ("_Z6parentv", [int(sys.argv[1]) if sys.argv[1:] else 1])])
+"""
+
 class TestRecord(unittest.TestCase):
 
+    def setUp(self):
+        # Keep cached instrumentation checks out of the user's cache directory.
+        self.cacheDir = tempfile.mkdtemp()
+        os.environ["CCDB_CACHE_DIR"] = self.cacheDir
+
+    def tearDown(self):
+        del os.environ["CCDB_CACHE_DIR"]
+        shutil.rmtree(self.cacheDir)
+
+    @staticmethod
+    def writeMultiprocessExecutable(path):
+        with open(path, "w") as outFile:
+            outFile.write(_MULTIPROCESS_EXECUTABLE % { "python": sys.executable, "testDirectory": os.path.dirname(os.path.abspath(__file__)) })
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
     # Ensure an error is thrown if there is no coverage data in the binary.
     def testBinaryNotBuiltWithCoverageError(self):
         try:
@@ -42,5 +92,98 @@ class TestRecord(unittest.TestCase):
         finally:
             shutil.rmtree(tempOutputDir)
 
+    # Each process should write its own shard, and the shards should be merged.
+    def testRecordShards(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            executable = os.path.join(tempOutputDir, "multiprocess")
+            TestRecord.writeMultiprocessExecutable(executable)
+            shardDirectory = os.path.join(tempOutputDir, "shards")
+            os.mkdir(shardDirectory)
+            shards, statistics = record.recordRawCoverageShards(shardDirectory, executable, ["3"])
+            self.assertEqual(len(shards), 2)
+            self.assertEqual(statistics.profileSize, sum(os.path.getsize(shard) for shard in shards))
+            # Recording into a directory that already has shards should fail.
+            self.assertRaises(AssertionError, record.recordRawCoverageShards, shardDirectory, executable)
+
+            coverage = record.mergeRawCoverageShards(shards, processes = 2)
+            self.assertEqual(coverage.callCount("", "main"), 2)
+            self.assertEqual(coverage.callCount("", "_Z5childv"), 2)
+            self.assertEqual(coverage.callCount("", "_Z6parentv"), 3)
+
+            snapshotFile = os.path.join(tempOutputDir, "coverage.snapshot")
+            record.recordCoverage(snapshotFile, executable, ["3"])[0]
+            self.assertEqual(Coverage.fromRawLlvmProfile(snapshotFile).asJson(), coverage.asJson())
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testRunStatistics(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            executable = os.path.join(tempOutputDir, "multiprocess")
+            TestRecord.writeMultiprocessExecutable(executable)
+            rawCoverageFile = os.path.join(tempOutputDir, "coverage.profraw")
+            statistics = record.recordRawCoverageFile(rawCoverageFile, executable)
+            self.assertEqual(statistics.profileSize, os.path.getsize(rawCoverageFile))
+            self.assertGreater(statistics.wallTime, 0)
+            self.assertGreater(statistics.maxRss, 1024 * 1024)
+            self.assertIn("max RSS", record.formatRunStatistics(statistics))
+
+            # Runs that take too long are killed.
+            self.assertRaises(AssertionError, record.recordRawCoverageFile, rawCoverageFile, executable, ["sleep"], timeout = 0.5)
+
+            # So are the processes they started.
+            start = time.time()
+            self.assertRaises(AssertionError, record.recordRawCoverageFile, rawCoverageFile, executable, ["grandchild"], timeout = 1)
+            self.assertLess(time.time() - start, 10)
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    # If waiting is interrupted, such as by Ctrl-C, the executable is killed
+    # and its stderr is still copied to the log before the log is closed.
+    def testInterruptedRun(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            executable = os.path.join(tempOutputDir, "multiprocess")
+            TestRecord.writeMultiprocessExecutable(executable)
+            rawCoverageFile = os.path.join(tempOutputDir, "coverage.profraw")
+            logFile = os.path.join(tempOutputDir, "log.txt")
+            wait4 = os.wait4
+            def interruptedWait4(pid, options):
+                time.sleep(0.5)
+                raise KeyboardInterrupt()
+            threads = threading.active_count()
+            os.wait4 = interruptedWait4
+            try:
+                self.assertRaises(KeyboardInterrupt, record.recordRawCoverageFile, rawCoverageFile, executable, ["sleep"], log = logFile)
+            finally:
+                os.wait4 = wait4
+            self.assertEqual(threading.active_count(), threads)
+            with open(logFile, "r") as inFile:
+                self.assertIn("sleeping", inFile.read())
+        finally:
+            shutil.rmtree(tempOutputDir)
+
+    def testRecordBatch(self):
+        try:
+            tempOutputDir = tempfile.mkdtemp()
+            executable = os.path.join(tempOutputDir, "multiprocess")
+            TestRecord.writeMultiprocessExecutable(executable)
+            commandsFile = os.path.join(tempOutputDir, "commands.txt")
+            with open(commandsFile, "w") as outFile:
+                outFile.write("# Comments and empty lines are ignored.\n\n" + executable + " 4\n" + executable + " 5\n")
+            invocations = record.readInvocations(commandsFile)
+            self.assertEqual(invocations, [[executable, "4"], [executable, "5"]])
+
+            outputFiles = [outputFile for outputFile, statistics in record.recordBatch(invocations, os.path.join(tempOutputDir, "out"), processes = 2)]
+            self.assertEqual([os.path.basename(outputFile) for outputFile in outputFiles], ["run0.snapshot", "run1.snapshot"])
+            # The output of each run is logged next to its snapshot.
+            with open(os.path.join(tempOutputDir, "out", "run1.log"), "r") as inFile:
+                self.assertEqual(sorted(inFile.read().split()), ["err", "out"])
+            self.assertEqual(Coverage.fromSnapshot(outputFiles[0]).callCount("", "_Z6parentv"), 4)
+            self.assertEqual(Coverage.fromSnapshot(outputFiles[1]).callCount("", "_Z6parentv"), 5)
+        finally:
+            shutil.rmtree(tempOutputDir)
+
 if __name__ == "__main__":
     unittest.main()
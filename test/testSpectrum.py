@@ -0,0 +1,57 @@
+import unittest
+
+from coverage.coverage import Coverage
+from coverage import spectrum
+from coverage.spectrum import Spectrum
+
+class TestSpectrum(unittest.TestCase):
+
+    @staticmethod
+    def coverageOf(functions):
+        coverage = Coverage()
+        for function in functions:
+            coverage.addCallCount("", function, 1)
+        return coverage
+
+    def testMetrics(self):
+        self.assertAlmostEqual(spectrum.ochiai(2, 1, 2, 4), 2 / 6 ** 0.5)
+        self.assertEqual(spectrum.ochiai(0, 0, 0, 4), 0.0)
+        self.assertAlmostEqual(spectrum.tarantula(2, 1, 2, 4), 1 / 1.25)
+        self.assertEqual(spectrum.tarantula(0, 0, 2, 4), 0.0)
+        self.assertEqual(spectrum.dstar(2, 1, 3, 4), 2.0)
+        self.assertEqual(spectrum.dstar(2, 0, 2, 4), float("inf"))
+
+    def testRank(self):
+        runs = Spectrum()
+        runs.addRun(TestSpectrum.coverageOf(["main", "common", "onlyPassing"]), False)
+        runs.addRun(TestSpectrum.coverageOf(["main", "common"]), False)
+        runs.addRun(TestSpectrum.coverageOf(["main", "common", "bug"]), True)
+        runs.addRun(TestSpectrum.coverageOf(["main", "bug", "sometimes"]), True)
+        runs.addRun(TestSpectrum.coverageOf(["main", "bug"]), True)
+        self.assertEqual((runs.passingRuns, runs.failingRuns, len(runs)), (2, 3, 5))
+
+        ranked = runs.rank("ochiai")
+        # Functions that no failing run called are omitted.
+        self.assertEqual([suspiciousness.function for suspiciousness in ranked], ["bug", "main", "sometimes", "common"])
+        self.assertEqual(ranked[0], spectrum.Suspiciousness("", "bug", 1.0, 3, 0))
+        self.assertEqual((ranked[1].failingRuns, ranked[1].passingRuns), (3, 2))
+
+        ranked = runs.rank("dstar", top = 2)
+        self.assertEqual([suspiciousness.function for suspiciousness in ranked], ["bug", "main"])
+        self.assertEqual(ranked[0].score, float("inf"))
+
+        self.assertEqual(runs.rank("tarantula")[-1].function, "common")
+        self.assertRaises(AssertionError, runs.rank, "unknown")
+
+    def testFilesAreDistinct(self):
+        runs = Spectrum()
+        failing = Coverage()
+        failing.addCallCount("a.cpp", "fn", 1)
+        runs.addRun(failing, True)
+        passing = Coverage()
+        passing.addCallCount("b.cpp", "fn", 1)
+        runs.addRun(passing, False)
+        self.assertEqual(runs.rank(), [spectrum.Suspiciousness("a.cpp", "fn", 1.0, 1, 0)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import json
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from coverage import stages
+from coverage.coverage import Coverage
+from testProfraw import writeRawProfile
+
+class TestStages(unittest.TestCase):
+
+    def setUp(self):
+        self.tempOutputDir = tempfile.mkdtemp()
+        os.environ["CCDB_CACHE_DIR"] = os.path.join(self.tempOutputDir, "cache")
+
+    def tearDown(self):
+        stages.disable()
+        del os.environ["CCDB_CACHE_DIR"]
+        shutil.rmtree(self.tempOutputDir)
+
+    def testDisabled(self):
+        self.assertFalse(stages.enabled())
+        with stages.stage("outer") as stage:
+            stage.items = 3
+        self.assertEqual(stages.records(), [])
+
+    def testNestedStages(self):
+        finished = []
+        stages.enable(finished.append)
+        with stages.stage("outer") as outer:
+            with stages.stage("inner", 5):
+                subprocess.check_call([sys.executable, "-c", "sum(range(100000))"])
+            outer.items = 2
+        records = stages.records()
+        self.assertEqual([(record.name, record.depth, record.items) for record in records], [("outer", 0, 2), ("inner", 1, 5)])
+        # Stages finish innermost first.
+        self.assertEqual([record.name for record in finished], ["inner", "outer"])
+        inner = records[1]
+        self.assertGreater(inner.subprocessTime, 0)
+        self.assertGreater(inner.maxRss, 0)
+        self.assertGreaterEqual(records[0].wallTime, inner.wallTime)
+
+    def testThreads(self):
+        stages.enable()
+        def load():
+            with stages.stage("load"):
+                with stages.stage("parse"):
+                    pass
+        threads = [threading.Thread(target=load) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        records = stages.records()
+        self.assertEqual(len(records), 8)
+        self.assertEqual(sorted((record.name, record.depth) for record in records), [("load", 0)] * 4 + [("parse", 1)] * 4)
+
+        # Each thread's stages are listed together in the table.
+        lines = stages.formatTable(records).splitlines()
+        self.assertEqual([line.split()[0] for line in lines[1:]], ["load", "parse"] * 4)
+
+    def testFormats(self):
+        stages.enable()
+        with stages.stage("outer", 7):
+            with stages.stage("inner"):
+                pass
+        records = stages.records()
+
+        encoded = json.loads(stages.formatJson(records))
+        self.assertEqual([record["name"] for record in encoded], ["outer", "inner"])
+        self.assertEqual(encoded[0]["items"], 7)
+
+        trace = json.loads(stages.formatTrace(records))
+        events = trace["traceEvents"]
+        self.assertEqual([event["name"] for event in events], ["outer", "inner"])
+        self.assertEqual(events[0]["ph"], "X")
+        self.assertEqual(events[0]["ts"], 0)
+        self.assertEqual(events[0]["args"]["items"], 7)
+        self.assertGreaterEqual(events[0]["dur"], events[1]["dur"])
+
+        reportFile = os.path.join(self.tempOutputDir, "stages.json")
+        stages.writeReport("json", reportFile)
+        with open(reportFile, "r") as inFile:
+            self.assertEqual(len(json.load(inFile)), 2)
+
+    def testLoadStages(self):
+        rawCoverageFile = os.path.join(self.tempOutputDir, "coverage.profraw")
+        writeRawProfile(rawCoverageFile, [("main", [1]), ("_Z1Av", [3]), ("_Z1Bv", [0])])
+        stages.enable()
+        coverage = Coverage.fromRawLlvmProfile(rawCoverageFile)
+        coverage.demangle("c++filt -n")
+        # The second load uses the snapshot.
+        Coverage.fromRawLlvmProfile(rawCoverageFile)
+        records = stages.records()
+        self.assertEqual([(record.name, record.items) for record in records], [
+            ("load profile", 2), ("read raw profile", 3), ("save snapshot", 2),
+            ("demangle", 2), ("run demangler", 2), ("rename functions", 2),
+            ("load profile", 2), ("load snapshot", 2)])
+
+if __name__ == "__main__":
+    unittest.main()